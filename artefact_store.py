@@ -0,0 +1,328 @@
+"""
+Content-addressed store for raw responses, repaired originals and debug prompts.
+
+Instead of one small file per attempt (raw_responses/, fixed_json_originals/,
+debug_prompts/), artefacts are written to a store under artefacts/store/:
+
+    segments/segment-000001.pack  compressed blobs appended back to back
+    objects.jsonl                 sha256 -> (segment, offset, length, codec, size)
+    index.jsonl                   (kind, complaint, differential, attempt) -> blob hashes
+
+Blobs are keyed by the sha256 of their content, so identical content is stored
+once. An entry may be made of several blobs that are concatenated on read;
+debug prompts are stored as (prefix, suffix) so the large shared prompt prefix
+is kept only once. Blobs are compressed with gzip (zlib), or zstd when the
+optional `zstandard` package is installed and requested. Segments are rotated
+once they reach `segment_size` bytes.
+
+Both journals are append-only JSONL replayed on open. A torn final line from
+an interrupted write is skipped, and truncated before the store next appends
+to the journal; index entries that refer to a blob missing from objects.jsonl
+are skipped.
+
+Command line:
+
+    python artefact_store.py stats
+    python artefact_store.py list --kind raw_response --complaint Headache
+    python artefact_store.py cat raw_response Headache Migraine 2
+    python artefact_store.py extract --kind raw_response --out artefacts   # old file layout
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+from case_writer import truncate_torn_line
+from run_logging import get_logger
+
+DEFAULT_STORE_DIRNAME = "store"
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+KIND_RAW_RESPONSE = "raw_response"
+KIND_REPAIRED_ORIGINAL = "repaired_original"
+KIND_DEBUG_PROMPT = "debug_prompt"
+
+# Where each kind used to be written, for `extract` and tools expecting the old layout.
+LEGACY_LAYOUT = {
+    KIND_RAW_RESPONSE: ("raw_responses", "{complaint}__{differential}_attempt{attempt}.txt"),
+    KIND_REPAIRED_ORIGINAL: ("fixed_json_originals", "{complaint}__{differential}_attempt{attempt}_repaired_original.json"),
+    KIND_DEBUG_PROMPT: ("debug_prompts", "{complaint}__{differential}_attempt{attempt}.txt"),
+}
+
+INVALID_FILENAME_CHARS = re.compile(r'[\\/:*?"<>|]')
+
+logger = get_logger("artefact_store")
+
+
+def _zstd_codec():
+    # Optional dependency, only needed when zstd compression is requested.
+    import zstandard
+    return zstandard.ZstdCompressor(level=10).compress, zstandard.ZstdDecompressor().decompress
+
+
+def _codec(name):
+    """Return (compress, decompress) for a codec name."""
+    if name == "gzip":
+        return (lambda data: zlib.compress(data, 6)), zlib.decompress
+    if name == "zstd":
+        return _zstd_codec()
+    if name == "none":
+        return (lambda data: data), (lambda data: data)
+    raise ValueError(f"Unknown artefact store compression '{name}'")
+
+
+def _read_journal(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"⚠️ Ignoring unreadable line {line_number} in {path}",
+                               extra={"path": path, "line_number": line_number})
+
+
+def legacy_filename(kind, complaint, differential, attempt):
+    """Relative path the entry had before the store existed, e.g. raw_responses/<c>__<d>_attempt1.txt."""
+    directory, pattern = LEGACY_LAYOUT[kind]
+    return os.path.join(directory, pattern.format(complaint=INVALID_FILENAME_CHARS.sub('_', complaint),
+                                                  differential=INVALID_FILENAME_CHARS.sub('_', differential),
+                                                  attempt=attempt))
+
+
+class ArtefactStore:
+    """Thread-safe content-addressed blob store with an (kind, complaint, differential, attempt) index."""
+
+    def __init__(self, root, compression="gzip", segment_size=DEFAULT_SEGMENT_SIZE):
+        self.root = root
+        self.segment_dir = os.path.join(root, "segments")
+        self.objects_path = os.path.join(root, "objects.jsonl")
+        self.index_path = os.path.join(root, "index.jsonl")
+        self.segment_size = segment_size
+        if compression == "zstd":
+            try:
+                _zstd_codec()
+            except ImportError:
+                print("⚠️ zstd compression needs the 'zstandard' package; using gzip for the artefact store")
+                compression = "gzip"
+        self.compression = compression
+        self._compress = _codec(compression)[0]
+        self._lock = threading.Lock()
+        self._objects = {}
+        self._entries = {}
+        self._segment_file = None
+        self._segment_number = 0
+        self._objects_file = None
+        self._index_file = None
+        for record in _read_journal(self.objects_path):
+            self._objects[record["hash"]] = record
+        missing = 0
+        for record in _read_journal(self.index_path):
+            # An entry written after its blob's objects.jsonl record was lost cannot be read back.
+            if any(blob_hash not in self._objects for blob_hash in record["hashes"]):
+                missing += 1
+                continue
+            self._entries[self._key(record["kind"], record["complaint"], record["differential"], record["attempt"])] = record
+        if missing:
+            logger.warning(f"⚠️ Ignoring {missing} entries in {self.index_path} that refer to unknown blobs",
+                           extra={"path": self.index_path, "entries": missing})
+        segments = sorted(glob.glob(os.path.join(self.segment_dir, "segment-*.pack")))
+        if segments:
+            self._segment_number = int(os.path.basename(segments[-1])[len("segment-"):-len(".pack")])
+
+    @staticmethod
+    def is_store(path):
+        return os.path.exists(os.path.join(path, "index.jsonl"))
+
+    @staticmethod
+    def _key(kind, complaint, differential, attempt):
+        return (kind, complaint, differential, int(attempt))
+
+    def __len__(self):
+        return len(self._entries)
+
+    # --- Writing ---
+
+    def _segment_path(self, number):
+        return os.path.join(self.segment_dir, f"segment-{number:06d}.pack")
+
+    def _open_files(self):
+        if self._objects_file is None:
+            os.makedirs(self.segment_dir, exist_ok=True)
+            # Appending after a torn final line would corrupt the next record too.
+            truncate_torn_line(self.objects_path)
+            truncate_torn_line(self.index_path)
+            self._objects_file = open(self.objects_path, 'a', encoding='utf-8')
+            self._index_file = open(self.index_path, 'a', encoding='utf-8')
+        if self._segment_file is not None and self._segment_file.tell() >= self.segment_size:
+            self._segment_file.close()
+            self._segment_file = None
+            self._segment_number += 1
+        if self._segment_file is None:
+            self._segment_number = max(self._segment_number, 1)
+            self._segment_file = open(self._segment_path(self._segment_number), 'ab')
+
+    def _put_blob(self, data):
+        """Store bytes once and return their hash. Caller holds the lock."""
+        blob_hash = hashlib.sha256(data).hexdigest()
+        if blob_hash in self._objects:
+            return blob_hash
+        self._open_files()
+        compressed = self._compress(data)
+        offset = self._segment_file.tell()
+        self._segment_file.write(compressed)
+        self._segment_file.flush()
+        record = {"hash": blob_hash, "segment": self._segment_number, "offset": offset,
+                  "length": len(compressed), "size": len(data), "codec": self.compression}
+        self._objects_file.write(json.dumps(record) + "\n")
+        self._objects_file.flush()
+        self._objects[blob_hash] = record
+        return blob_hash
+
+    def put(self, kind, complaint, differential, attempt, *parts):
+        """
+        Store an artefact made of one or more text parts (concatenated on read).
+
+        Returns a short reference like "store:raw_response/<hash prefix>" for log messages.
+        """
+        with self._lock:
+            hashes = [self._put_blob(part.encode('utf-8')) for part in parts]
+            record = {"kind": kind, "complaint": complaint, "differential": differential, "attempt": int(attempt),
+                      "hashes": hashes, "timestamp": time.time()}
+            self._open_files()
+            self._index_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._index_file.flush()
+            self._entries[self._key(kind, complaint, differential, attempt)] = record
+        return f"store:{kind}/{hashes[-1][:12] if hashes else 'empty'}"
+
+    def close(self):
+        with self._lock:
+            for f in (self._segment_file, self._objects_file, self._index_file):
+                if f is not None:
+                    f.close()
+            self._segment_file = self._objects_file = self._index_file = None
+
+    # --- Reading ---
+
+    def read_blob(self, blob_hash):
+        record = self._objects[blob_hash]
+        with open(self._segment_path(record["segment"]), 'rb') as f:
+            f.seek(record["offset"])
+            data = f.read(record["length"])
+        return _codec(record["codec"])[1](data)
+
+    def read_entry(self, entry):
+        return b"".join(self.read_blob(blob_hash) for blob_hash in entry["hashes"]).decode('utf-8')
+
+    def get(self, kind, complaint, differential, attempt):
+        """Return the text stored for an entry, or None."""
+        entry = self._entries.get(self._key(kind, complaint, differential, attempt))
+        return None if entry is None else self.read_entry(entry)
+
+    def entries(self, kind=None, complaint=None, differential=None):
+        """Index records, optionally filtered, in (kind, complaint, differential, attempt) order."""
+        for key in sorted(self._entries):
+            entry = self._entries[key]
+            if kind is not None and entry["kind"] != kind:
+                continue
+            if complaint is not None and entry["complaint"] != complaint:
+                continue
+            if differential is not None and entry["differential"] != differential:
+                continue
+            yield entry
+
+    def stats(self):
+        referenced = sum(self._objects[h]["size"] for entry in self._entries.values() for h in entry["hashes"]
+                         if h in self._objects)
+        kinds = {}
+        for entry in self._entries.values():
+            kinds[entry["kind"]] = kinds.get(entry["kind"], 0) + 1
+        segment_files = glob.glob(os.path.join(self.segment_dir, "segment-*.pack"))
+        return {
+            "entries": len(self._entries),
+            "entries_by_kind": kinds,
+            "blobs": len(self._objects),
+            "logical_bytes": referenced,
+            "unique_bytes": sum(record["size"] for record in self._objects.values()),
+            "stored_bytes": sum(record["length"] for record in self._objects.values()),
+            "segments": len(segment_files),
+        }
+
+    def extract(self, output_dir, kind=None, complaint=None):
+        """Write entries back out in the old one-file-per-attempt layout. Returns the number written."""
+        count = 0
+        for entry in self.entries(kind, complaint):
+            path = os.path.join(output_dir, legacy_filename(entry["kind"], entry["complaint"], entry["differential"],
+                                                            entry["attempt"]))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self.read_entry(entry))
+            count += 1
+        return count
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_artefact_store(output_dir="artefacts", compression="gzip"):
+    """Return the shared ArtefactStore for an output directory (artefacts/store)."""
+    root = os.path.join(output_dir, DEFAULT_STORE_DIRNAME)
+    with _stores_lock:
+        if root not in _stores:
+            _stores[root] = ArtefactStore(root, compression)
+        return _stores[root]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and extract entries from the artefact store")
+    parser.add_argument("--store", default=os.path.join("artefacts", DEFAULT_STORE_DIRNAME),
+                        help="Store directory (default: artefacts/store).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Show entry, blob and size totals.")
+    list_parser = subparsers.add_parser("list", help="List index entries.")
+    extract_parser = subparsers.add_parser("extract", help="Write entries out in the old per-file layout.")
+    for sub in (list_parser, extract_parser):
+        sub.add_argument("--kind", choices=sorted(LEGACY_LAYOUT))
+        sub.add_argument("--complaint")
+    extract_parser.add_argument("--out", default="artefacts",
+                                help="Directory to extract into; kinds go to their old subdirectories (default: artefacts).")
+    cat_parser = subparsers.add_parser("cat", help="Print one entry.")
+    cat_parser.add_argument("kind", choices=sorted(LEGACY_LAYOUT))
+    cat_parser.add_argument("complaint")
+    cat_parser.add_argument("differential")
+    cat_parser.add_argument("attempt", type=int)
+    args = parser.parse_args()
+
+    if not ArtefactStore.is_store(args.store):
+        print(f"❌ No artefact store found at {args.store}")
+        exit(1)
+    store = ArtefactStore(args.store)
+    if args.command == "stats":
+        stats = store.stats()
+        print(f"📦 {stats['entries']} entries ({', '.join(f'{k}: {v}' for k, v in sorted(stats['entries_by_kind'].items()))})")
+        print(f"   {stats['blobs']} unique blobs in {stats['segments']} segments")
+        print(f"   {stats['logical_bytes']} bytes referenced, {stats['unique_bytes']} after de-duplication, "
+              f"{stats['stored_bytes']} stored compressed")
+    elif args.command == "list":
+        for entry in store.entries(args.kind, args.complaint):
+            print(f"{entry['kind']}\t{entry['complaint']}\t{entry['differential']}\t{entry['attempt']}")
+    elif args.command == "cat":
+        text = store.get(args.kind, args.complaint, args.differential, args.attempt)
+        if text is None:
+            print("❌ No such entry")
+            exit(1)
+        print(text, end="")
+    elif args.command == "extract":
+        count = store.extract(args.out, args.kind, args.complaint)
+        print(f"✅ Extracted {count} entries to {args.out}")
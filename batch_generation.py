@@ -0,0 +1,229 @@
+"""
+Batch-prediction mode for full regenerations.
+
+Instead of one interactive model call per differential, every
+(complaint, differential) prompt is written to a JSONL request file in the
+Vertex AI Gemini batch format:
+
+    {"request": {"contents": [{"role": "user", "parts": [{"text": "..."}]}], "generationConfig": {...}}}
+
+The file is submitted through a batch submitter, and the result file is
+ingested through the normal cleaning/validation path
+(main_generation.process_response_text). Results are matched back to their
+jobs by a hash of the prompt text, so the output order of the batch service
+does not matter.
+
+- VertexBatchSubmitter: uploads the request file to Cloud Storage, runs a
+  BatchPredictionJob and downloads the predictions.
+- LocalBatchSubmitter: a file-based stand-in that answers every request with
+  a local model backend (e.g. the stub) and writes a result file in the same
+  format, for testing the batch path offline.
+"""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from failure_ledger import REASON_BATCH_ERROR
+from prompts import build_prompt
+
+BATCH_REQUESTS_FILENAME = "batch_requests.jsonl"
+BATCH_RESULTS_FILENAME = "batch_results.jsonl"
+
+# generation_config keys as used by the SDK -> field names used by the batch REST format.
+GENERATION_CONFIG_FIELDS = {
+    "temperature": "temperature",
+    "max_output_tokens": "maxOutputTokens",
+    "top_k": "topK",
+    "top_p": "topP",
+    "candidate_count": "candidateCount",
+    "response_mime_type": "responseMimeType",
+    "response_schema": "responseSchema",
+}
+
+
+def request_key(prompt_text):
+    """Stable key identifying a request by its prompt text."""
+    return hashlib.sha1(prompt_text.encode('utf-8')).hexdigest()
+
+
+def request_prompt_text(request):
+    """Return the concatenated text parts of a batch request."""
+    return "".join(
+        part.get("text", "")
+        for content in request.get("contents", [])
+        for part in content.get("parts", [])
+    )
+
+
+def write_batch_requests(jobs, requests_path, generation_config, compact_prompt=False):
+    """
+    Write one batch request per (complaint, differential) job.
+
+    Returns a dict mapping request_key -> job.
+    """
+    batch_config = {
+        GENERATION_CONFIG_FIELDS.get(key, key): value for key, value in generation_config.items()
+    }
+    keys = {}
+    os.makedirs(os.path.dirname(requests_path) or ".", exist_ok=True)
+    with open(requests_path, 'w', encoding='utf-8') as f:
+        for complaint, differential in jobs:
+            prompt_text = build_prompt(differential, complaint, compact_prompt)
+            keys[request_key(prompt_text)] = (complaint, differential)
+            request = {
+                "contents": [{"role": "user", "parts": [{"text": prompt_text}]}],
+                "generationConfig": batch_config,
+            }
+            f.write(json.dumps({"request": request}, ensure_ascii=False) + "\n")
+    print(f"📝 Wrote {len(keys)} batch requests to {requests_path}")
+    return keys
+
+
+def read_batch_results(results_path):
+    """
+    Read a batch result file.
+
+    Returns a dict mapping request_key -> (response_text or None, error message or None).
+    """
+    results = {}
+    with open(results_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"❌ Unreadable batch result on line {line_number} of {results_path}: {str(e)}")
+                continue
+            key = request_key(request_prompt_text(record.get("request", {})))
+            error = record.get("status") or None
+            candidates = (record.get("response") or {}).get("candidates") or []
+            text = None
+            if candidates:
+                parts = (candidates[0].get("content") or {}).get("parts") or []
+                text = "".join(part.get("text", "") for part in parts) or None
+            if text is None and error is None:
+                error = "empty response"
+            results[key] = (text, error)
+    return results
+
+
+def build_result_record(request, response_text=None, error=None):
+    """Build a result line in the Vertex batch output format."""
+    record = {"request": request, "status": error or ""}
+    if error is None:
+        record["response"] = {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": response_text}]}, "finishReason": "STOP"}]
+        }
+    return record
+
+
+class LocalBatchSubmitter:
+    """File-based stand-in for a batch-prediction service, answering requests with a local model."""
+
+    def __init__(self, model, concurrency=1):
+        self.model = model
+        self.concurrency = max(1, concurrency)
+
+    def _answer(self, request):
+        generation_config = {
+            sdk_key: request.get("generationConfig", {})[batch_key]
+            for sdk_key, batch_key in GENERATION_CONFIG_FIELDS.items()
+            if batch_key in request.get("generationConfig", {})
+        }
+        try:
+            response = self.model.generate_content(request_prompt_text(request), generation_config=generation_config)
+            return build_result_record(request, response_text=response.text)
+        except Exception as e:
+            return build_result_record(request, error=f"{type(e).__name__}: {str(e)}")
+
+    def submit(self, requests_path, results_path):
+        with open(requests_path, 'r', encoding='utf-8') as f:
+            requests = [json.loads(line)["request"] for line in f if line.strip()]
+        print(f"🚚 Running {len(requests)} batch requests locally")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            records = list(executor.map(self._answer, requests))
+        with open(results_path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return results_path
+
+
+class VertexBatchSubmitter:
+    """Submit the request file as a Vertex AI BatchPredictionJob via Cloud Storage."""
+
+    def __init__(self, gcs_prefix, model_id, poll_seconds=60):
+        if not gcs_prefix.startswith("gs://"):
+            raise ValueError(f"Batch mode needs a gs:// prefix for Vertex AI, got '{gcs_prefix}'")
+        self.gcs_prefix = gcs_prefix.rstrip("/")
+        self.model_id = model_id
+        self.poll_seconds = poll_seconds
+
+    def submit(self, requests_path, results_path):
+        # Imported here so the Cloud SDKs are only needed for real batch runs.
+        from google.cloud import storage
+        from vertexai.batch_prediction import BatchPredictionJob
+
+        client = storage.Client()
+        run_prefix = f"{self.gcs_prefix}/{time.strftime('%Y%m%d-%H%M%S')}"
+        bucket_name, _, blob_prefix = run_prefix[len("gs://"):].partition("/")
+        bucket = client.bucket(bucket_name)
+        input_blob = f"{blob_prefix}/{os.path.basename(requests_path)}".lstrip("/")
+        bucket.blob(input_blob).upload_from_filename(requests_path)
+        print(f"☁️ Uploaded batch requests to gs://{bucket_name}/{input_blob}")
+
+        job = BatchPredictionJob.submit(
+            source_model=self.model_id,
+            input_dataset=f"gs://{bucket_name}/{input_blob}",
+            output_uri_prefix=f"{run_prefix}/output",
+        )
+        print(f"🚚 Submitted batch prediction job {job.resource_name}")
+        while not job.has_ended:
+            time.sleep(self.poll_seconds)
+            job.refresh()
+            print(f"  ⏳ Batch job state: {job.state.name}")
+        if not job.has_succeeded:
+            raise RuntimeError(f"Batch prediction job failed: {job.error}")
+
+        # Predictions are written as one or more predictions*.jsonl files under output_location.
+        _, _, output_blob_prefix = job.output_location[len("gs://"):].partition("/")
+        with open(results_path, 'w', encoding='utf-8') as f:
+            for blob in client.list_blobs(bucket_name, prefix=output_blob_prefix):
+                if blob.name.endswith(".jsonl"):
+                    f.write(blob.download_as_text(encoding='utf-8').rstrip("\n") + "\n")
+        print(f"📥 Downloaded batch results to {results_path}")
+        return results_path
+
+
+def run_batch_jobs(jobs, submitter, process_response, output_dir, generation_config, compact_prompt=False):
+    """
+    Generate all jobs through one batch submission and yield (job, result) in job order.
+
+    `process_response(complaint, differential, response_text)` must return the
+    same dict as main_generation.process_response_text. Each result also gets
+    "attempts" (always 1); failed requests get a "failure" with REASON_BATCH_ERROR.
+    """
+    jobs = list(jobs)
+    batch_dir = os.path.join(output_dir, "batch")
+    requests_path = os.path.join(batch_dir, BATCH_REQUESTS_FILENAME)
+    results_path = os.path.join(batch_dir, BATCH_RESULTS_FILENAME)
+    keys = write_batch_requests(jobs, requests_path, generation_config, compact_prompt)
+    if not keys:
+        return
+    submitter.submit(requests_path, results_path)
+    batch_results = read_batch_results(results_path)
+    print(f"📥 Ingesting {len(batch_results)} batch results from {results_path}")
+
+    job_keys = {job: key for key, job in keys.items()}
+    for complaint, differential in jobs:
+        response_text, error = batch_results.get(job_keys[(complaint, differential)], (None, "missing from batch output"))
+        if response_text is not None:
+            result = process_response(complaint, differential, response_text)
+        else:
+            print(f"❌ Batch request failed for {complaint} - {differential}: {error}")
+            result = {"case": None, "output_path": None, "failure": {"reason": REASON_BATCH_ERROR, "detail": error}}
+        result["attempts"] = 1
+        yield (complaint, differential), result
@@ -0,0 +1,368 @@
+"""
+Compiled schema for generated OSCE cases.
+
+CASE_SCHEMA describes the whole "case" object the prompt asks for. It is
+compiled once, at import, into a tree of small checker functions, so
+validating a case is a single walk over it with no schema interpretation per
+call. Every violation is reported with its path, e.g.
+
+    case.OSCE_Examination.Patient_Actor.Symptoms.Secondary_Symptoms: expected at least 1 item, found 0
+
+Schema nodes are dicts:
+    {"type": "string", "min_length": 1}
+    {"type": "array", "items": <node>, "min_items": 1}
+    {"type": "object", "required": {key: <node>}, "optional": {key: <node>},
+     "additional": <node> or None (any value), "min_properties": 0}
+    {"type": "finding"}: free-form examination/test findings: a non-empty
+        string, a number, a list of findings or an object of findings.
+
+structured_output_config() turns on JSON-mode generation, optionally with a
+response schema derived from CASE_SCHEMA (see response_schema()).
+
+Run as a script to check existing output files:
+
+    python case_schema.py                      # artefacts/*_all_cases.jsonl
+    python case_schema.py artefacts/Headache_all_cases.jsonl --max-errors 5
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from functools import lru_cache
+
+NON_EMPTY_STRING = {"type": "string", "min_length": 1}
+FINDING = {"type": "finding"}
+FINDINGS = {"type": "object", "additional": FINDING, "min_properties": 1}
+
+CASE_SCHEMA = {
+    "type": "object",
+    "required": {
+        "OSCE_Examination": {
+            "type": "object",
+            "required": {
+                "Patient_Actor": {
+                    "type": "object",
+                    "required": {
+                        "Demographics": NON_EMPTY_STRING,
+                        "History": NON_EMPTY_STRING,
+                        "Symptoms": {
+                            "type": "object",
+                            "required": {
+                                "Primary_Symptom": NON_EMPTY_STRING,
+                                "Secondary_Symptoms": {"type": "array", "items": NON_EMPTY_STRING, "min_items": 1},
+                            },
+                        },
+                        "Past_Medical_History": NON_EMPTY_STRING,
+                        "Social_History": NON_EMPTY_STRING,
+                        "Review_of_Systems": NON_EMPTY_STRING,
+                    },
+                    # e.g. "Medications" in some exemplars
+                    "additional": FINDING,
+                },
+                "Physical_Examination_Findings": FINDINGS,
+                "Test_Results": FINDINGS,
+                "Correct_Diagnosis": NON_EMPTY_STRING,
+            },
+        },
+    },
+    # Output files carry the diagnosis category as "tag".
+    "optional": {"tag": NON_EMPTY_STRING},
+}
+
+TYPE_NAMES = {dict: "object", list: "array", str: "string", int: "number", float: "number", bool: "boolean",
+              type(None): "null"}
+
+
+def _type_name(value):
+    return TYPE_NAMES.get(type(value), type(value).__name__)
+
+
+def _compile_string(node):
+    min_length = node.get("min_length", 0)
+
+    def check(value, path, errors):
+        if not isinstance(value, str):
+            errors.append(f"{path}: expected a string, found {_type_name(value)}")
+        elif len(value.strip()) < min_length:
+            errors.append(f"{path}: expected a non-empty string")
+    return check
+
+
+def _compile_array(node):
+    check_item = compile_schema(node["items"]) if node.get("items") else None
+    min_items = node.get("min_items", 0)
+
+    def check(value, path, errors):
+        if not isinstance(value, list):
+            errors.append(f"{path}: expected an array, found {_type_name(value)}")
+            return
+        if len(value) < min_items:
+            errors.append(f"{path}: expected at least {min_items} item{'s' if min_items != 1 else ''}, found {len(value)}")
+        if check_item is not None:
+            for index, item in enumerate(value):
+                check_item(item, f"{path}[{index}]", errors)
+    return check
+
+
+def _compile_object(node):
+    required = [(key, compile_schema(child)) for key, child in node.get("required", {}).items()]
+    optional = {key: compile_schema(child) for key, child in node.get("optional", {}).items()}
+    known = {key for key, _ in required} | set(optional)
+    check_additional = compile_schema(node["additional"]) if node.get("additional") else None
+    min_properties = node.get("min_properties", 0)
+
+    def check(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append(f"{path}: expected an object, found {_type_name(value)}")
+            return
+        if len(value) < min_properties:
+            errors.append(f"{path}: expected at least {min_properties} field{'s' if min_properties != 1 else ''}, found {len(value)}")
+        present = 0
+        for key, check_child in required:
+            if key in value:
+                present += 1
+                check_child(value[key], f"{path}.{key}", errors)
+            else:
+                errors.append(f"{path}.{key}: missing required key")
+        if len(value) == present:
+            return  # No optional or additional keys to check.
+        for key, child_value in value.items():
+            if key in known:
+                if key in optional:
+                    optional[key](child_value, f"{path}.{key}", errors)
+            elif check_additional is not None:
+                check_additional(child_value, f"{path}.{key}", errors)
+    return check
+
+
+def _check_finding(value, path, errors):
+    if isinstance(value, str):
+        if not value.strip():
+            errors.append(f"{path}: expected a non-empty string")
+    elif isinstance(value, dict):
+        if not value:
+            errors.append(f"{path}: expected a non-empty object")
+        for key, child_value in value.items():
+            _check_finding(child_value, f"{path}.{key}", errors)
+    elif isinstance(value, list):
+        if not value:
+            errors.append(f"{path}: expected a non-empty array")
+        for index, item in enumerate(value):
+            _check_finding(item, f"{path}[{index}]", errors)
+    elif isinstance(value, bool) or not isinstance(value, (int, float)):
+        errors.append(f"{path}: expected a finding (string, number, array or object), found {_type_name(value)}")
+
+
+_COMPILERS = {
+    "string": _compile_string,
+    "array": _compile_array,
+    "object": _compile_object,
+    "finding": lambda node: _check_finding,
+}
+
+
+def compile_schema(node):
+    """Compile a schema node into a checker function check(value, path, errors)."""
+    compiler = _COMPILERS.get(node.get("type"))
+    if compiler is None:
+        raise ValueError(f"Unknown schema node type: {node.get('type')!r}")
+    return compiler(node)
+
+
+_check_case = compile_schema(CASE_SCHEMA)
+
+
+def validate_case(case_content, base_path_name="case"):
+    """Return the list of schema violations ("path: problem") for a case object; empty if valid."""
+    errors = []
+    _check_case(case_content, base_path_name, errors)
+    return errors
+
+
+def validate_specific_key_nesting(data_dict, base_path_name="case"):
+    """
+    Validate the content of the "case" key against CASE_SCHEMA.
+
+    Returns (passed, message); on failure the message lists every violation.
+    """
+    errors = validate_case(data_dict, base_path_name)
+    if errors:
+        return False, f"Validation Error: {len(errors)} problem{'s' if len(errors) != 1 else ''}: " + "; ".join(errors)
+    return True, f"Case structure validated successfully ({base_path_name}.OSCE_Examination and all nested fields)."
+
+
+# --- Structured output ---
+#
+# Vertex AI response schemas use an OpenAPI subset with no free-form maps, so
+# the "finding" sections are given the section names the prompt exemplars use,
+# all optional, plus a catch-all "Other_Findings" string. The schema must be
+# no looser than validate_specific_key_nesting(), or a conforming response can
+# still be rejected: non-empty strings get min_length, arrays min_items and
+# findings objects min_properties. (Snake-case field names are accepted both
+# by the SDK and, as proto field names, by the batch REST format.)
+
+OTHER_FINDINGS_KEY = "Other_Findings"
+
+
+def _exemplar_cases():
+    """The case objects from the prompt exemplars."""
+    from prompts import example_json_format
+
+    decoder = json.JSONDecoder()
+    cases = []
+    position = example_json_format.find('{')
+    while position != -1:
+        try:
+            value, end = decoder.raw_decode(example_json_format, position)
+        except json.JSONDecodeError:
+            end = position + 1
+        else:
+            if isinstance(value, dict):
+                cases.append(value.get("case", value))
+        position = example_json_format.find('{', end)
+    return cases
+
+
+def _schema_from_examples(examples):
+    """Response schema for the shape shared by example values (objects merge their keys)."""
+    if examples and all(isinstance(example, dict) for example in examples):
+        properties = {}
+        for example in examples:
+            for key in example:
+                if key not in properties:
+                    properties[key] = _schema_from_examples([e[key] for e in examples if key in e])
+        # Findings are never empty (see _check_finding).
+        return {"type": "OBJECT", "properties": properties, "min_properties": 1}
+    if examples and all(isinstance(example, list) for example in examples):
+        return {"type": "ARRAY", "items": _schema_from_examples([item for example in examples for item in example]),
+                "min_items": 1}
+    return {"type": "STRING", "min_length": 1}
+
+
+def _to_response_schema(node, examples):
+    node_type = node["type"]
+    if node_type == "string":
+        schema = {"type": "STRING"}
+        if node.get("min_length"):
+            schema["min_length"] = node["min_length"]
+        return schema
+    if node_type == "array":
+        items = [item for example in examples if isinstance(example, list) for item in example]
+        schema = {"type": "ARRAY", "items": _to_response_schema(node["items"], items)}
+        if node.get("min_items"):
+            schema["min_items"] = node["min_items"]
+        return schema
+    if node_type == "finding":
+        return _schema_from_examples(examples)
+    examples = [example for example in examples if isinstance(example, dict)]
+    properties = {}
+    for key, child in list(node.get("required", {}).items()) + list(node.get("optional", {}).items()):
+        if key != "tag":  # added by the scripts, not the model
+            properties[key] = _to_response_schema(child, [example[key] for example in examples if key in example])
+    if node.get("additional"):
+        for example in examples:
+            for key in example:
+                if key not in properties:
+                    properties[key] = _to_response_schema(node["additional"],
+                                                          [e[key] for e in examples if key in e])
+        if not node.get("required"):
+            properties[OTHER_FINDINGS_KEY] = {"type": "STRING", "min_length": 1}
+    schema = {"type": "OBJECT", "properties": properties}
+    if node.get("required"):
+        schema["required"] = list(node["required"])
+    if node.get("min_properties"):
+        schema["min_properties"] = node["min_properties"]
+    return schema
+
+
+@lru_cache(maxsize=None)
+def _response_schema_json():
+    case_schema = _to_response_schema(CASE_SCHEMA, _exemplar_cases())
+    return json.dumps({
+        "type": "OBJECT",
+        "properties": {"Presenting complaint": {"type": "STRING", "min_length": 1}, "case": case_schema},
+        "required": ["Presenting complaint", "case"],
+    })
+
+
+def response_schema():
+    """Response schema for a whole model response, derived from CASE_SCHEMA and the prompt exemplars."""
+    return json.loads(_response_schema_json())
+
+
+def structured_output_config(generation_config, json_mode=False, use_response_schema=False):
+    """
+    Return a copy of generation_config asking for JSON-only output, and with
+    use_response_schema also constrained to response_schema().
+    """
+    generation_config = dict(generation_config)
+    if json_mode or use_response_schema:
+        generation_config["response_mime_type"] = "application/json"
+    if use_response_schema:
+        generation_config["response_schema"] = response_schema()
+    return generation_config
+
+
+def generation_mode_name(json_mode=False, use_response_schema=False):
+    """Label recorded with each job so attempts per case can be compared between modes."""
+    if use_response_schema:
+        return "response-schema"
+    return "json" if json_mode else "text"
+
+
+def check_files(paths, max_errors_per_file=10):
+    """Validate every case in the given JSONL files and print a report. Returns the number of invalid cases."""
+    total_cases = invalid_cases = 0
+    problem_counts = {}
+    started = time.perf_counter()
+    for path in paths:
+        file_cases = file_invalid = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                file_cases += 1
+                try:
+                    case_content = json.loads(line)
+                except json.JSONDecodeError as e:
+                    errors = [f"line is not valid JSON: {str(e)}"]
+                else:
+                    errors = validate_case(case_content)
+                if not errors:
+                    continue
+                file_invalid += 1
+                for error in errors:
+                    # Group problems by path without array indices, e.g. "case.X.Secondary_Symptoms[]".
+                    problem_key = re.sub(r"\[\d+\]", "[]", error)
+                    problem_counts[problem_key] = problem_counts.get(problem_key, 0) + 1
+                if file_invalid <= max_errors_per_file:
+                    print(f"  ❌ {path}:{line_number}")
+                    for error in errors:
+                        print(f"      {error}")
+        total_cases += file_cases
+        invalid_cases += file_invalid
+        status = "✅" if not file_invalid else "⚠️"
+        print(f"{status} {path}: {file_cases - file_invalid}/{file_cases} cases valid")
+    elapsed = time.perf_counter() - started
+    rate = total_cases / elapsed if elapsed else 0.0
+    print(f"\n📊 Checked {total_cases} cases in {len(paths)} files: {invalid_cases} invalid ({rate:.0f} cases/s)")
+    for key, count in sorted(problem_counts.items(), key=lambda item: -item[1]):
+        print(f"  {count:6d}  {key}")
+    return invalid_cases
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate generated cases in *_all_cases.jsonl files against the OSCE case schema")
+    parser.add_argument("paths", nargs="*",
+                        help="JSONL files to check (default: artefacts/*_all_cases.jsonl).")
+    parser.add_argument("--max-errors", type=int, default=10,
+                        help="Invalid cases to print in detail per file (default: 10).")
+    args = parser.parse_args()
+    paths = args.paths or sorted(glob.glob(os.path.join("artefacts", "*_all_cases.jsonl")))
+    if not paths:
+        print("⚠️ No *_all_cases.jsonl files found")
+        exit(1)
+    exit(1 if check_files(paths, args.max_errors) else 0)
@@ -0,0 +1,141 @@
+"""
+Streaming JSONL writers for generated cases.
+
+Cases are appended to artefacts/all_cases.jsonl and their complaint's
+artefacts/<complaint>_all_cases.jsonl as soon as they validate, instead of
+being accumulated in memory and written at the end of the run. Every line is
+flushed and fsynced after it is written (a line-level journal), so a crash
+keeps every case written so far and memory use does not grow with the corpus.
+"""
+
+import os
+import threading
+
+import jsonlines
+
+
+class JsonlAppendWriter:
+    """
+    JSONL writer that makes each line durable before returning.
+
+    The file is opened lazily on the first write, so a writer that never
+    receives a record leaves any existing file untouched. With mode='a',
+    a torn final line left by an interrupted write is truncated first.
+    """
+
+    def __init__(self, path, mode='w', fsync=True):
+        self.path = path
+        self.mode = mode
+        self.fsync = fsync
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.mode == 'a':
+            truncate_torn_line(self.path)
+        self._file = open(self.path, self.mode, encoding='utf-8')
+        self._writer = jsonlines.Writer(self._file, flush=True)
+
+    def write(self, obj):
+        if self._writer is None:
+            self._open()
+        self._writer.write(obj)
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.count += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._file.close()
+            self._writer = None
+            self._file = None
+
+
+def truncate_torn_line(path):
+    """Drop a trailing partial line (no final newline) left by an interrupted append."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        # Scan back to the last complete line.
+        position = size - 1
+        chunk_size = 4096
+        while position > 0:
+            start = max(0, position - chunk_size)
+            f.seek(start)
+            chunk = f.read(position - start)
+            newline_index = chunk.rfind(b"\n")
+            if newline_index != -1:
+                f.truncate(start + newline_index + 1)
+                return
+            position = start
+        f.truncate(0)
+
+
+class CaseSink:
+    """
+    Streams validated cases to the global and per-complaint *_all_cases.jsonl files.
+
+    Open per-complaint writers are indexed by complaint, so cases for several
+    complaints may interleave and finishing a complaint only touches that
+    complaint's file. With mode='w' the files are rewritten per run (as the
+    end-of-run writes used to do); mode='a' appends to existing files. Files
+    are only created once a case arrives. Set global_filename=None to skip
+    the global file. Methods are safe to call from several worker threads.
+    """
+
+    def __init__(self, output_dir, complaint_filename, mode='w', global_filename="all_cases.jsonl", fsync=True):
+        self.output_dir = output_dir
+        self.complaint_filename = complaint_filename
+        self.mode = mode
+        self.fsync = fsync
+        self.global_writer = None
+        if global_filename:
+            self.global_writer = JsonlAppendWriter(os.path.join(output_dir, global_filename), mode, fsync)
+        self.complaint_writers = {}
+        self.case_counts = {}
+        self._lock = threading.Lock()
+
+    @property
+    def total_cases(self):
+        return sum(self.case_counts.values())
+
+    def complaint_path(self, complaint):
+        return os.path.join(self.output_dir, self.complaint_filename(complaint))
+
+    def write(self, complaint, case_content):
+        with self._lock:
+            writer = self.complaint_writers.get(complaint)
+            if writer is None:
+                writer = JsonlAppendWriter(self.complaint_path(complaint), self.mode, self.fsync)
+                self.complaint_writers[complaint] = writer
+            writer.write(case_content)
+            if self.global_writer is not None:
+                self.global_writer.write(case_content)
+            self.case_counts[complaint] = self.case_counts.get(complaint, 0) + 1
+
+    def finish_complaint(self, complaint):
+        """Close a complaint's file and return how many cases it received in this run."""
+        with self._lock:
+            writer = self.complaint_writers.pop(complaint, None)
+            if writer is not None:
+                writer.close()
+            return self.case_counts.get(complaint, 0)
+
+    def close(self):
+        for complaint in list(self.complaint_writers):
+            self.finish_complaint(complaint)
+        with self._lock:
+            if self.global_writer is not None:
+                self.global_writer.close()
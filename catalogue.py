@@ -0,0 +1,302 @@
+"""
+Indexed catalogue of presenting complaints and their differential diagnoses.
+
+tables_list/diagnoses.jsonl holds one {complaint: {category: [differential, ...]}}
+object per line. Catalogue parses it once and indexes it:
+
+- complaint -> unique differentials (file order) and differential -> category
+  (first category wins; "Masquerades" and "Patient trying to tell me
+  something" are excluded),
+- normalised complaint name -> complaint, e.g. the sanitised folder names
+  used under artefacts/,
+- normalised (and prefix-stripped) differential name -> differential, per complaint,
+- a substring index over complaint-name tokens for --complaints style matching.
+
+The name helpers shared by both scripts (sanitize_filename for artefact paths,
+normalize_differential_name and friends for matching) live here too.
+
+get_catalogue() returns one shared instance per file. The parsed index is
+pickled to the user cache directory ($XDG_CACHE_HOME or ~/.cache, under
+casegen/catalogue/) and reused while the file's mtime and size (or, if those
+changed, its sha1) still match. The cache is skipped with use_cache=False
+(--no-catalogue-cache in the generation scripts) or when the
+CASEGEN_NO_CATALOGUE_CACHE environment variable is set.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DIAGNOSES_PATH = os.path.join(SCRIPT_DIR, "tables_list", "diagnoses.jsonl")
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                         "casegen", "catalogue")
+# Set (to any non-empty value) to neither read nor write the pickled index.
+CACHE_DISABLE_ENV = "CASEGEN_NO_CATALOGUE_CACHE"
+# Bump when the pickled Catalogue layout changes.
+CACHE_VERSION = 2
+
+EXCLUDED_CATEGORIES = ("Masquerades", "Patient trying to tell me something")
+
+# Qualifiers some differentials carry in the source tables, e.g. "vascular: ruptured AAA".
+DIFFERENTIAL_PREFIXES = (
+    'vascular:', 'infection:', 'cancer:', 'other:', 'rarity:', 'pulmonary cause:',
+    'neoplasia/cancer:', 'pitfalls:', 'serious disorders:', 'probability diagnosis:',
+    'masquerades:', 'patient trying to tell me something:', 'pitfall:', 'serious disorder:'
+)
+
+TOKEN_SPLIT = re.compile(r'[^a-z0-9]+')
+
+
+def sanitize_filename(name):
+    """Replace invalid filename characters with underscores."""
+    # Replace characters that are invalid in filenames with underscores
+    # Windows specifically disallows: \ / : * ? " < > |
+    invalid_chars = r'[\\/:*?"<>|]'
+    return re.sub(invalid_chars, '_', name)
+
+
+def strip_prefix(differential):
+    """Remove a leading qualifier such as 'vascular:' from a differential name."""
+    d = differential.lower()
+    for prefix in DIFFERENTIAL_PREFIXES:
+        if d.startswith(prefix):
+            return differential[len(prefix):].strip()
+    return differential
+
+
+def strip_suffix(name):
+    # Remove (n) suffixes before .json
+    return re.sub(r'\s*\(\d+\)$', '', name)
+
+
+def normalize_differential_name(name):
+    # Lowercase, strip prefixes, replace spaces/underscores with single underscore, remove non-alphanumeric except underscores
+    name = strip_prefix(name)
+    name = name.lower()
+    name = re.sub(r'[\s_]+', '_', name)  # Replace spaces and underscores with single underscore
+    name = re.sub(r'[^a-z0-9_]', '', name)  # Remove all non-alphanumeric except underscore
+    name = re.sub(r'_+', '_', name)  # Collapse multiple underscores
+    return name.strip('_')
+
+
+def all_normalized_forms(name):
+    forms = set()
+    forms.add(normalize_differential_name(name))
+    forms.add(normalize_differential_name(strip_prefix(name)))
+    return forms
+
+
+def _tokens(text):
+    return [token for token in TOKEN_SPLIT.split(text.lower()) if token]
+
+
+def _substrings(token):
+    return {token[start:end] for start in range(len(token)) for end in range(start + 1, len(token) + 1)}
+
+
+class Catalogue:
+    """In-memory index over diagnoses.jsonl. Build with Catalogue.from_file() or get_catalogue()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.differentials_by_complaint = {}
+        self.categories_by_complaint = {}
+        self.complaint_by_normalized = {}
+        self.differential_by_normalized = {}
+        # Every substring of every complaint-name token -> complaints.
+        self.substring_index = {}
+        # Complaint -> position in the file, for ordering matches.
+        self.complaint_order = {}
+        # Problems found while parsing, printed whenever the catalogue is loaded.
+        self.warnings = []
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_DIAGNOSES_PATH):
+        catalogue = cls(path)
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    catalogue._add_line(json.loads(line), line_number)
+                except json.JSONDecodeError as e:
+                    catalogue.warnings.append(f"❌ Error decoding JSON on line {line_number} in {path}: {str(e)}")
+        return catalogue
+
+    def _add_line(self, data, line_number):
+        # Expecting a single key per JSON object, which is the complaint
+        if not isinstance(data, dict) or len(data) != 1:
+            self.warnings.append(f"❌ Unexpected JSON structure on line {line_number} in {self.path}. Expected single key (complaint name).")
+            return
+        complaint, diagnosis_categories = next(iter(data.items()))
+        if not isinstance(diagnosis_categories, dict):
+            self.warnings.append(f"❌ Unexpected structure for complaint '{complaint}' on line {line_number} in {self.path}. Expected dict of categories.")
+            return
+
+        differentials = []
+        categories = {}
+        normalized = {}
+        for category, diagnoses in diagnosis_categories.items():
+            if category in EXCLUDED_CATEGORIES or not isinstance(diagnoses, list):
+                continue
+            for differential in diagnoses:
+                # If a diagnosis appears in multiple categories, keep its first occurrence.
+                if not isinstance(differential, str) or differential in categories:
+                    continue
+                differentials.append(differential)
+                categories[differential] = category
+                for form in all_normalized_forms(differential):
+                    normalized.setdefault(form, differential)
+
+        self.complaint_by_normalized.setdefault(normalize_differential_name(complaint), complaint)
+        for token in set(_tokens(complaint)):
+            for substring in _substrings(token):
+                self.substring_index.setdefault(substring, set()).add(complaint)
+        if not differentials:
+            self.warnings.append(f"⚠️ No valid diagnoses found for '{complaint}' in {self.path} on line {line_number}")
+            return
+        self.complaint_order.setdefault(complaint, len(self.complaint_order))
+        self.differentials_by_complaint[complaint] = differentials
+        self.categories_by_complaint[complaint] = categories
+        self.differential_by_normalized[complaint] = normalized
+
+    def __len__(self):
+        return len(self.differentials_by_complaint)
+
+    @property
+    def differential_count(self):
+        return sum(len(differentials) for differentials in self.differentials_by_complaint.values())
+
+    def differentials(self, complaint):
+        return self.differentials_by_complaint.get(complaint, [])
+
+    def find_complaint(self, name):
+        """Return the complaint whose normalised name matches `name` (e.g. an artefacts folder name), or None."""
+        return self.complaint_by_normalized.get(normalize_differential_name(name))
+
+    def find_differential(self, complaint, name):
+        """Return the catalogue spelling of a differential given any of its normalised forms, or None."""
+        forms = self.differential_by_normalized.get(complaint, {})
+        for form in all_normalized_forms(name):
+            if form in forms:
+                return forms[form]
+        return None
+
+    def category(self, complaint, differential, default="Unknown"):
+        """Category of a differential, looked up by exact name or normalised form."""
+        categories = self.categories_by_complaint.get(complaint, {})
+        if differential in categories:
+            return categories[differential]
+        match = self.find_differential(complaint, differential)
+        return categories.get(match, default) if match is not None else default
+
+    def match_complaints(self, target):
+        """
+        Complaints whose name contains `target` (case-insensitive), in file order.
+
+        Every token of the target must occur inside a token of a matching
+        complaint, so candidates are the intersection of one substring-index
+        lookup per target token; only those are checked with a substring test.
+        A target with no tokens (e.g. punctuation only) falls back to a scan.
+        """
+        target_lower = target.lower()
+        candidates = None
+        for target_token in _tokens(target):
+            token_matches = self.substring_index.get(target_token, set())
+            candidates = token_matches if candidates is None else candidates & token_matches
+            if not candidates:
+                return []
+        if candidates is None:
+            candidates = self.differentials_by_complaint
+        return sorted(
+            (complaint for complaint in candidates
+             if complaint in self.complaint_order and target_lower in complaint.lower()),
+            key=self.complaint_order.get,
+        )
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _cache_path(path):
+    # Keyed by the absolute path too, so checkouts sharing a cache directory do not collide.
+    path_key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"{os.path.basename(path)}.{path_key}.pickle")
+
+
+def _load_cached(path):
+    """Return the pickled Catalogue for `path` if it is still current, else None."""
+    cache_path = _cache_path(path)
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        return None
+    if cached.get("version") != CACHE_VERSION:
+        return None
+    if cached.get("signature") == _file_signature(path):
+        return cached["catalogue"]
+    # Touched but possibly unchanged (e.g. a fresh checkout): fall back to the content hash.
+    if cached.get("sha1") == _file_hash(path):
+        _save_cache(path, cached["catalogue"], cached["sha1"])
+        return cached["catalogue"]
+    return None
+
+
+def _save_cache(path, catalogue, sha1=None):
+    cache_path = _cache_path(path)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump({"version": CACHE_VERSION, "signature": _file_signature(path),
+                         "sha1": sha1 or _file_hash(path), "catalogue": catalogue}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        # The cache is an optimisation; a read-only checkout still works.
+        print(f"⚠️ Could not write catalogue cache {cache_path}: {str(e)}")
+
+
+_catalogues = {}
+_catalogues_lock = threading.Lock()
+
+
+def get_catalogue(path=None, use_cache=True):
+    """
+    Return the shared Catalogue for a diagnoses file (default tables_list/diagnoses.jsonl).
+
+    With use_cache=False, or CASEGEN_NO_CATALOGUE_CACHE set, the file is
+    parsed without reading or writing the on-disk cache.
+    Raises FileNotFoundError if the file does not exist.
+    """
+    path = os.path.abspath(path or DEFAULT_DIAGNOSES_PATH)
+    use_cache = use_cache and not os.environ.get(CACHE_DISABLE_ENV)
+    with _catalogues_lock:
+        if path in _catalogues:
+            return _catalogues[path]
+        catalogue = _load_cached(path) if use_cache else None
+        source = "cache"
+        if catalogue is None:
+            catalogue = Catalogue.from_file(path)
+            source = "file"
+            if use_cache:
+                _save_cache(path, catalogue)
+        for warning in catalogue.warnings:
+            print(warning)
+        print(f"✅ Loaded {catalogue.differential_count} unique differentials for {len(catalogue)} complaints "
+              f"from {path}{' (cached index)' if source == 'cache' else ''}")
+        _catalogues[path] = catalogue
+        return catalogue
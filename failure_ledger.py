@@ -0,0 +1,178 @@
+"""
+Batched, de-duplicated failure logging for artefacts/<complaint>/failed_differentials.jsonl.
+
+Workers hand failures to FailureLedger.record() (a SimpleQueue put, so callers
+never take a lock or touch the file system). One background thread drains the
+queue, keeps the ledger of each touched complaint in memory keyed by
+differential, and every `flush_interval` seconds (or `batch_size` events)
+rewrites the changed files atomically. A differential therefore appears at
+most once per complaint, with its latest reason and attempt count:
+
+    {"differential": "Migraine", "reason": "validation_failed", "detail": "...", "attempts": 15, "timestamp": ...}
+
+Older ledgers hold one JSON string per line; read_failures() accepts both.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+from catalogue import sanitize_filename
+from run_logging import get_logger
+
+FAILED_DIFFERENTIALS_FILENAME = "failed_differentials.jsonl"
+
+# Why the last attempt for a differential failed.
+REASON_MODEL_ERROR = "model_error"
+REASON_EMPTY_RESPONSE = "empty_response"
+REASON_PARSE_ERROR = "parse_error"
+REASON_VALIDATION_FAILED = "validation_failed"
+REASON_MAX_TOKENS = "max_tokens"
+REASON_BATCH_ERROR = "batch_error"
+
+MAX_DETAIL_LENGTH = 300
+
+logger = get_logger("failure_ledger")
+
+_RECORD = "record"
+_RESOLVE = "resolve"
+_FLUSH = "flush"
+_STOP = "stop"
+
+
+def read_failures(path):
+    """
+    Read a failed_differentials.jsonl file into {differential: entry}, in file order.
+
+    Lines may be JSON strings (older ledgers) or entry objects; repeated
+    differentials keep their last entry. Unreadable lines are skipped.
+    """
+    failures = {}
+    if not os.path.exists(path):
+        return failures
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Hand-edited ledgers sometimes hold bare names.
+                entry = line.strip('"')
+            if isinstance(entry, str):
+                entry = {"differential": entry, "reason": None, "attempts": None}
+            if isinstance(entry, dict) and entry.get("differential"):
+                failures.pop(entry["differential"], None)
+                failures[entry["differential"]] = entry
+    return failures
+
+
+def write_failures(path, failures):
+    """Atomically replace a ledger file with the given entries."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        for entry in failures.values():
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    os.replace(temp_path, path)
+
+
+class FailureLedger:
+    """Per-complaint failed_differentials.jsonl files, written by a single background thread."""
+
+    def __init__(self, output_dir="artefacts", flush_interval=1.0, batch_size=64):
+        self.output_dir = output_dir
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        # Owned by the writer thread only.
+        self._ledgers = {}
+        self._dirty = set()
+        self.recorded = 0
+        self._thread = threading.Thread(target=self._run, name="failure-ledger", daemon=True)
+        self._thread.start()
+
+    def path(self, complaint):
+        return os.path.join(self.output_dir, sanitize_filename(complaint), FAILED_DIFFERENTIALS_FILENAME)
+
+    def record(self, complaint, differential, reason, attempts, detail=None):
+        """Log that a differential failed after `attempts` attempts; replaces any earlier entry for it."""
+        entry = {
+            "differential": differential,
+            "reason": reason,
+            "detail": str(detail)[:MAX_DETAIL_LENGTH] if detail is not None else None,
+            "attempts": attempts,
+            "timestamp": time.time(),
+        }
+        self._queue.put((_RECORD, complaint, entry))
+
+    def resolve(self, complaint, differential):
+        """Drop a differential from its complaint's ledger (it has since been generated)."""
+        self._queue.put((_RESOLVE, complaint, differential))
+
+    def flush(self):
+        """Block until every event queued so far is on disk."""
+        done = threading.Event()
+        self._queue.put((_FLUSH, None, done))
+        done.wait()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put((_STOP, None, None))
+            self._thread.join()
+
+    def _ledger(self, complaint):
+        path = self.path(complaint)
+        if path not in self._ledgers:
+            self._ledgers[path] = read_failures(path)
+        return path, self._ledgers[path]
+
+    def _apply(self, kind, complaint, payload):
+        if kind == _RECORD:
+            path, ledger = self._ledger(complaint)
+            # Re-insert so the file stays in order of the latest failure.
+            ledger.pop(payload["differential"], None)
+            ledger[payload["differential"]] = payload
+            self._dirty.add(path)
+            self.recorded += 1
+        elif kind == _RESOLVE:
+            path, ledger = self._ledger(complaint)
+            if ledger.pop(payload, None) is not None:
+                self._dirty.add(path)
+
+    def _write_dirty(self):
+        for path in self._dirty:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_failures(path, self._ledgers[path])
+            except OSError as e:
+                logger.error(f"❌ Error writing failure ledger {path}: {str(e)}")
+        self._dirty.clear()
+
+    def _run(self):
+        pending = 0
+        # A steady stream of events never lets get() time out, so the interval is tracked explicitly.
+        last_write = time.monotonic()
+        while True:
+            timeout = max(0.0, last_write + self.flush_interval - time.monotonic())
+            try:
+                kind, complaint, payload = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                kind = None
+            if kind == _STOP:
+                self._write_dirty()
+                return
+            if kind in (_RECORD, _RESOLVE):
+                try:
+                    self._apply(kind, complaint, payload)
+                except OSError as e:
+                    logger.error(f"❌ Error reading failure ledger for {complaint}: {str(e)}")
+                pending += 1
+            if kind == _FLUSH or pending >= self.batch_size or time.monotonic() - last_write >= self.flush_interval:
+                self._write_dirty()
+                pending = 0
+                last_write = time.monotonic()
+            if kind == _FLUSH:
+                payload.set()
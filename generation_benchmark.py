@@ -0,0 +1,363 @@
+"""
+End-to-end benchmark of generate_cases_from_differentials() against the stub backend.
+
+Every complaint in tables_list/diagnoses.jsonl is run through the full
+generation path (rate limiter, model stage, parse pool, writer, artefact
+store, manifest and ledger) with the stub model standing in for Vertex AI,
+so results are reproducible and cost nothing. The stub's latency
+distribution and failure mix come from the usual --stub-* options; with a
+fixed --stub-seed two runs make the same calls and see the same failures.
+
+Each configuration (one per --concurrency value) runs in a fresh spawned
+process, so the process-wide telemetry, artefact store and model start
+empty and peak RSS is that run's own. For each it reports:
+
+    cases/s           cases written per second of wall time
+    hedges            hedged requests issued and won (with --hedge-budget)
+    model idle        wall time with no model call in flight (and its share of the run)
+    slot utilisation  model call time / (wall time x concurrency)
+    disk bytes        size of everything written to the output directory
+    written bytes     bytes the run process sent to storage (/proc/self/io, Linux only)
+    peak RSS          of the run process and of its largest parse worker
+    attempts/case     model attempts per case written
+
+Results can be saved as JSON and compared with a stored baseline: a
+configuration whose cases/s drops, or whose attempts/case or peak RSS grows,
+by more than --tolerance counts as a regression and the exit status is 1.
+
+    python generation_benchmark.py --stub-latency 0.2 --stub-latency-jitter 0.2 --stub-latency-distribution lognormal \\
+        --stub-failure-rate 0.1 --stub-failure-mix rate_limit=2,truncated=1 --concurrency 1 8 32
+    python generation_benchmark.py --concurrency 8 --save-baseline generation_baseline.json
+    python generation_benchmark.py --concurrency 8 --baseline generation_baseline.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from model_backends import add_backend_arguments, add_hedging_arguments, model_from_args
+from pipeline import DEFAULT_PARSE_WORKERS
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_TOLERANCE = 0.1
+# Requests per minute for the benchmark's rate limiter: high enough that the stub, not the limiter, sets the pace.
+DEFAULT_BENCHMARK_RPM = 100000
+
+
+class CallTracker:
+    """
+    Model wrapper that records when calls are in flight.
+
+    busy_seconds_until() is the wall time with at least one generate call
+    running, so the run's model-idle time is its wall time minus that;
+    call_seconds sums the finished calls' own durations. Everything else is
+    forwarded to the model.
+    """
+
+    def __init__(self, model):
+        self._model = model
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._busy_since = None
+        self.calls = 0
+        self.busy_seconds = 0.0
+        self.call_seconds = 0.0
+
+    def _track(self, func, *args, **kwargs):
+        start = time.perf_counter()
+        with self._lock:
+            if self._in_flight == 0:
+                self._busy_since = start
+            self._in_flight += 1
+            self.calls += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self._in_flight -= 1
+                self.call_seconds += end - start
+                if self._in_flight == 0:
+                    self.busy_seconds += end - self._busy_since
+
+    def busy_seconds_until(self, now):
+        """Busy time up to `now`, including calls still running (e.g. hedged requests that lost)."""
+        with self._lock:
+            return self.busy_seconds + (now - self._busy_since if self._in_flight else 0.0)
+
+    def generate_with_prefix(self, *args, **kwargs):
+        return self._track(self._model.generate_with_prefix, *args, **kwargs)
+
+    def generate_streamed(self, *args, **kwargs):
+        return self._track(self._model.generate_streamed, *args, **kwargs)
+
+    def generate_candidates(self, *args, **kwargs):
+        return self._track(self._model.generate_candidates, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+def _maxrss_bytes(who):
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _proc_io_write_bytes():
+    try:
+        with open("/proc/self/io", 'r') as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def run_configuration(args, concurrency, output_dir):
+    """Run one configuration in this process and return its measurements (called in a spawned child)."""
+    if not args.show_output:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+
+    # Imported here so the telemetry, artefact store and model singletons belong to this run only.
+    from main_generation import generate_cases_from_differentials
+    from run_logging import setup_run_logging, shutdown_run_logging, DEFAULT_LOG_FILENAME
+    from telemetry import get_telemetry
+
+    model = CallTracker(model_from_args(args))
+    setup_run_logging(os.path.join(output_dir, DEFAULT_LOG_FILENAME), verbose=False)
+    write_bytes_before = _proc_io_write_bytes()
+    start = time.perf_counter()
+    try:
+        cases = generate_cases_from_differentials(
+            max_cases_per_complaint=args.max_cases,
+            specific_complaints=args.complaints,
+            concurrency=concurrency,
+            requests_per_minute=args.rpm,
+            tokens_per_minute=0,
+            resume=False,
+            model=model,
+            prompt_cache=args.prompt_cache,
+            parse_workers=args.parse_workers,
+            stream=args.stream,
+            output_dir=output_dir,
+            hedge_budget=args.hedge_budget,
+            hedge_percentile=args.hedge_percentile,
+            candidates=args.candidates,
+        )
+    finally:
+        shutdown_run_logging()
+    end = time.perf_counter()
+    wall_seconds = end - start
+    write_bytes_after = _proc_io_write_bytes()
+
+    telemetry = get_telemetry()
+    attempts = int(telemetry.attempts.sum)
+    model_idle_seconds = max(0.0, wall_seconds - model.busy_seconds_until(end))
+    return {
+        "concurrency": concurrency,
+        "cases": cases,
+        "differentials": telemetry.attempts.count,
+        "attempts": attempts,
+        "model_calls": model.calls,
+        "hedges_issued": telemetry.counter("hedges", event="issued"),
+        "hedges_won": telemetry.counter("hedges", event="won"),
+        "wall_seconds": wall_seconds,
+        "cases_per_second": cases / wall_seconds if wall_seconds else None,
+        "attempts_per_case": attempts / cases if cases else None,
+        "model_idle_seconds": model_idle_seconds,
+        "model_idle_fraction": model_idle_seconds / wall_seconds if wall_seconds else None,
+        "slot_utilisation": model.call_seconds / (wall_seconds * concurrency) if wall_seconds else None,
+        "disk_bytes": _directory_bytes(output_dir),
+        "written_bytes": (write_bytes_after - write_bytes_before) if write_bytes_before is not None else None,
+        "peak_rss_bytes": _maxrss_bytes(resource.RUSAGE_SELF) if resource else None,
+        "peak_parse_worker_rss_bytes": _maxrss_bytes(resource.RUSAGE_CHILDREN) if resource else None,
+    }
+
+
+def _configuration_entry(args, concurrency, output_root):
+    output_dir = os.path.join(output_root, f"concurrency_{concurrency}")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return run_configuration(args, concurrency, output_dir)
+
+
+def run_benchmark(args):
+    """Run every configuration in its own spawned process; returns the results dict."""
+    output_root = args.keep_output or tempfile.mkdtemp(prefix="generation_benchmark_")
+    runs = []
+    try:
+        for concurrency in args.concurrency:
+            print(f"⏱️ Running concurrency {concurrency}...")
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                runs.append(executor.submit(_configuration_entry, args, concurrency, output_root).result())
+    finally:
+        if not args.keep_output:
+            shutil.rmtree(output_root, ignore_errors=True)
+    return {
+        "stub": {
+            "latency": args.stub_latency,
+            "latency_jitter": args.stub_latency_jitter,
+            "latency_distribution": args.stub_latency_distribution,
+            "failure_rate": args.stub_failure_rate,
+            "failure_mix": args.stub_failure_mix,
+            "seed": args.stub_seed,
+            "replay_dir": args.stub_replay_dir,
+        },
+        "options": {
+            "parse_workers": args.parse_workers,
+            "stream": args.stream,
+            "prompt_cache": args.prompt_cache,
+            "hedge_budget": args.hedge_budget,
+            "hedge_percentile": args.hedge_percentile,
+            "candidates": args.candidates,
+            "max_cases": args.max_cases,
+            "complaints": args.complaints,
+        },
+        "runs": runs,
+    }
+
+
+def _format_bytes(value):
+    if value is None:
+        return "n/a"
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024 or unit == "GB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def _format_ratio(value, digits=2):
+    return "n/a" if value is None else f"{value:.{digits}f}"
+
+
+def print_results(results):
+    stub = results["stub"]
+    mix = ", ".join(f"{kind}={weight:g}" for kind, weight in (stub["failure_mix"] or {}).items()) or "equal weights"
+    print(f"📊 Stub latency {stub['latency']}s ± {stub['latency_jitter']}s ({stub['latency_distribution']}), "
+          f"failure rate {stub['failure_rate']} ({mix}), seed {stub['seed']}")
+    for run in results["runs"]:
+        idle_share = "n/a" if run["model_idle_fraction"] is None else f"{run['model_idle_fraction'] * 100:.1f}%"
+        utilisation = "n/a" if run["slot_utilisation"] is None else f"{run['slot_utilisation'] * 100:.1f}%"
+        print(f"  concurrency {run['concurrency']:3}: {run['cases']} cases in {run['wall_seconds']:.1f}s, "
+              f"{_format_ratio(run['cases_per_second'])} cases/s, {_format_ratio(run['attempts_per_case'])} attempts/case"
+              + (f", {run['hedges_issued']} hedges ({run['hedges_won']} won)" if results["options"]["hedge_budget"] else ""))
+        print(f"  {'':16} model idle {run['model_idle_seconds']:.1f}s ({idle_share}), slot utilisation {utilisation}, "
+              f"disk {_format_bytes(run['disk_bytes'])}, written {_format_bytes(run['written_bytes'])}, "
+              f"peak RSS {_format_bytes(run['peak_rss_bytes'])} (parse worker {_format_bytes(run['peak_parse_worker_rss_bytes'])})")
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Print per-configuration changes against `baseline`; returns a list of regression descriptions."""
+    regressions = []
+    if baseline.get("stub") != results["stub"]:
+        print("⚠️ Baseline was measured with different stub settings; comparisons are approximate")
+    before_by_concurrency = {run["concurrency"]: run for run in baseline.get("runs", [])}
+    print(f"🔁 Compared with the baseline (tolerance {tolerance * 100:.0f}%):")
+    for run in results["runs"]:
+        before = before_by_concurrency.get(run["concurrency"])
+        if not before:
+            print(f"  concurrency {run['concurrency']:3}: not in the baseline")
+            continue
+        changes = []
+        # (metric, True if higher is better)
+        for metric, higher_is_better in (("cases_per_second", True), ("attempts_per_case", False),
+                                         ("peak_rss_bytes", False)):
+            if not before.get(metric) or run[metric] is None:
+                continue
+            ratio = run[metric] / before[metric]
+            changes.append(f"{metric} {ratio:.2f}x")
+            if (ratio < 1 - tolerance) if higher_is_better else (ratio > 1 + tolerance):
+                regressions.append(f"concurrency {run['concurrency']} {metric} {before[metric]:.4g} -> {run[metric]:.4g}")
+        print(f"  concurrency {run['concurrency']:3}: " + ", ".join(changes))
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s): " + "; ".join(regressions))
+    else:
+        print("✅ No regressions against the baseline")
+    return regressions
+
+
+def _write_json(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark generate_cases_from_differentials end to end against the stub backend")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8],
+                        help="Concurrency levels to run, each as a separate configuration (default: 1 8).")
+    parser.add_argument("--parse-workers", type=int, default=DEFAULT_PARSE_WORKERS,
+                        help=f"Processes for parsing and validating responses (default: {DEFAULT_PARSE_WORKERS}).")
+    parser.add_argument("--complaints", type=str, nargs='+', default=None,
+                        help="Only run these complaints (default: all complaints in tables_list/diagnoses.jsonl).")
+    parser.add_argument("--max-cases", type=int, default=0,
+                        help="Maximum cases per complaint; 0 for every differential (default: 0).")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_BENCHMARK_RPM,
+                        help=f"Requests per minute for the rate limiter (default: {DEFAULT_BENCHMARK_RPM}).")
+    parser.add_argument("--prompt-cache", action="store_true",
+                        help="Register the static prompt prefix with the backend's context cache.")
+    parser.add_argument("--candidates", type=int, default=1,
+                        help="Candidates requested per call; the first valid one is kept (default: 1).")
+    add_backend_arguments(parser)
+    add_hedging_arguments(parser)
+    parser.set_defaults(backend="stub")
+    parser.add_argument("--keep-output", type=str, default=None,
+                        help="Keep each configuration's artefacts under this directory instead of a temporary one.")
+    parser.add_argument("--show-output", action="store_true",
+                        help="Show the generation runs' console output.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Compare with results saved by --save-baseline; exits with status 1 on a regression.")
+    parser.add_argument("--save-baseline", type=str, default=None,
+                        help="Save these results as the baseline for later runs.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Allowed relative change of cases/s, attempts/case and peak RSS before it counts as a regression (default: {DEFAULT_TOLERANCE}).")
+    args = parser.parse_args()
+    if args.backend != "stub":
+        parser.error("the benchmark only runs against the stub backend")
+    if args.candidates > 1 and args.stream:
+        parser.error("--candidates cannot be combined with --stream")
+
+    results = run_benchmark(args)
+    print_results(results)
+    if args.output:
+        _write_json(args.output, results)
+        print(f"📝 Results written to {args.output}")
+    if args.save_baseline:
+        _write_json(args.save_baseline, results)
+        print(f"📝 Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
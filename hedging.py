@@ -0,0 +1,137 @@
+"""
+Hedged model calls for tail-latency differentials.
+
+When a call has been running for longer than the run's p90 call latency so
+far, HedgePolicy.call() sends one duplicate request and returns whichever
+usable response arrives first:
+
+    primary  |----------------- p90 ------x  (still running)
+    hedge                                 |------- done -> returned
+
+- The threshold is the `percentile` (default 90) of the latencies of every
+  call completed so far in the run, measured around the whole call (rate
+  limiter wait included, as the hedge goes through the limiter too). No
+  call is hedged until HEDGE_MIN_SAMPLES calls have completed.
+- Each call is hedged at most once, and the run at most `budget` times, so
+  the extra spend is bounded (budget 0 disables hedging).
+- "Usable" is decided by accept(response), normally is_usable_response():
+  a call that raises or returns an empty or truncated response lets the
+  other call win. Parsing and validation stay in their usual stage, so a
+  hedge that wins but then fails validation is retried like any attempt.
+- Calls cannot be cancelled once sent: the losing call runs to completion in
+  the background and its response is discarded.
+
+Hedges issued and won are counted in the run telemetry (see telemetry.py).
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from run_logging import get_logger
+from telemetry import get_telemetry, percentile
+
+logger = get_logger("hedging")
+
+DEFAULT_HEDGE_PERCENTILE = 90
+# Completed calls needed before the latency percentile is trusted.
+HEDGE_MIN_SAMPLES = 20
+
+
+def is_usable_response(response):
+    """True for a response with text that was not cut off at the token limit."""
+    return bool(response is not None and getattr(response, "text", None)
+                and not getattr(response, "hit_token_limit", False))
+
+
+class HedgePolicy:
+    """Per-run hedging state: call latencies so far, the hedge budget and hedges issued/won. Thread-safe."""
+
+    def __init__(self, budget, percentile=DEFAULT_HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES):
+        self.budget = max(0, budget)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.issued = 0
+        self.won = 0
+        # Completed call latencies, kept sorted.
+        self._latencies = []
+        self._lock = threading.Lock()
+
+    def threshold(self):
+        """Seconds after which a call is hedged, or None until enough calls have completed."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return percentile(self._latencies, self.percentile)
+
+    def _observe(self, seconds):
+        with self._lock:
+            bisect.insort(self._latencies, seconds)
+
+    def _take_hedge(self):
+        with self._lock:
+            if self.issued >= self.budget:
+                return False
+            self.issued += 1
+            return True
+
+    def _start(self, func, args, kwargs):
+        """Run func in its own thread (with the caller's logging context); returns a Future."""
+        future = Future()
+        future.set_running_or_notify_cancel()
+        context = contextvars.copy_context()
+
+        def run():
+            start = time.perf_counter()
+            try:
+                result = context.run(func, *args, **kwargs)
+            except BaseException as e:
+                self._observe(time.perf_counter() - start)
+                future.set_exception(e)
+            else:
+                self._observe(time.perf_counter() - start)
+                future.set_result(result)
+
+        threading.Thread(target=run, name="hedged-call", daemon=True).start()
+        return future
+
+    def call(self, func, *args, accept=is_usable_response, **kwargs):
+        """
+        Call func(*args, **kwargs), sending a duplicate if it runs past threshold().
+
+        Returns the first response for which accept() is true; if neither is
+        accepted, the primary call's outcome (its response, or its exception
+        re-raised).
+        """
+        threshold = self.threshold() if self.issued < self.budget else None
+        if threshold is None:
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._observe(time.perf_counter() - start)
+
+        primary = self._start(func, args, kwargs)
+        if wait([primary], timeout=threshold).done or not self._take_hedge():
+            return primary.result()
+        logger.info(f"🪁 Call still running after {threshold:.2f}s (p{self.percentile:g}); sending a hedged request",
+                    extra={"hedges_issued": self.issued})
+        get_telemetry().record_hedge("issued")
+        hedge = self._start(func, args, kwargs)
+
+        pending = [primary, hedge]
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            # If both finished together, prefer the primary.
+            for future in [f for f in pending if f in done]:
+                pending.remove(future)
+                if future.exception() is None and accept(future.result()):
+                    if future is hedge:
+                        with self._lock:
+                            self.won += 1
+                        get_telemetry().record_hedge("won")
+                        logger.debug("🪁 Hedged request won")
+                    return future.result()
+        return primary.result()
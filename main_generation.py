@@ -4,54 +4,48 @@
 import os
 import time
 import json
-import jsonlines
-import re
 import glob
-from google.cloud import aiplatform
-from vertexai.preview.generative_models import GenerativeModel
-from google import generativeai as genai
-from google.generativeai import types
 from dotenv import load_dotenv
-import vertexai
 import argparse
-from json_repair import repair_json as json_repair
-import copy
+import logging
+from functools import partial
+from model_backends import (MODEL_ID, CachedPrefix, get_model, add_backend_arguments, add_prompt_arguments,
+                            model_from_args, preflight_check, report_prompt_token_savings,
+                            add_structured_output_arguments, add_telemetry_arguments, add_logging_arguments,
+                            add_hedging_arguments, add_catalogue_arguments)
+from prompts import build_prompt_prefix, build_prompt_suffix, exemplar_tokens_saved
+from response_parser import extract_case, extract_candidates
+from case_schema import validate_specific_key_nesting, structured_output_config, generation_mode_name
+from case_writer import CaseSink, JsonlAppendWriter
+from telemetry import get_telemetry, DEFAULT_METRICS_FILENAME
+from run_logging import get_logger, job_context, progress, setup_run_logging, shutdown_run_logging, DEFAULT_LOG_FILENAME
+from failure_ledger import (FailureLedger, REASON_MODEL_ERROR, REASON_EMPTY_RESPONSE, REASON_PARSE_ERROR,
+                            REASON_VALIDATION_FAILED, REASON_MAX_TOKENS)
+from catalogue import get_catalogue, sanitize_filename, DEFAULT_DIAGNOSES_PATH
+from artefact_store import get_artefact_store, KIND_RAW_RESPONSE, KIND_REPAIRED_ORIGINAL, KIND_DEBUG_PROMPT
+from pipeline import GenerationPipeline, DEFAULT_PARSE_WORKERS
+from batch_generation import LocalBatchSubmitter, VertexBatchSubmitter, run_batch_jobs
+from rate_limiter import RateLimiter, backoff_delay, estimate_tokens
+from hedging import HedgePolicy, DEFAULT_HEDGE_PERCENTILE
+from run_manifest import RunManifest, DEFAULT_MANIFEST_FILENAME, STATUS_SUCCEEDED, STATUS_FAILED
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Set the environment variable for authentication
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "service-account.json"
-
-# Define the default path for diagnoses.jsonl relative to the script's location
+# The default path for diagnoses.jsonl (relative to the script's location) is DEFAULT_DIAGNOSES_PATH in catalogue.py
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-DEFAULT_DIAGNOSES_PATH = os.path.join(SCRIPT_DIR, "tables_list", "diagnoses.jsonl")
-
-# Initialize Vertex AI with your project and credentials
-try:
-    vertexai.init(
-        location="us-central1",
-        credentials=None  # Will use service account from environment
-    )
-    print("✅ Vertex AI initialized successfully")
-except Exception as e:
-    print(f"❌ Error initializing Vertex AI: {str(e)}")
-    exit(1)
-
-# Initialize the model
-try:
-    model = GenerativeModel("gemini-2.5-pro-preview-03-25")
-    print("✅ Model initialized successfully")
-    
-    # Test the model with a simple prompt
-    test_response = model.generate_content("Hello, can you respond?")
-    print(f"✅ Test response: {test_response.text[:100]}...")
-except Exception as e:
-    print(f"❌ Error initializing model: {str(e)}")
-    exit(1)
+
+# The default (Vertex AI) client is created lazily on first use (see model_backends.py),
+# so importing this module or running --help makes no network calls. Use --preflight
+# to send a test prompt before the run starts, or --backend stub to run offline.
+model = get_model()
 
 # set model ID for reference
-model_id = "gemini-2.5-pro-preview-03-25"
+model_id = MODEL_ID
+
+# Per-attempt messages go to the run log (artefacts/run_log.jsonl); see run_logging.py.
+logger = get_logger("main_generation")
+NO_NEWLINES = str.maketrans("", "", "\r\n")
 
 # Define this list to run only specific complaints from the script.
 # If this list is empty AND no --complaints are given via CLI, all complaints will be processed.
@@ -164,65 +158,18 @@ COMPLAINTS_BANK = [
     "Weight loss"
 ]
 
-def load_differential_diagnoses(jsonl_file_path=None):
-    """Load all differential diagnoses from a JSONL file, with category information."""
+def load_differential_diagnoses(jsonl_file_path=None, use_cache=True):
+    """
+    Load all differential diagnoses with category information.
+
+    Thin wrapper over the shared catalogue (see catalogue.py), which parses the
+    file once per process and caches the index on disk (unless `use_cache` is False). Returns
+    (differentials_by_complaint, diagnosis_categories_by_complaint).
+    """
     if jsonl_file_path is None:
         jsonl_file_path = DEFAULT_DIAGNOSES_PATH
-    differentials_by_complaint = {}
-    # Also track category information for each diagnosis
-    diagnosis_categories_by_complaint = {}
-    
     try:
-        with open(jsonl_file_path, 'r', encoding='utf-8') as f:
-            for line_number, line in enumerate(f, 1):
-                try:
-                    data = json.loads(line.strip())
-                    # Expecting a single key per JSON object, which is the complaint
-                    if len(data) == 1:
-                        complaint_name = list(data.keys())[0]
-                        diagnosis_categories = data[complaint_name]
-                        
-                        all_diagnoses_for_complaint = []
-                        diagnosis_to_category_map = {}  # Maps each diagnosis to its category
-                        
-                        if isinstance(diagnosis_categories, dict):
-                            for category_key, diagnoses_list in diagnosis_categories.items():
-                                # Exclude specified categories
-                                if category_key in ["Masquerades", "Patient trying to tell me something"]:
-                                    continue # Skip these categories
-                                    
-                                # We are interested in "Probability diagnosis", "Serious disorders", "Pitfalls",
-                                # and potentially others if they contain lists of strings (after exclusion).
-                                if isinstance(diagnoses_list, list):
-                                    for diag in diagnoses_list:
-                                        if isinstance(diag, str):
-                                            diag_str = str(diag)
-                                            all_diagnoses_for_complaint.append(diag_str)
-                                            # Store category of each diagnosis
-                                            diagnosis_to_category_map[diag_str] = category_key
-
-                            # Remove duplicates (if a diagnosis appears in multiple categories, keep first occurrence)
-                            seen = set()
-                            unique_diagnoses = []
-                            for diag in all_diagnoses_for_complaint:
-                                if diag not in seen:
-                                    seen.add(diag)
-                                    unique_diagnoses.append(diag)
-                            
-                            if unique_diagnoses:
-                                differentials_by_complaint[complaint_name] = unique_diagnoses
-                                diagnosis_categories_by_complaint[complaint_name] = diagnosis_to_category_map
-                                print(f"✅ Loaded {len(unique_diagnoses)} unique differentials for '{complaint_name}' from {jsonl_file_path}")
-                            else:
-                                print(f"⚠️ No valid diagnoses found for '{complaint_name}' in {jsonl_file_path} on line {line_number}")
-                        else:
-                            print(f"❌ Unexpected structure for complaint '{complaint_name}' on line {line_number} in {jsonl_file_path}. Expected dict of categories.")
-                    else:
-                        print(f"❌ Unexpected JSON structure on line {line_number} in {jsonl_file_path}. Expected single key (complaint name).")
-                except json.JSONDecodeError as e:
-                    print(f"❌ Error decoding JSON on line {line_number} in {jsonl_file_path}: {str(e)}")
-                except Exception as e:
-                    print(f"❌ Error processing line {line_number} in {jsonl_file_path}: {str(e)}")
+        catalogue = get_catalogue(jsonl_file_path, use_cache)
     except FileNotFoundError:
         print(f"❌ Error: The file {jsonl_file_path} was not found.")
         return {}, {} # Return empty if file not found to prevent crash
@@ -230,305 +177,382 @@ def load_differential_diagnoses(jsonl_file_path=None):
         print(f"❌ An unexpected error occurred while trying to read {jsonl_file_path}: {str(e)}")
         return {}, {}
 
-    if not differentials_by_complaint:
+    if not catalogue.differentials_by_complaint:
         print(f"⚠️ No differential diagnoses were loaded from {jsonl_file_path}. Please check the file content and path.")
-        
-    return differentials_by_complaint, diagnosis_categories_by_complaint
 
-def validate_specific_key_nesting(data_dict, base_path_name="case"):
-    """
-    Validates if "OSCE_Examination" and its specific child keys exist as expected
-    within the provided data_dict (assumed to be the content of the "case" key).
-
-    Expected structure:
-    case: {
-        "OSCE_Examination": {
-            "Patient_Actor": { ... },
-            "Physical_Examination_Findings": { ... },
-            "Test_Results": { ... },
-            "Correct_Diagnosis": "Some diagnosis"
-        }
-    }
+    return catalogue.differentials_by_complaint, catalogue.categories_by_complaint
+
+# Maximum number of batch attempts per differential
+MAX_BATCH_ATTEMPTS = 3
+
+# Sampling settings used for every case generation call
+GENERATION_CONFIG = {
+    "temperature": 1.0,
+    "max_output_tokens": 8000,
+    "top_k": 40,
+    "top_p": 0.8,
+}
+
+# Default model call budgets; the limiter backs off below these on 429/503 errors.
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_TOKENS_PER_MINUTE = 0  # 0 disables the tokens-per-minute budget
+# Valid candidates other than the one kept, with --candidates N --store-alternates.
+DEFAULT_ALTERNATES_FILENAME = "alternates.jsonl"
+
+def process_response_text(complaint, differential, diagnosis_tag, response_text, attempts, output_dir="artefacts"):
     """
-    # 1. Check for OSCE_Examination at the top level of data_dict (which is the content of "case")
-    osce_key = "OSCE_Examination"
-    osce_path_str = f"{base_path_name}.{osce_key}" # e.g., "case.OSCE_Examination"
-
-    if not isinstance(data_dict, dict):
-        # This check is mostly for robustness, as data_dict should be the "case" object.
-        return False, f"Validation Error: Expected '{base_path_name}' to be a dictionary, but found {type(data_dict).__name__}."
-
-    if osce_key not in data_dict:
-        return False, f"Validation Error: Missing key '{osce_key}' at path '{base_path_name}' (expected '{osce_path_str}')."
-
-    osce_level_dict = data_dict[osce_key]
-    if not isinstance(osce_level_dict, dict):
-        return False, f"Validation Error: Key '{osce_key}' at path '{osce_path_str}' should point to a dictionary, but found {type(osce_level_dict).__name__}."
-
-    # 2. Define keys expected as direct children of OSCE_Examination and their requirements.
-    # Format: (key_name, must_be_dict_if_not_terminal_key)
-    # "Correct_Diagnosis" is the terminal key for diagnosis; its value type isn't strictly checked beyond existence here.
-    expected_children_of_osce = [
-        ("Patient_Actor", True),
-        ("Physical_Examination_Findings", True),
-        ("Test_Results", True),
-        ("Correct_Diagnosis", False) # False means it doesn't *have* to be a dict for this validation.
-    ]
+    Clean, parse and validate one raw model response and save the resulting case.
 
-    # The base path for error messages concerning children of OSCE_Examination
-    children_base_path_str = osce_path_str # This will be like "case.OSCE_Examination"
+    Used by batch-mode ingestion and the sequential attempt loop; the pipeline
+    parses in a process pool and calls save_extracted_case() itself.
 
-    for child_key, must_be_dict in expected_children_of_osce:
-        current_child_path_str = f"{children_base_path_str}.{child_key}" # e.g., "case.OSCE_Examination.Patient_Actor"
+    Returns a dict with:
+        "case": the all_cases entry for the generated case, or None if the response was rejected
+        "output_path": path of the saved case JSON file, or None
+        "failure": {"reason", "detail"} if the response was rejected (see failure_ledger.py), else None
+    """
+    extracted = extract_case(response_text, validate_specific_key_nesting)
+    return save_extracted_case(complaint, differential, diagnosis_tag, response_text, extracted, attempts, output_dir)
 
-        if child_key not in osce_level_dict:
-            return False, f"Validation Error: Missing key '{child_key}' at path '{current_child_path_str}'."
+def save_extracted_case(complaint, differential, diagnosis_tag, response_text, extracted, attempts, output_dir="artefacts"):
+    """
+    Save one response and, if extract_case() accepted it, the tagged case.
 
-        if must_be_dict:
-            child_value = osce_level_dict[child_key]
-            if not isinstance(child_value, dict):
-                return False, f"Validation Error: Key '{child_key}' at path '{current_child_path_str}' should point to a dictionary, but found {type(child_value).__name__}."
-    
-    # If all checks pass
-    return True, f"Specific key nesting validated successfully ({osce_path_str} and its direct children)."
-
-# Restore the example_json_format variable definition
-example_json_format = """
-{
-      "OSCE_Examination": {
-        "Patient_Actor": {
-          "Demographics": "32-year-old male",
-          "History": "The patient reports a progressive worsening of headaches over the past several weeks. He also notices blurred vision occasionally, especially later in the day. He initially attributed these to work-related stress but has decided to seek medical attention as the symptoms persisted and have not responded to over-the-counter medications.",
-          "Symptoms": {
-            "Primary_Symptom": "Headaches",
-            "Secondary_Symptoms": [
-              "Blurred vision",
-              "Pain intensifying over the day",
-              "Occasional nausea"
-            ]
-          },
-          "Past_Medical_History": "Previous concussion during a motor vehicle accident 5 years ago. No other significant past medical or surgical history.",
-          "Social_History": "Non-smoker, occasional drinker. Works as a software engineer.",
-          "Review_of_Systems": "Pain is located in the frontal region and worse in the morning. Denies fever, focal neurology, seizures, balance problems, weakness or loss of consciousness. No preceding aura."
-        },
-        "Physical_Examination_Findings": {
-          "Vital_Signs": {
-            "Temperature": "36.7°C (98°F)",
-            "Blood_Pressure": "128/75 mmHg",
-            "Heart_Rate": "60 bpm",
-            "Respiratory_Rate": "18 breaths/min"
-          },
-          "Neurological_Examination": {
-            "Pupils": "Bilateral papilledema",
-            "Gait": "Normal gait",
-            "Motor_System": "Normal power and tone in all four limbs. Deep tendon reflexes within normal limits.",
-            "Sensory_System": "Normal sensation to touch, pain, temperature, and vibration."
-          }
-        },
-        "Test_Results": {
-          "Imaging": {
-            "MRI_Brain": {
-              "Findings": "Normal, no space-occupying lesions."
-            },
-            "CT_Brain": {
-              "Findings": "Normal, no space-occupying lesions."
-            },
-            "CT_Angiogram_Brain": {
-              "Findings": "Normal, no acute intracranial hemorrhage."
-            }
-          },
-          "CSF_Opening_Pressure": "Increased CSF opening pressure",
-          "CSF_analysis": {
-            "Protein_Level": "Normal",
-            "WBC_Count": "Normal"
-          }
-        },
-        "Correct_Diagnosis": "Idiopathic intracranial hypertension"
-      }
-    },
-{
-    "Presenting complaint": "Weight loss",
-    "case": {
-      "OSCE_Examination": {
-        "Patient_Actor": {
-          "Demographics": "60-year-old female",
-          "History": "The patient reports a 6-month history of diarrhea, as well as considerable weight loss during this period. She also mentions being easily fatigued and having been diagnosed with iron deficiency anemia.",
-          "Symptoms": {
-            "Primary_Symptom": "Weight loss and chronic diarrhea",
-            "Secondary_Symptoms": [
-              "Fatigue",
-              "Iron deficiency anemia",
-		"Constipation"
-            ]
-          },
-          "Past_Medical_History": "No significant past medical history.",
-          "Social_History": "Non-smoker, moderate alcohol consumption, works as a restaurant manager. No allergies, eats an unrestricted diet.",
-          "Review_of_Systems": "Patient denies experiencing any vomiting, blood in stool, or gastric pain. Reports 5 kg weight loss over 3 months, denies any rashes."
-        },
-        "Physical_Examination_Findings": {
-          "Vital_Signs": {
-            "Temperature": "36.7°C (98.1°F)",
-            "Blood_Pressure": "115/70 mmHg",
-            "Heart_Rate": "82 bpm",
-            "Respiratory_Rate": "17 breaths/min"
-          },
-          "Abdominal_Examination": {
-            "Inspection": "Flat abdomen",
-            "Auscultation": "Increased bowel sounds",
-            "Percussion": "Tympanic sound throughout",
-            "Palpation": "Mild, diffuse abdominal tenderness"
-          }
-        },
-        "Test_Results": {
-          "Blood_Tests": {
-            "Hemoglobin": "Low",
-            "Iron_Studies": {
-              "Serum_Iron": "Low",
-              "Transferrin_Saturation": "Low",
-              "Ferritin": "Low",
-		"Anti TTG-IgA": "Positive",
-		"Anti-EMA": "Positive",
-		"IgA-Titre": "Normal"
-            }
-          },
-          "Stool_Analysis": {
-            "Macroscopic_Appearance": "Normal",
-            "Fecal_Fat_Stain": "Positive"
-          },
-          "Upper_Endoscopy": {
-            "Findings": "Villous atrophy in the duodenum"
-          },
-          "Small_Bowel_Biopsy": {
-            "Histopathology": "Villous atrophy with crypt hyperplasia and intraepithelial lymphocytosis"
-          },
-"Colonoscopy": {
-            "Findings": "Normal"
-          }
-        },
-        "Correct_Diagnosis": "Celiac disease"
-      }
-    }
-  },
-{
-  "Presenting complaint": "Abdominal pain, migrating from epigastrium to right lower quadrant",
-  "case": {
-    "OSCE_Examination": {
-      "Patient_Actor": {
-        "Demographics": "28-year-old male",
-        "History": "The patient presents with a 36-hour history of abdominal pain. He states the pain initially began around his epigastrium, described as a persistent dull ache. Over the last 12 hours, the pain has become more constant and has shifted, now predominantly felt in the right lower quadrant, with some associated discomfort radiating to his right flank. He rates the pain as 5/10, exacerbated by movement and coughing. He experienced one episode of nausea this morning but has not vomited. His appetite is noticeably reduced, though he is not completely anorexic. His last bowel movement was yesterday and was normal; he now feels slightly constipated. He also reports a mild burning sensation at the end of urination for the past day, but denies increased urinary frequency, urgency, or visible blood in his urine. He mentions consuming some 'questionable leftovers' two days prior, but no one else who ate them has reported illness.",
-        "Symptoms": {
-          "Primary_Symptom": "Abdominal pain, migrating from epigastrium to right lower quadrant",
-          "Secondary_Symptoms": [
-            "Nausea (one episode)",
-            "Reduced appetite",
-            "Slight constipation",
-            "Mild dysuria"
-          ]
-        },
-        "Past_Medical_History": "Generally healthy. No chronic illnesses. No previous abdominal surgeries. No history of inflammatory bowel disease. No known drug allergies.",
-        "Social_History": "Non-smoker. Drinks socially, approximately 2-3 beers on weekends. Works as a graphic designer. Denies illicit drug use.",
-        "Medications": "No regular medications. Takes ibuprofen occasionally for headaches.",
-        "Review_of_Systems": "Patient reports the abdominal pain as his main concern. Denies fever at home (though measured 37.6°C in clinic), denies chills or night sweats. Denies significant recent weight loss. Denies chest pain, palpitations, or shortness of breath. Denies melena or hematochezia. Denies rash or joint pains. Confirms mild dysuria but denies frank hematuria, true urinary urgency, or flank pain distinct from his described abdominal discomfort."
-      },
-      "Physical_Examination_Findings": {
-        "Vital_Signs": {
-          "Temperature": "37.6°C (99.7°F)",
-          "Blood_Pressure": "125/80 mmHg",
-          "Heart_Rate": "92 bpm",
-          "Respiratory_Rate": "18 breaths/min",
-          "Oxygen_Saturation": "99% on room air"
-        },
-        "General_Appearance": "Alert and oriented. Appears uncomfortable and is observed to shift position frequently on the examination table. Not in acute distress.",
-        "Abdominal_Examination": {
-          "Inspection": "Abdomen is flat. No visible scars, distension, or discoloration. Umbilicus is central and inverted.",
-          "Auscultation": "Bowel sounds are present but slightly hypoactive in all four quadrants. No abdominal bruits.",
-          "Percussion": "Mild tympany throughout. Tender to light percussion over the right lower quadrant and extending slightly to the right flank. No shifting dullness.",
-          "Palpation": "Maximal tenderness on palpation in the right lower quadrant, slightly medial to McBurney's point. Some voluntary guarding noted in this area. No definite rebound tenderness elicited, though the patient winces and pulls away upon rapid withdrawal of pressure. Rovsing's sign is equivocal. Psoas and Obturator signs are negative. No palpable masses. Liver edge not palpable; spleen not palpable. No hepatosplenomegaly."
-        },
-        "Cardiovascular_Examination": "Regular rate and rhythm. S1 and S2 heart sounds normal. No murmurs, rubs, or gallops.",
-        "Respiratory_Examination": "Chest clear to auscultation bilaterally. No wheezes, rales, or rhonchi. Symmetric chest expansion.",
-        "Back_Examination": "No costovertebral angle tenderness elicited bilaterally."
-      },
-      "Test_Results": {
-        "Blood_Tests": {
-          "Complete_Blood_Count": {
-            "WBC": "11.5 x 10^9/L",
-            "Hemoglobin": "14.5 g/dL",
-            "Hematocrit": "43%",
-            "Platelets": "250 x 10^9/L",
-            "Neutrophils": "75%",
-            "Lymphocytes": "18%",
-            "Monocytes": "5%",
-            "Eosinophils": "2%"
-          },
-          "C_Reactive_Protein": "35 mg/L",
-          "Electrolytes_and_Renal_Function": {
-            "Sodium": "138 mmol/L",
-            "Potassium": "4.0 mmol/L",
-            "Chloride": "102 mmol/L",
-            "Bicarbonate": "24 mmol/L",
-            "Urea": "5.0 mmol/L",
-            "Creatinine": "80 µmol/L"
-          },
-          "Liver_Function_Tests": {
-            "ALT": "25 U/L",
-            "AST": "22 U/L",
-            "ALP": "70 U/L",
-            "Total_Bilirubin": "0.8 mg/dL"
-          },
-          "Amylase": "60 U/L"
-        },
-        "Urine_Analysis": {
-          "Dipstick": {
-            "Color": "Yellow",
-            "Clarity": "Clear",
-            "Specific_Gravity": "1.015",
-            "pH": "6.0",
-            "Leukocytes": "Trace",
-            "Nitrite": "Negative",
-            "Protein": "Negative",
-            "Glucose": "Negative",
-            "Ketones": "Negative",
-            "Urobilinogen": "Normal",
-            "Bilirubin": "Negative",
-            "Blood": "Trace"
-          },
-          "Microscopy": {
-            "WBC_per_HPF": "2-5",
-            "RBC_per_HPF": "1-3",
-            "Bacteria": "None seen",
-            "Casts": "None seen",
-            "Epithelial_cells": "Few"
-          }
-        },
-        "Imaging": {
-          "Abdominal_Ultrasound_RLQ_Pelvis": {
-            "Findings": "Focused examination of the right lower quadrant demonstrates limited views due to overlying bowel gas. The appendix was not definitively visualized. No free fluid or obvious abscess collection identified in the RLQ. Kidneys appear sonographically normal bilaterally. Bladder unremarkable. No other acute sonographic abnormality identified to explain the patient's symptoms."
-          },
-          "CT_Abdomen_Pelvis_with_IV_contrast": {
-            "Findings": "The appendix is identified, measuring 7mm in maximal transverse diameter with associated mild circumferential wall thickening and periappendiceal fat stranding. A small amount of simple free fluid is noted adjacent to the appendiceal tip. No definite appendicolith visualized. No evidence of abscess formation or frank perforation. Several mildly prominent mesenteric lymph nodes, up to 8mm in short axis, are seen in the right lower quadrant, likely reactive. The visualized small and large bowel are otherwise unremarkable. Liver, spleen, pancreas, kidneys, and adrenal glands are normal. No acute pelvic pathology identified."
-          }
-        }
-      },
-      "Correct_Diagnosis": "Acute appendicitis (non-perforated)"
+    Saves the raw response to the artefact store, and on success the tagged case
+    JSON in the complaint directory. Returns the same dict as process_response_text.
+    """
+    complaint_dir = os.path.join(output_dir, sanitize_filename(complaint))
+    os.makedirs(complaint_dir, exist_ok=True)
+    result = {"case": None, "output_path": None, "failure": None}
+
+    log = {"attempt": attempts}
+    if logger.isEnabledFor(logging.DEBUG):
+        # First 100 characters of the response, without newlines, for the run log.
+        logger.debug(f"📄 Raw response: {len(response_text)} characters, begins with: "
+                     f"{response_text[:100].translate(NO_NEWLINES)}...", extra={**log, "response_chars": len(response_text)})
+
+    # Save the complete raw response from the model to the artefact store.
+    # This is useful for inspecting exactly what the model returned before any processing
+    # (python artefact_store.py cat raw_response <complaint> <differential> <attempt>).
+    artefact_store = get_artefact_store(output_dir)
+    raw_ref = artefact_store.put(KIND_RAW_RESPONSE, complaint, differential, attempts, response_text)
+
+    logger.debug(f"📝 Saved raw response to {raw_ref}", extra={**log, "raw_ref": raw_ref})
+
+    # Fence stripping, truncation repair, parsing and validation were done in one pass (see response_parser.py).
+    get_telemetry().record_extraction(extracted)
+    for repair in extracted["repairs"]:
+        logger.debug(f"🧹 Repaired response: {repair}", extra=log)
+    if extracted["parse_error"] is not None:
+        logger.info(f"❌ JSON parse error: {extracted['parse_error']}", extra=log)
+        if extracted["used_json_repair"]:
+            logger.info("✅ Fixed JSON parsed successfully by json-repair!", extra=log)
+
+    if extracted["error"] is not None:
+        if extracted["validation_failed"]:
+            # The required nested structure is missing; the caller tries the next attempt and
+            # logs the differential once if every attempt fails.
+            result["failure"] = {"reason": REASON_VALIDATION_FAILED, "detail": extracted["error"]}
+            logger.info(f"❌ Specific key nesting validation failed: {extracted['error']}", extra={**log, "reason": REASON_VALIDATION_FAILED})
+        else:
+            result["failure"] = {"reason": REASON_PARSE_ERROR, "detail": extracted["error"]}
+            logger.info(f"❌ {extracted['error']}", extra={**log, "reason": REASON_PARSE_ERROR})
+        return result # Rejected; the caller moves on to the next attempt.
+    logger.debug(f"✅ {extracted['validation_message']}", extra=log)
+
+    if extracted["used_json_repair"]:
+        # For debugging, save the full JSON object *as returned by json_repair* before extracting the 'case'.
+        fixed_ref = artefact_store.put(KIND_REPAIRED_ORIGINAL, complaint, differential, attempts,
+                                       json.dumps(extracted["data"], indent=2, ensure_ascii=False))
+
+        logger.debug(f"📝 Saved *original* repaired JSON (before extraction) to {fixed_ref}", extra=log)
+
+    # Add tag field to the case content. The parsed case belongs to this call, so a
+    # shallow copy is enough to keep extracted["data"] unchanged.
+    tagged_case_content = {**extracted["case"], "tag": diagnosis_tag}
+
+    generated_case = { # Returned to the caller, which streams it to the JSONL outputs in order.
+        "intended_complaint_category": complaint, # Store the category it was generated for
+        "ai_presenting_complaint": extracted["presenting_complaint"], # Keep AI's version
+        "content_to_write": tagged_case_content, # Store the case object for output with tag
+        "diagnosis_category": diagnosis_tag
     }
-  }
-}
 
-"""
+    # Save the successfully parsed and validated 'case' object to its own JSON file.
+    case_filename = f"{sanitize_filename(differential)}.json"
+    case_filepath = os.path.join(complaint_dir, case_filename)
+
+    with open(case_filepath, 'w', encoding='utf-8') as f:
+        json.dump(tagged_case_content, f, indent=2, ensure_ascii=False)
 
-# Helper function to sanitize filenames
-def sanitize_filename(name):
-    """Replace invalid filename characters with underscores."""
-    # Replace characters that are invalid in filenames with underscores
-    # Windows specifically disallows: \ / : * ? " < > |
-    invalid_chars = r'[\\/:*?"<>|]'
-    return re.sub(invalid_chars, '_', name)
+    logger.info("✅ Generated and saved case (extracted content only)", extra={**log, "output_path": case_filepath})
+    result["case"] = generated_case
+    result["output_path"] = case_filepath
+
+    return result
+
+def request_case(complaint, differential, diagnosis_tag, attempts, rate_limiter, model, prompt_prefix, generation_config,
+                 stream=False, hedge_policy=None, candidates=1, compact_prompt=False):
+    """
+    Make one model call for a differential (the model stage of the pipeline).
+
+    With `stream` the response is streamed and reading stops as soon as the
+    JSON object closes (see model_backends.generate_streamed); a response cut
+    off at max_output_tokens fails with REASON_MAX_TOKENS instead of being
+    repaired. With `hedge_policy` (see hedging.py) a call that runs past the
+    run's latency percentile is duplicated and the first usable response kept.
+    With `candidates` > 1 the call asks for that many candidates (see
+    model_backends.generate_candidates); not combined with `stream`.
+
+    Returns an outcome dict: "text" (the response text, or None if the call
+    failed, the response was empty or hit the token limit), "candidates" (every
+    candidate's text, for a multi-candidate call), and for failures "failure"
+    ({"reason", "detail"}) and "retry_delay" (seconds to back off before the
+    next attempt). "prompt_suffix" is kept for saving a debug prompt, and
+    "truncated_text" for saving a response that hit the token limit.
+    """
+    log = {"attempt": attempts}
+    telemetry = get_telemetry()
+    # Only the suffix varies per differential; the static prefix (if any) is shared by every call.
+    # A non-empty prefix means the --prompt-cache layout (see prompts.py).
+    prompt_suffix = build_prompt_suffix(differential, complaint, compact_prompt, split=bool(prompt_prefix.text))
+    outcome = {"text": None, "failure": None, "retry_delay": None, "prompt_suffix": prompt_suffix}
+
+    # This try-except block catches errors during the model call itself
+    # or fundamental issues with the response object.
+    try:
+        logger.debug(f"🌀 Attempt {attempts}/{MAX_BATCH_ATTEMPTS}: sending prompt to model", extra=log)
+
+        sent_prompt_tokens = estimate_tokens(prompt_suffix) + (0 if prompt_prefix.is_cached else prompt_prefix.token_count)
+
+        def call_model():
+            # Usage is recorded per call, so a hedge's discarded response is still counted.
+            if candidates > 1:
+                generate, prompt = model.generate_candidates, (prompt_prefix, prompt_suffix, candidates)
+                # Backends without a candidate_count option send one request per candidate.
+                requests = model.candidate_requests(candidates)
+            else:
+                generate, prompt = model.generate_streamed if stream else model.generate_with_prefix, (prompt_prefix, prompt_suffix)
+                requests = 1
+            response = rate_limiter.call(
+                telemetry.timed(generate),
+                *prompt,
+                generation_config=generation_config,
+                estimated_tokens=requests * sent_prompt_tokens + candidates * generation_config["max_output_tokens"],
+                requests=requests
+            )
+            telemetry.record_usage(complaint, diagnosis_tag, response)
+            if stream:
+                telemetry.record_stream(response)
+            return response
+
+        response = hedge_policy.call(call_model) if hedge_policy is not None else call_model()
+
+        # Validate the model's response:
+        # Ensure the response object exists, has a 'text' attribute, and the text is not empty.
+        if not response or not hasattr(response, 'text') or not response.text:
+            logger.info("❌ Invalid or empty response from model", extra={**log, "reason": REASON_EMPTY_RESPONSE})
+            outcome["failure"] = {"reason": REASON_EMPTY_RESPONSE, "detail": None}
+        elif stream and response.hit_token_limit:
+            # Truncated by the token limit: a repaired case would be silently incomplete.
+            detail = f"Stopped at max_output_tokens={generation_config['max_output_tokens']} after {len(response.text)} characters"
+            logger.info(f"❌ {detail}", extra={**log, "reason": REASON_MAX_TOKENS})
+            outcome["failure"] = {"reason": REASON_MAX_TOKENS, "detail": detail}
+            outcome["truncated_text"] = response.text
+        else:
+            outcome["text"] = response.text
+            if candidates > 1:
+                outcome["candidates"] = response.texts
+    except Exception as e: # Catches errors from model.generate_content() or initial response handling.
+        logger.info(f"❌ Error generating content: {type(e).__name__}: {str(e)}",
+                    extra={**log, "reason": REASON_MODEL_ERROR, "exception_type": type(e).__name__})
+        outcome["failure"] = {"reason": REASON_MODEL_ERROR, "detail": f"{type(e).__name__}: {str(e)}"}
+        # Back off exponentially (with jitter) before retrying this differential.
+        outcome["retry_delay"] = backoff_delay(attempts)
+    return outcome
+
+def record_attempt(complaint, differential, diagnosis_tag, outcome, extracted, attempts, output_dir="artefacts",
+                   prompt_prefix=None, alternates_writer=None):
+    """
+    Save the outcome of one attempt (the writer stage of the pipeline).
+
+    `extracted` is extract_case() of the response text (extract_candidates() of
+    the candidates for a multi-candidate call, see record_candidates), or None if
+    the call failed. Returns the same dict as process_response_text.
+    """
+    telemetry = get_telemetry()
+    if outcome["text"] is None:
+        if outcome.get("truncated_text"):
+            raw_ref = get_artefact_store(output_dir).put(KIND_RAW_RESPONSE, complaint, differential, attempts,
+                                                         outcome["truncated_text"])
+            logger.debug(f"📝 Saved truncated response to {raw_ref}", extra={"attempt": attempts, "raw_ref": raw_ref})
+        if outcome["failure"]["reason"] == REASON_EMPTY_RESPONSE and prompt_prefix is not None:
+            # Save the prompt that led to the empty/invalid response for debugging.
+            # Prefix and suffix are stored separately so the shared prefix is kept only once.
+            prompt_ref = get_artefact_store(output_dir).put(KIND_DEBUG_PROMPT, complaint, differential, attempts,
+                                                            prompt_prefix.text, outcome["prompt_suffix"])
+            logger.debug(f"📝 Saved problematic prompt to {prompt_ref}", extra={"attempt": attempts})
+        telemetry.record_failure(outcome["failure"]["reason"])
+        return {"case": None, "output_path": None, "failure": outcome["failure"]}
+    if outcome.get("candidates") is not None:
+        return record_candidates(complaint, differential, diagnosis_tag, outcome["candidates"], extracted, attempts,
+                                 output_dir, alternates_writer)
+    processed = save_extracted_case(complaint, differential, diagnosis_tag, outcome["text"], extracted, attempts, output_dir)
+    if processed["failure"] is not None:
+        telemetry.record_failure(processed["failure"]["reason"])
+    return processed
+
+def record_candidates(complaint, differential, diagnosis_tag, texts, extracted, attempts, output_dir="artefacts",
+                      alternates_writer=None):
+    """
+    Save a multi-candidate attempt, keeping the first valid candidate as the case.
+
+    `extracted` is extract_candidates() of `texts`. The kept candidate (or, if
+    none is valid, the first non-empty one, for its failure reason) is saved by
+    save_extracted_case() like a single response; the other valid candidates
+    are appended to `alternates_writer` if given. Returns the same dict as
+    process_response_text.
+    """
+    telemetry = get_telemetry()
+    valid = [index for index, result in enumerate(extracted) if result is not None and result["error"] is None]
+    kept = valid[0] if valid else next(index for index, text in enumerate(texts) if text)
+    for index, result in enumerate(extracted):
+        if index == kept:
+            continue
+        if result is None:
+            telemetry.record_candidate("empty")
+        else:
+            telemetry.record_extraction(result)
+            telemetry.record_candidate("alternate" if index in valid else "rejected")
+    processed = save_extracted_case(complaint, differential, diagnosis_tag, texts[kept], extracted[kept], attempts, output_dir)
+    if processed["failure"] is not None:
+        telemetry.record_candidate("rejected")
+        telemetry.record_failure(processed["failure"]["reason"])
+        return processed
+    telemetry.record_candidate("kept")
+    if len(valid) > 1:
+        logger.debug(f"🎯 Kept candidate {kept + 1} of {len(texts)}; {len(valid) - 1} other valid candidate(s)",
+                     extra={"attempt": attempts})
+    if alternates_writer is not None:
+        for index in valid[1:]:
+            alternates_writer.write({
+                "intended_complaint_category": complaint,
+                "differential": differential,
+                "attempt": attempts,
+                "candidate": index,
+                "ai_presenting_complaint": extracted[index]["presenting_complaint"],
+                "content": {**extracted[index]["case"], "tag": diagnosis_tag},
+            })
+    return processed
+
+def generate_case_for_differential(complaint, differential, diagnosis_tag, output_dir="artefacts", rate_limiter=None, model=model,
+                                   prompt_prefix=None, generation_config=GENERATION_CONFIG, stream=False, hedge_policy=None,
+                                   candidates=1, alternates_writer=None, compact_prompt=False):
+    """
+    Run the attempt loop for a single (complaint, differential) job in the calling thread.
+
+    generate_cases_from_differentials runs the same steps as pipeline stages
+    (request_case, extract_case, record_attempt); this is the sequential form
+    for generating one differential. Failures are not logged here; the reason the
+    last attempt failed is returned in "failure" for the caller's FailureLedger.
+    Model calls to `model` go through `rate_limiter`, which may be shared by several callers.
+    `prompt_prefix` is the run's CachedPrefix handle (see model_backends.cache_prefix);
+    only the per-differential suffix is sent when the backend has cached it. By
+    default the prefix is empty and the whole prompts.PROMPT_TEMPLATE prompt
+    (with the compact exemplar if `compact_prompt`) is sent.
+    `generation_config` defaults to GENERATION_CONFIG (see case_schema.structured_output_config
+    for JSON mode). `stream` streams each response, `hedge_policy` hedges slow
+    calls and `candidates` asks for several candidates per call (see request_case);
+    other valid candidates go to `alternates_writer` (see record_candidates).
+
+    Returns a dict with:
+        "case": the all_cases entry for the generated case, or None on failure
+        "failure": {"reason", "detail"} for the last failed attempt if no case was generated, else None
+        "attempts": number of attempts made
+        "output_path": path of the saved case JSON file, or None on failure
+    """
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE)
+    if prompt_prefix is None:
+        prompt_prefix = CachedPrefix(build_prompt_prefix(compact_prompt))
+
+    logger.debug(f"🔍 Generating case for: {differential}")
+
+    result = {"case": None, "output_path": None, "failure": None}
+    attempts = 0
+    while result["case"] is None and attempts < MAX_BATCH_ATTEMPTS:
+        attempts += 1
+        outcome = request_case(complaint, differential, diagnosis_tag, attempts, rate_limiter, model, prompt_prefix,
+                               generation_config, stream, hedge_policy, candidates, compact_prompt)
+        extracted = None
+        if outcome.get("candidates") is not None:
+            extracted = extract_candidates(outcome["candidates"], validate_specific_key_nesting)
+        elif outcome["text"] is not None:
+            extracted = extract_case(outcome["text"], validate_specific_key_nesting)
+        result = record_attempt(complaint, differential, diagnosis_tag, outcome, extracted, attempts, output_dir, prompt_prefix,
+                                alternates_writer)
+        if result["case"] is None and outcome["retry_delay"] and attempts < MAX_BATCH_ATTEMPTS:
+            time.sleep(outcome["retry_delay"])
+
+    finish_job(diagnosis_tag, result, attempts)
+    result["attempts"] = attempts
+    return result
+
+def finish_job(diagnosis_tag, result, attempts):
+    """Log and count a differential whose attempts are finished."""
+    if result["case"] is None:
+        # If, after all MAX_BATCH_ATTEMPTS, no valid case was generated for this differential.
+        logger.warning(f"⚠️ Failed to generate case after {attempts} attempts",
+                       extra={"attempts": attempts, "reason": result["failure"]["reason"] if result["failure"] else None})
+    get_telemetry().record_job(diagnosis_tag, attempts, result["case"] is not None)
+
+def load_completed_case(complaint, differential, manifest_record):
+    """Rebuild the all_cases entry for a differential completed in an earlier run from its saved JSON file."""
+    with open(manifest_record["output_path"], 'r', encoding='utf-8') as f:
+        tagged_case_content = json.load(f)
+    return {
+        "intended_complaint_category": complaint,
+        "ai_presenting_complaint": manifest_record.get("presenting_complaint"),
+        "content_to_write": tagged_case_content,
+        "diagnosis_category": tagged_case_content.get("tag", "Unknown")
+    }
 
 # Generate cases for each differential diagnosis
-def generate_cases_from_differentials(max_cases_per_complaint=0, specific_complaints=None):
+def generate_cases_from_differentials(max_cases_per_complaint=0, specific_complaints=None, concurrency=1,
+                                      requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                                      tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE, resume=True, model=model,
+                                      prompt_cache=False, compact_prompt=False, batch_submitter=None, json_mode=False,
+                                      response_schema=False, metrics_path=None, prometheus_path=None,
+                                      parse_workers=DEFAULT_PARSE_WORKERS, stream=False, output_dir="artefacts",
+                                      hedge_budget=0, hedge_percentile=DEFAULT_HEDGE_PERCENTILE, candidates=1,
+                                      store_alternates=False, catalogue_cache=True):
+    """
+    Generate one case per differential for the selected complaints.
+
+    Model calls (`concurrency` threads), parsing and validation
+    (`parse_workers` processes; 0 parses in the writer thread) and saving run
+    as pipeline stages (see pipeline.py). With `stream` responses are streamed
+    and read only up to the end of the JSON object (see request_case).
+    With `hedge_budget` > 0, up to that many calls that run past the
+    `hedge_percentile` latency of the run so far are hedged (see hedging.py).
+    With `candidates` > 1 each call asks for that many candidates and keeps
+    the first valid one; `store_alternates` appends the other valid ones to
+    <output_dir>/alternates.jsonl.
+    With `batch_submitter` set, all prompts are submitted as a single batch
+    job (see batch_generation.py) instead of the interactive attempt loop.
+    `json_mode` asks for JSON-only output and `response_schema` also passes the
+    schema derived from case_schema.CASE_SCHEMA. `catalogue_cache` False
+    parses the diagnoses file without its on-disk cache (see catalogue.py).
+    Cases are streamed to <output_dir>/<complaint>_all_cases.jsonl and
+    <output_dir>/all_cases.jsonl as they validate; returns the number written.
+    Run metrics (see telemetry.py) go to `metrics_path` (default
+    artefacts/run_metrics.json, plus a .csv) and, if set, `prometheus_path`.
+    """
+    if candidates > 1 and stream:
+        raise ValueError("Several candidates per call cannot be combined with streaming")
+
     # Load all differentials
-    differentials_by_complaint, diagnosis_categories_by_complaint = load_differential_diagnoses()
+    differentials_by_complaint, diagnosis_categories_by_complaint = load_differential_diagnoses(use_cache=catalogue_cache)
     
     # Determine which complaints to process based on priority:
     # 1. CLI (--complaints argument)
@@ -550,14 +574,13 @@ def generate_cases_from_differentials(max_cases_per_complaint=0, specific_compla
 
     if final_complaints_list:
         filtered_differentials = {}
+        catalogue = get_catalogue(DEFAULT_DIAGNOSES_PATH, catalogue_cache)
         for complaint_name_to_find in final_complaints_list:
-            found_match = False
-            for existing_complaint_key in differentials_by_complaint.keys():
-                if complaint_name_to_find.lower() in existing_complaint_key.lower():
-                    filtered_differentials[existing_complaint_key] = differentials_by_complaint[existing_complaint_key]
-                    print(f"  ✓ Matched complaint: '{existing_complaint_key}' for target '{complaint_name_to_find}'")
-                    found_match = True
-            if not found_match:
+            matches = [c for c in catalogue.match_complaints(complaint_name_to_find) if c in differentials_by_complaint]
+            for existing_complaint_key in matches:
+                filtered_differentials[existing_complaint_key] = differentials_by_complaint[existing_complaint_key]
+                print(f"  ✓ Matched complaint: '{existing_complaint_key}' for target '{complaint_name_to_find}'")
+            if not matches:
                 print(f"  ⚠️ No match found in loaded differentials for target complaint: '{complaint_name_to_find}' (from {complaints_to_process_source})")
         
         if not filtered_differentials:
@@ -571,449 +594,238 @@ def generate_cases_from_differentials(max_cases_per_complaint=0, specific_compla
         print("ℹ️ Processing all available complaints from 'tables_list' directory.")
             
     # Create output directory if it doesn't exist
-    output_dir = "artefacts"
     os.makedirs(output_dir, exist_ok=True)
     
-    # Track all generated cases
-    all_cases = []
-
-    def log_failed_case(complaint_name, differential_name):
-        """Helper function to log a failed differential immediately to its complaint-specific file."""
-        try:
-            # Construct path to complaint-specific directory
-            # Ensure sanitize_filename is available or define/import it if not in scope
-            # For this edit, assuming sanitize_filename is accessible as it's used elsewhere
-            current_complaint_dir = os.path.join("artefacts", sanitize_filename(complaint_name))
-            # Ensure this directory exists (it should have been created in the main loop for the complaint)
-            os.makedirs(current_complaint_dir, exist_ok=True)
-
-            complaint_failed_log_path = os.path.join(current_complaint_dir, "failed_differentials.jsonl")
-
-            with jsonlines.open(complaint_failed_log_path, mode='a') as writer: # Append mode
-                writer.write(differential_name) # Write just the name of the differential
-            print(f"📝 Logged failed differential '{differential_name}' for complaint '{complaint_name}' to {complaint_failed_log_path}")
-        except Exception as e:
-            print(f"❌ Error logging failed differential for {complaint_name} - {differential_name}: {str(e)}")
-
-    # Maximum number of batch attempts per differential
-    MAX_BATCH_ATTEMPTS = 3
-    
-    # For each presenting complaint
+    # Cases are streamed to the per-complaint and global JSONL files as they arrive
+    # instead of being held in memory until the end of the run.
+    case_sink = CaseSink(output_dir, lambda complaint: f"{sanitize_filename(complaint)}_all_cases.jsonl")
+
+    # Durable record of finished jobs; lets a restarted run skip completed differentials.
+    manifest_path = os.path.join(output_dir, DEFAULT_MANIFEST_FILENAME)
+    if not resume and os.path.exists(manifest_path):
+        print(f"ℹ️ --no-resume given: ignoring existing run manifest {manifest_path}")
+        os.remove(manifest_path)
+    manifest = RunManifest(manifest_path)
+    if len(manifest):
+        print(f"ℹ️ Resuming from run manifest {manifest_path} ({len(manifest)} recorded jobs)")
+
+    # Build the work plan up front: (complaint, differentials to process) in file order.
+    plan = []
     for complaint, differentials in differentials_by_complaint.items():
-        print(f"\n🩺 Processing presenting complaint: {complaint}")
-        print(f"📋 Found {len(differentials)} differential diagnoses")
-        
-        # Create a separate folder for each complaint
-        complaint_dir = os.path.join(output_dir, sanitize_filename(complaint))
-        os.makedirs(complaint_dir, exist_ok=True)
-        
-        # Track generated diagnoses to avoid duplicates
-        generated_diagnoses = set()
+        # Track planned diagnoses to avoid duplicates
+        planned_diagnoses = set()
         
         # Determine the number of differentials to process
         if max_cases_per_complaint == 0:  # 0 means process all available differentials
             differentials_to_process = differentials
-            print(f"⚙️ Processing all {len(differentials_to_process)} differentials for this complaint.")
         else:
             differentials_to_process = differentials[:max_cases_per_complaint]
-            print(f"⚙️ Processing up to {max_cases_per_complaint} differentials (found {len(differentials_to_process)} of {len(differentials)} total for this complaint).")
-        
-        # Generate a case for each differential diagnosis
+
+        unique_differentials = []
         for differential in differentials_to_process:
-            # Skip if we've already generated a case for this diagnosis
-            if differential in generated_diagnoses:
-                print(f"⏩ Skipping {differential} - already generated")
+            # Skip if we've already planned a case for this diagnosis
+            if differential in planned_diagnoses:
+                logger.debug(f"⏩ Skipping {differential} - already generated", extra={"complaint": complaint})
                 continue
-                
-            print(f"\n🔍 Generating case for: {differential}")
-            
-            # Track attempts for this differential
-            attempts = 0
-            case_generated = False
-            
-            while not case_generated and attempts < MAX_BATCH_ATTEMPTS:
-                attempts += 1
-                print(f"  🌀 Attempt {attempts}/{MAX_BATCH_ATTEMPTS}")
-                
-                # Create prompt for this differential
-                prompt = f"""
-
-                
-You are a clinical assistant generating synthetic training data of medical cases. Your output will be parsed as JSON, so **valid JSON formatting is critical**.
-
-📌 TASK: Create a detailed medical case about {differential} for a {complaint} complaint.
-
-Include:
-1. **Pertinent positive AND negative findings** in:
-   - History (e.g. denies urinary symptoms, no past abdominal surgery)
-   - Examination (e.g. no focal neurology, no hepatosplenomegaly)
-   - Investigations (e.g. normal ECG, negative troponin, normal lipase)
-
-   EXTREMELY IMPORTANT INSTRUCTIONS:
-1. Return ONLY a valid JSON object, nothing else.
-2. Do NOT include ```json or ``` tags around your output.
-3. Make sure all strings are enclosed in double quotes, not single quotes.
-4. Do NOT add any comments or extra text before or after the JSON.
-5. Ensure EVERY string is properly closed with a matching quote.
-6. Make sure your JSON is valid and can be parsed by standard JSON parsers.
-7. Use the EXACT field names shown in the example below.
-
-2. These findings should help **narrow the differential diagnosis** — by ruling out common or dangerous alternatives.
-
-3. All investigations ordered should be **relevant to the presenting complaint** and help confirm the diagnosis of {differential}, or rule out other differentials.
-
-For this case, create a realistic presentation with an adequate amount of medical uncertainty that would lead to a diagnosis of {differential}.
-
-**Refrain from including pathognomonic signs of diseases in the case**
-
-**Refrain from creating history and exam findings that are too obvious**
-
-ESPECIALLY in the history, make it less obvious. Make the symptoms of the correct diagnosis less classical. 
-
-**Reduce the number of typical symptoms and signs**.
-
-Make the diagnostic process difficult.
-
-Difficulty can be increased in cases in the form of **more diagnostically complicated (e.g. red herrings, findings or investigations that don't fit typically into the case)**, **less typical symptoms/signs**, **subtle or absent signs**.
-
-Please generate a detailed and realistic OSCE-style medical case that focuses on {differential} as the correct diagnosis.
-
-Return only valid JSON. No explanation text before or after the JSON object. 
-
-Use the EXACT field names and EXACT ORDER AND EXACT STRUCTURE as shown below. 
-
-Provide the diagnosis only at the end of the case.
-Example format:
-{example_json_format}
-
-"""
-
-                # This outer try-except block catches errors during the model call itself
-                # or fundamental issues with the response object.
-                try:
-                    print("\n📝 Sending prompt to model...")
-                    
-                    response = model.generate_content(
-                        prompt,
-                        generation_config={
-                            "temperature": 1.0,
-                            "max_output_tokens": 8000,
-                            "top_k": 40,
-                            "top_p": 0.8,
-                        }
-                    )
-                    
-                    # Validate the model's response:
-                    # Ensure the response object exists, has a 'text' attribute, and the text is not empty.
-                    if not response or not hasattr(response, 'text') or not response.text:
-                        print("❌ Invalid or empty response from model")
-                        # Save the prompt that led to the empty/invalid response for debugging.
-                        prompt_dir = os.path.join(output_dir, "debug_prompts")
-                        os.makedirs(prompt_dir, exist_ok=True)
-                        prompt_filename = f"{sanitize_filename(complaint)}__{sanitize_filename(differential)}_attempt{attempts}.txt"
-                        prompt_filepath = os.path.join(prompt_dir, prompt_filename)
-                        
-                        with open(prompt_filepath, 'w', encoding='utf-8') as f:
-                            f.write(prompt)
-                        
-                        print(f"📝 Saved problematic prompt to {prompt_filepath}")
-                        continue # Move to the next attempt for this differential.
-                    
-                    response_text = response.text
-                    print(f"📄 Raw response length: {len(response_text)} characters")
-                    # Print first 100 characters of response for debugging, removing newlines for cleaner log output.
-                    print(f"📄 Response begins with: {response_text[:100].replace(chr(10), '').replace(chr(13), '')}...")
-                    
-                    # Save the complete raw response from the model to a file.
-                    # This is useful for inspecting exactly what the model returned before any processing.
-                    raw_dir = os.path.join(output_dir, "raw_responses")
-                    os.makedirs(raw_dir, exist_ok=True)
-                    raw_filename = f"{sanitize_filename(complaint)}__{sanitize_filename(differential)}_attempt{attempts}.txt"
-                    raw_filepath = os.path.join(raw_dir, raw_filename)
-                    
-                    with open(raw_filepath, 'w', encoding='utf-8') as f:
-                        f.write(response_text)
-                    
-                    print(f"📝 Saved raw response to {raw_filepath}")
-                    
-                    # --- Start of JSON Cleaning Steps ---
-                    # These steps attempt to pre-process the raw text to make it more likely to be valid JSON.
-                    cleaned_text = response_text
-                    print("🧹 Cleaning response...")
-                    
-                    # Remove markdown code block fences (e.g., ```json ... ``` or ``` ... ```).
-                    # The model sometimes wraps its JSON output in these fences.
-                    # Using re.DOTALL allows .*? to match across multiple lines.
-                    markdown_match = re.search(r"^\\s*```(?:json)?\\s*\\n?(.*?)\\n?\\s*```\\s*$", response_text, re.DOTALL)
-                    if markdown_match:
-                        cleaned_text = markdown_match.group(1) # Extract content within the fences.
-                        print("  ✓ Removed markdown code block using regex")
-                    else:
-                        # Fallback: If regex doesn't match, try simple prefix/suffix removal.
-                        # This handles cases where the model might output, e.g., ```json ... (and forgets closing ```).
-                        if response_text.startswith("```json"):
-                            cleaned_text = response_text[len("```json"):]
-                            if cleaned_text.startswith("\\n"): # Remove potential leading newline
-                                cleaned_text = cleaned_text[1:]
-                            print("  ✓ Removed ```json prefix (fallback)")
-                        elif response_text.startswith("```"):
-                            cleaned_text = response_text[len("```"):]
-                            if cleaned_text.startswith("\\n"): # Remove potential leading newline
-                                cleaned_text = cleaned_text[1:]
-                            print("  ✓ Removed ``` prefix (fallback)")
-
-                        # Always try to remove a trailing ``` if it exists and wasn't caught by the regex.
-                        if cleaned_text.endswith("```"):
-                            cleaned_text = cleaned_text[:-len("```")]
-                            if cleaned_text.endswith("\\n"): # Remove potential trailing newline
-                                cleaned_text = cleaned_text[:-1]
-                            print("  ✓ Removed ``` suffix (fallback)")
-                    
-                    # Remove any leading or trailing whitespace that might remain or was outside fences.
-                    original_length = len(cleaned_text)
-                    cleaned_text = cleaned_text.strip()
-                    if len(cleaned_text) != original_length:
-                        print(f"  ✓ Stripped leading/trailing whitespace ({original_length - len(cleaned_text)} chars)")
-
-                    # Attempt to fix common truncation issues before formal parsing.
-                    # Check for imbalanced curly braces (often indicates a truncated JSON object).
-                    open_braces = cleaned_text.count('{')
-                    close_braces = cleaned_text.count('}')
-                    
-                    if open_braces != close_braces:
-                        print(f"⚠️ Detected potential truncation: {open_braces} opening braces, {close_braces} closing braces")
-                        if open_braces > close_braces:
-                            # If truncated, append the missing closing braces.
-                            cleaned_text += "}" * (open_braces - close_braces)
-                            print(f"🔧 Added {open_braces - close_braces} closing braces to fix truncation")
-                    
-                    # Check for a string value that appears truncated at the very end of the JSON.
-                    # Example: "key": "value without closing quote
-                    string_pattern = r'"([^"]+)"\\s*:\\s*"([^"]+)$'
-                    if re.search(string_pattern, cleaned_text):
-                        print("⚠️ Detected truncated string value at the end of JSON")
-                        # Append a closing double quote to fix the truncated string.
-                        cleaned_text += '"'
-                        print("🔧 Added closing quote to fix truncated string")
-                    # --- End of initial pre-parsing JSON Cleaning Steps ---
-
-                    # Attempt to parse the cleaned text as JSON.
-                    # This is the first attempt using the standard json.loads().
-                    try:
-                        parsed_full_case = json.loads(cleaned_text)
-                        
-                        # If the model returns a list (e.g., `[{...}]`) instead of a single object,
-                        # and it contains exactly one element, extract that element.
-                        if isinstance(parsed_full_case, list) and len(parsed_full_case) == 1:
-                            print("ℹ️ Model returned an array, extracting the first object.")
-                            parsed_full_case = parsed_full_case[0]
-                        elif isinstance(parsed_full_case, list):
-                            # If it's a list with multiple elements, it's not the expected format.
-                            print(f"❌ Expected a JSON object, but got an array with {len(parsed_full_case)} elements after initial parse.")
-                            continue # To next attempt for this differential.
-                            
-                        # Ensure the parsed result is a dictionary (JSON object) as expected.
-                        if not isinstance(parsed_full_case, dict):
-                            print(f"❌ Expected a JSON object after initial parse, but got type {type(parsed_full_case)}.")
-                            continue # To next attempt.
-                        
-                        # Validate presence and type of critical top-level keys.
-                        original_complaint_value = parsed_full_case.get("Presenting complaint")
-                        if not original_complaint_value or not isinstance(original_complaint_value, str):
-                            print("❌ Missing, empty, or invalid type for 'Presenting complaint' in initial parse.")
-                            continue # To next attempt.
-                            
-                        actual_case_content = parsed_full_case.get("case")
-                        if not isinstance(actual_case_content, dict):
-                            print("❌ Missing, empty, or incorrect type for field: 'case' (must be an object) in initial parse.")
-                            continue # To next attempt.
-                        
-                        # Perform specific key nesting validation on the extracted 'case' content.
-                        # This function (validate_specific_key_nesting) ensures that the critical
-                        # diagnostic path (OSCE_Examination -> ... -> Correct_Diagnosis) exists.
-                        validation_passed, validation_msg = validate_specific_key_nesting(actual_case_content)
-                        
-                        if not validation_passed:
-                            # If the required nested structure is not found, log the failure and try next attempt.
-                            print(f"❌ Specific key nesting validation failed for {complaint} - {differential}: {validation_msg}")
-                            log_failed_case(complaint, differential)
-                            continue # To next attempt.
-                        else:
-                            print(f"✅ {validation_msg}")
-
-                        # --- JSON Parsing and Validation Successful (First Attempt) ---
-                        # If all checks pass, the case is considered successfully generated.
-                        
-                        generated_diagnoses.add(differential) # Track to avoid duplicates for this complaint.
-                        
-                        # Get the diagnosis category (tag)
-                        diagnosis_tag = diagnosis_categories_by_complaint.get(complaint, {}).get(differential, "Unknown")
-                        
-                        # Add tag field to the case content
-                        tagged_case_content = copy.deepcopy(actual_case_content)
-                        tagged_case_content["tag"] = diagnosis_tag
-                        
-                        all_cases.append({ # Add to the list of all successfully generated cases.
-                            "intended_complaint_category": complaint, # Store the category it was generated for
-                            "ai_presenting_complaint": original_complaint_value, # Keep AI's version
-                            "content_to_write": tagged_case_content, # Store the case object for output with tag
-                            "diagnosis_category": diagnosis_tag
-                        })
-                        
-                        # Save the successfully parsed and validated 'case' object to its own JSON file.
-                        case_filename = f"{sanitize_filename(differential)}.json"
-                        case_filepath = os.path.join(complaint_dir, case_filename)
-                        
-                        with open(case_filepath, 'w', encoding='utf-8') as f:
-                            json.dump(tagged_case_content, f, indent=2, ensure_ascii=False)
-                            
-                        print(f"✅ Generated and saved case for {differential} (extracted content only)")
-                        case_generated = True # Flag that this differential is done, exit the while loop.
-                        
-                    except json.JSONDecodeError as e: # This block executes if json.loads(cleaned_text) fails.
-                        print(f"❌ JSON parse error: {str(e)}")
-                        # Show the problematic character and its context if position is available.
-                        if hasattr(e, 'pos'):
-                            error_context_start = max(0, e.pos - 30)
-                            error_context_end = min(len(cleaned_text), e.pos + 30)
-                            error_context = cleaned_text[error_context_start:error_context_end]
-                            print(f"  Problem near: '...{error_context}...'")
-                            print(f"  Error position: {e.pos}")
-                        
-                        print("🔧 Attempting to fix JSON using json-repair library...")
-                        
-                        # Second attempt at parsing, this time using the `json_repair` library,
-                        # which is more tolerant of common JSON errors.
-                        try:
-                            # `json_repair` attempts to fix and parse the string directly into Python objects.
-                            repaired_full_case = json_repair(cleaned_text, return_objects=True)
-                            print("✅ Fixed JSON parsed successfully by json-repair!")
-                            
-                            # Similar to the first parsing attempt, handle if the repaired output is an array.
-                            if isinstance(repaired_full_case, list) and len(repaired_full_case) == 1:
-                                print("ℹ️ Repaired JSON was an array, extracting the first object.")
-                                repaired_full_case = repaired_full_case[0]
-                            elif isinstance(repaired_full_case, list):
-                                print(f"❌ Repaired JSON was an array with {len(repaired_full_case)} elements. Skipping this attempt.")
-                                continue # To next attempt for this differential.
-                                
-                            # Ensure the repaired result is a dictionary.
-                            if not isinstance(repaired_full_case, dict):
-                                print(f"❌ Repaired JSON is not an object, but type {type(repaired_full_case)}. Skipping this attempt.")
-                                continue # To next attempt.
-
-                            # Validate critical top-level keys in the repaired JSON.
-                            original_complaint_value_repaired = repaired_full_case.get("Presenting complaint")
-                            if not original_complaint_value_repaired or not isinstance(original_complaint_value_repaired, str):
-                                print(f"❌ Repaired JSON is missing, empty, or invalid type for 'Presenting complaint'. Skipping this attempt.")
-                                continue # To next attempt.
-                                
-                            actual_case_content_repaired = repaired_full_case.get("case")
-                            if not isinstance(actual_case_content_repaired, dict):
-                                print(f"❌ Repaired JSON is missing, empty, or incorrect type for field: 'case' (must be an object). Skipping this attempt.")
-                                continue # To next attempt.
-
-                            # Perform specific key nesting validation on the 'case' content from the repaired JSON.
-                            validation_passed_repaired, validation_msg_repaired = validate_specific_key_nesting(actual_case_content_repaired)
-
-                            if not validation_passed_repaired:
-                                # If validation fails even after repair, log and try next attempt.
-                                print(f"❌ Specific key nesting validation failed for REPAIRED {complaint} - {differential}: {validation_msg_repaired}")
-                                log_failed_case(complaint, differential)
-                                continue # To next attempt.
-                            else:
-                                print(f"✅ {validation_msg_repaired} (repaired JSON)")
-
-                            # --- JSON Repair and Validation Successful ---
-
-                            # For debugging, save the full JSON object *as returned by json_repair* before extracting the 'case'.
-                            fixed_dir = os.path.join(output_dir, "fixed_json_originals") 
-                            os.makedirs(fixed_dir, exist_ok=True)
-                            fixed_filename = f"{sanitize_filename(complaint)}__{sanitize_filename(differential)}_attempt{attempts}_repaired_original.json"
-                            fixed_filepath = os.path.join(fixed_dir, fixed_filename)
-                            
-                            with open(fixed_filepath, 'w', encoding='utf-8') as f:
-                                json.dump(repaired_full_case, f, indent=2, ensure_ascii=False)
-                                
-                            print(f"📝 Saved *original* repaired JSON (before extraction) to {fixed_filepath}")
-                            
-                            # Get the diagnosis category (tag)
-                            diagnosis_tag = diagnosis_categories_by_complaint.get(complaint, {}).get(differential, "Unknown")
-                            
-                            # Add tag field to the case content
-                            tagged_case_content_repaired = copy.deepcopy(actual_case_content_repaired)
-                            tagged_case_content_repaired["tag"] = diagnosis_tag
-                            
-                            # Add to generated diagnoses and all_cases list.
-                            generated_diagnoses.add(differential)
-                            all_cases.append({
-                                "intended_complaint_category": complaint, # Store the category it was generated for
-                                "ai_presenting_complaint": original_complaint_value_repaired, # Keep AI's version
-                                "content_to_write": tagged_case_content_repaired,
-                                "diagnosis_category": diagnosis_tag
-                            })
-                            
-                            # Save the successfully repaired and validated 'case' object to its JSON file.
-                            case_filename = f"{sanitize_filename(differential)}.json"
-                            case_filepath = os.path.join(complaint_dir, case_filename)
-                            with open(case_filepath, 'w', encoding='utf-8') as f:
-                                json.dump(tagged_case_content_repaired, f, indent=2, ensure_ascii=False)
-                                
-                            print(f"✅ Generated and saved case for {differential} from repaired JSON (extracted content only)")
-                            case_generated = True # Flag successful generation.
-                            # No 'continue' here; processing for this differential is complete.
-
-                        except Exception as e2: # This catches errors from json_repair or subsequent logic.
-                            print(f"❌ Failed to fix JSON with json-repair or process it: {str(e2)}")
-                            # If json-repair itself or subsequent validation fails, this attempt is considered failed.
-                            # The loop will continue to the next attempt for this differential.
-                
-                except Exception as e: # Outer except: Catches errors from model.generate_content() or initial response handling.
-                    print(f"❌ Error generating content: {str(e)}")
-                    print(f"  Exception type: {type(e).__name__}")
-                    
-                    # Add a small delay before retrying to respect potential rate limits or transient issues.
-                    time.sleep(2)
-            
-            # This code executes after all attempts for a single differential diagnosis are exhausted
-            # or if a case was successfully generated (case_generated = True).
-            if not case_generated:
-                # If, after all MAX_BATCH_ATTEMPTS, no valid case was generated for this differential.
-                print(f"⚠️ Failed to generate case for {differential} after {MAX_BATCH_ATTEMPTS} attempts")
-                log_failed_case(complaint, differential)
-        
-        # After processing all differentials for the current presenting complaint:
-        # Save all successfully generated and extracted 'case' objects for this complaint to a single JSONL file.
-        # JSONL (JSON Lines) format is one JSON object per line.
-        complaint_cases_to_write = [
-            item["content_to_write"] for item in all_cases
-            # Filter all_cases to include only those generated for the current complaint category.
-            if item["intended_complaint_category"].lower() == complaint.lower()
-        ]
-        jsonl_filename = f"{sanitize_filename(complaint)}_all_cases.jsonl"
-        jsonl_filepath = os.path.join(output_dir, jsonl_filename) # Saved in the main output_dir, not complaint specific subdir.
-        
-        if complaint_cases_to_write: # Only write the file if there are cases for this complaint.
-            with jsonlines.open(jsonl_filepath, mode='w') as writer:
-                for case_content_item in complaint_cases_to_write:
-                    writer.write(case_content_item)
-            print(f"✅ Saved {len(complaint_cases_to_write)} extracted cases for {complaint} to {jsonl_filepath}")
+            planned_diagnoses.add(differential)
+            # Completed in an earlier run: reuse the saved case instead of regenerating it.
+            unique_differentials.append((differential, manifest.completed_record(complaint, differential)))
+        plan.append((complaint, len(differentials), unique_differentials))
+
+    if concurrency > 1:
+        print(f"⚙️ Running up to {concurrency} differentials concurrently.")
+    if batch_submitter is None and parse_workers:
+        print(f"⚙️ Parsing and validating responses in {parse_workers} worker process(es).")
+
+    # Construct the model client now (no test prompt) so configuration errors stop the run
+    # immediately instead of failing every attempt of every differential.
+    if hasattr(model, "get"):
+        try:
+            model.get()
+            print("✅ Model initialized successfully")
+        except Exception as e:
+            print(f"❌ Error initializing model: {str(e)}")
+            return 0
+
+    # Build the static prompt prefix once; with prompt_cache the backend keeps it server-side.
+    # Without prompt_cache the prefix is empty and each call sends the whole default prompt.
+    prefix_text = build_prompt_prefix(compact_prompt, split=prompt_cache)
+    prompt_prefix = model.cache_prefix(prefix_text) if prompt_cache else CachedPrefix(prefix_text)
+
+    generation_config = structured_output_config(GENERATION_CONFIG, json_mode, response_schema)
+    generation_mode = generation_mode_name(json_mode, response_schema)
+    if generation_mode != "text":
+        print(f"ℹ️ Generation mode: {generation_mode}")
+
+    # One limiter shared by every worker so the budgets apply to the whole run.
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    hedge_policy = HedgePolicy(hedge_budget, hedge_percentile) if hedge_budget > 0 else None
+    alternates_writer = None
+    if candidates > 1:
+        if batch_submitter is not None:
+            print("ℹ️ Batch mode requests one candidate per prompt; --candidates is ignored")
         else:
-            print(f"ℹ️ No cases to write for complaint '{complaint}' to {jsonl_filepath} (either no cases generated or filtering mismatch).")
-
-    # After processing all complaints:
-    # Save all generated cases from *all* complaints to a single global JSONL file.
-    all_cases_filepath = os.path.join(output_dir, "all_cases.jsonl")
-    if all_cases: # Only write if there are any cases at all
-        with jsonlines.open(all_cases_filepath, mode='w') as writer:
-            for item in all_cases:
-                writer.write(item["content_to_write"])
-        print(f"✅ Saved all {len(all_cases)} extracted cases to global {all_cases_filepath}")
+            print(f"ℹ️ Requesting {candidates} candidates per call; the first valid one is kept")
+            if store_alternates:
+                alternates_writer = JsonlAppendWriter(os.path.join(output_dir, DEFAULT_ALTERNATES_FILENAME), mode='a')
+
+    def record_result(complaint, differential, result):
+        if result["case"] is not None:
+            manifest.record(complaint, differential, result["attempts"], STATUS_SUCCEEDED, result["output_path"],
+                            presenting_complaint=result["case"]["ai_presenting_complaint"], generation_mode=generation_mode)
+        else:
+            manifest.record(complaint, differential, result["attempts"], STATUS_FAILED, generation_mode=generation_mode)
+
+    def generate(job):
+        if job["attempts"] == 1:
+            progress.job_started()
+        with job_context(complaint=job["complaint"], differential=job["differential"], attempt=job["attempts"]):
+            if job["attempts"] == 1:
+                logger.debug(f"🔍 Generating case for: {job['differential']}")
+            return request_case(job["complaint"], job["differential"], job["tag"], job["attempts"], rate_limiter, model,
+                                prompt_prefix, generation_config, stream, hedge_policy, candidates, compact_prompt)
+
+    def write(job, outcome, extracted):
+        with job_context(complaint=job["complaint"], differential=job["differential"], attempt=job["attempts"]):
+            return record_attempt(job["complaint"], job["differential"], job["tag"], outcome, extracted, job["attempts"],
+                                  output_dir, prompt_prefix, alternates_writer)
+
+    def on_finished(job, result):
+        with job_context(complaint=job["complaint"], differential=job["differential"]):
+            finish_job(job["tag"], result, job["attempts"])
+        # Recorded by the writer stage so finished work is durable as soon as it is saved.
+        record_result(job["complaint"], job["differential"], result)
+        progress.job_finished(result["case"] is not None)
+
+    def pipelined_results():
+        parse = extract_candidates if candidates > 1 else extract_case
+        pipeline = GenerationPipeline(generate, partial(parse, validator=validate_specific_key_nesting), write,
+                                      on_finished, concurrency, parse_workers, MAX_BATCH_ATTEMPTS)
+        pipeline_jobs = [
+            {"complaint": complaint, "differential": differential,
+             "tag": diagnosis_categories_by_complaint.get(complaint, {}).get(differential, "Unknown")}
+            for complaint, differential in jobs
+        ]
+        for job, result in pipeline.run(pipeline_jobs):
+            yield (job["complaint"], job["differential"]), result
+
+    def process_batch_response(complaint, differential, response_text):
+        diagnosis_tag = diagnosis_categories_by_complaint.get(complaint, {}).get(differential, "Unknown")
+        with job_context(complaint=complaint, differential=differential):
+            return process_response_text(complaint, differential, diagnosis_tag, response_text, 1, output_dir)
+
+    def recorded_batch_results():
+        for (complaint, differential), result in run_batch_jobs(jobs, batch_submitter, process_batch_response, output_dir,
+                                                                 generation_config, compact_prompt):
+            record_result(complaint, differential, result)
+            if result["failure"] is not None:
+                get_telemetry().record_failure(result["failure"]["reason"])
+            get_telemetry().record_job(diagnosis_categories_by_complaint.get(complaint, {}).get(differential, "Unknown"),
+                                       1, result["case"] is not None)
+            progress.job_finished(result["case"] is not None, started=False)
+            yield (complaint, differential), result
+
+    jobs = [
+        (complaint, differential)
+        for complaint, _, differentials in plan
+        for differential, completed in differentials
+        if completed is None
+    ]
+    resumed_count = sum(len(differentials) for _, _, differentials in plan) - len(jobs)
+    if resumed_count:
+        print(f"⏩ Skipping {resumed_count} differentials already completed in a previous run")
+    progress.start(len(jobs))
+    get_telemetry().start()
+    if batch_submitter is not None:
+        results = recorded_batch_results()
+    else:
+        results = pipelined_results()
+
+    # Results come back in plan order, so failure logs and the per-complaint
+    # JSONL files are written in the same order regardless of concurrency.
+    # Failed differentials are batched into each complaint's failed_differentials.jsonl, one entry per differential.
+    failure_ledger = FailureLedger(output_dir)
+    try:
+        attempt_stats = write_results_in_order(plan, results, case_sink, max_cases_per_complaint, output_dir, failure_ledger)
+    finally:
+        # Stops the pipeline stages (or batch ingestion) if writing ended early.
+        results.close()
+        case_sink.close()
+        if alternates_writer is not None:
+            alternates_writer.close()
+        failure_ledger.close()
+        get_artefact_store(output_dir).close()
+        progress.finish()
+    if case_sink.total_cases:
+        print(f"✅ Saved all {case_sink.total_cases} extracted cases to global {case_sink.global_writer.path}")
     else:
-        print(f"ℹ️ No cases generated overall to write to global {all_cases_filepath}.")
+        print(f"ℹ️ No cases generated overall to write to global {case_sink.global_writer.path}.")
             
-    print(f"\n✅ Done! Generated {len(all_cases)} cases across {len(differentials_by_complaint)} presenting complaints.")
-    return all_cases
+    print(f"\n✅ Done! Generated {case_sink.total_cases} cases across {len(differentials_by_complaint)} presenting complaints.")
+    if attempt_stats["accepted"]:
+        print(f"📉 Attempts per accepted case ({generation_mode} mode): {attempt_stats['accepted_attempts'] / attempt_stats['accepted']:.2f}; "
+              f"{attempt_stats['attempts']} attempts in total for {attempt_stats['accepted']} new cases "
+              f"({attempt_stats['attempts'] / attempt_stats['accepted']:.2f} per case, including failed differentials)")
+    if alternates_writer is not None and alternates_writer.count:
+        print(f"🗂️ Saved {alternates_writer.count} alternate cases to {alternates_writer.path}")
+    if batch_submitter is None:
+        limiter_summary = rate_limiter.summary()
+        print(f"📈 Model calls: {limiter_summary['calls']}, rate limited: {limiter_summary['throttled']}, "
+              f"final rate: {limiter_summary['current_requests_per_minute']} RPM, time spent waiting for budget: {limiter_summary['wait_seconds']}s")
+        report_prompt_token_savings(prompt_prefix, exemplar_tokens_saved(compact_prompt))
+    if prompt_cache:
+        model.release_prefix(prompt_prefix)
+    get_telemetry().write_reports(metrics_path or os.path.join(output_dir, DEFAULT_METRICS_FILENAME), prometheus_path)
+    return case_sink.total_cases
+
+def write_results_in_order(plan, results, case_sink, max_cases_per_complaint, output_dir="artefacts", failure_ledger=None):
+    """
+    Consume job results in plan order, recording failures in `failure_ledger` and
+    streaming each case to `case_sink`.
+
+    Returns attempt counts for the newly generated jobs: "accepted" cases, the
+    "accepted_attempts" they took, and "attempts" over all jobs.
+    """
+    attempt_stats = {"accepted": 0, "accepted_attempts": 0, "attempts": 0}
+    for complaint, total_differentials, differentials_to_process in plan:
+        log = {"complaint": complaint}
+        logger.info(f"🩺 Processing presenting complaint: {complaint} ({total_differentials} differential diagnoses)", extra=log)
+        if max_cases_per_complaint == 0:
+            logger.debug(f"⚙️ Processing all {len(differentials_to_process)} differentials for this complaint.", extra=log)
+        else:
+            logger.debug(f"⚙️ Processing up to {max_cases_per_complaint} differentials (found {len(differentials_to_process)} of {total_differentials} total for this complaint).", extra=log)
+
+        # Create a separate folder for each complaint
+        complaint_dir = os.path.join(output_dir, sanitize_filename(complaint))
+        os.makedirs(complaint_dir, exist_ok=True)
+
+        for differential, completed in differentials_to_process:
+            if completed is not None:
+                case_sink.write(complaint, load_completed_case(complaint, differential, completed)["content_to_write"])
+                continue
+            _, result = next(results)
+            if failure_ledger is not None:
+                if result["case"] is None:
+                    failure = result["failure"] or {}
+                    failure_ledger.record(complaint, differential, failure.get("reason"), result["attempts"], failure.get("detail"))
+                else:
+                    failure_ledger.resolve(complaint, differential)
+            attempt_stats["attempts"] += result["attempts"]
+            if result["case"] is not None:
+                attempt_stats["accepted"] += 1
+                attempt_stats["accepted_attempts"] += result["attempts"]
+                case_sink.write(complaint, result["case"]["content_to_write"])
+        
+        # Each case was appended to <complaint>_all_cases.jsonl (one JSON object per line)
+        # as it arrived; closing the file here completes it.
+        jsonl_filepath = case_sink.complaint_path(complaint) # Saved in the main output_dir, not complaint specific subdir.
+        complaint_case_count = case_sink.finish_complaint(complaint)
+        if complaint_case_count:
+            logger.info(f"✅ Saved {complaint_case_count} extracted cases for {complaint} to {jsonl_filepath}",
+                        extra={**log, "cases": complaint_case_count})
+        else:
+            logger.info(f"ℹ️ No cases to write for complaint '{complaint}' to {jsonl_filepath} (no cases generated).", extra=log)
+    return attempt_stats
 
 # Example usage
 if __name__ == "__main__":
@@ -1023,19 +835,87 @@ if __name__ == "__main__":
                         help="Maximum number of cases to generate per complaint. Specify 0 or omit to process all differentials for each complaint (default: 0).")
     parser.add_argument("--complaints", type=str, nargs='+',
                         help="Specific complaints to process (if not specified, all complaints will be processed)")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of differentials to generate concurrently across all complaints (default: 1, sequential).")
+    parser.add_argument("--parse-workers", type=int, default=DEFAULT_PARSE_WORKERS,
+                        help=f"Processes for parsing and validating responses; 0 parses in the writer thread (default: {DEFAULT_PARSE_WORKERS}).")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_REQUESTS_PER_MINUTE,
+                        help=f"Maximum model requests per minute; reduced automatically on 429/503 errors (default: {DEFAULT_REQUESTS_PER_MINUTE}).")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TOKENS_PER_MINUTE,
+                        help="Maximum model tokens per minute (prompt + output). 0 disables the token budget (default: 0).")
+    add_backend_arguments(parser)
+    add_prompt_arguments(parser)
+    add_structured_output_arguments(parser)
+    add_telemetry_arguments(parser)
+    add_logging_arguments(parser)
+    add_hedging_arguments(parser)
+    add_catalogue_arguments(parser)
+    parser.add_argument("--candidates", type=int, default=1,
+                        help="Candidates requested per call (candidate_count, or parallel sub-requests on backends without it); "
+                             "the first valid one is kept (default: 1).")
+    parser.add_argument("--store-alternates", action="store_true",
+                        help=f"With --candidates, append the other valid candidates to artefacts/{DEFAULT_ALTERNATES_FILENAME}.")
+    parser.add_argument("--preflight", action="store_true",
+                        help="Send a short test prompt to the model before starting (one extra billable call).")
+    parser.add_argument("--batch", action="store_true",
+                        help="Submit all prompts as one batch-prediction job instead of calling the model per differential.")
+    parser.add_argument("--batch-gcs-prefix", type=str, default=None,
+                        help="gs:// prefix for batch request/result files (required for --batch with the vertex backend).")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Ignore artefacts/run_manifest.jsonl and regenerate differentials completed by earlier runs.")
     
     args = parser.parse_args()
+    if args.candidates > 1 and args.stream:
+        parser.error("--candidates cannot be combined with --stream")
+    setup_run_logging(args.log_file or os.path.join("artefacts", DEFAULT_LOG_FILENAME), args.verbose)
+    model = model_from_args(args)
     
     if args.max_cases == 0:
         print("🔍 Running with max_cases_per_complaint = 0 (process all differentials for each complaint).")
     else:
         print(f"🔍 Running with max_cases_per_complaint = {args.max_cases}")
     
+    if args.preflight and not preflight_check(model):
+        exit(1)
+
+    batch_submitter = None
+    if args.batch:
+        if args.backend == "vertex":
+            if not args.batch_gcs_prefix:
+                parser.error("--batch with the vertex backend requires --batch-gcs-prefix gs://bucket/path")
+            batch_submitter = VertexBatchSubmitter(args.batch_gcs_prefix, MODEL_ID)
+        else:
+            # Local file-based stand-in for the batch service, answered by the selected backend.
+            batch_submitter = LocalBatchSubmitter(model, args.concurrency)
+
     # No need to print about args.complaints here, it's handled inside generate_cases_from_differentials
     # if args.complaints:
     #     print(f"🔍 Processing only these complaints: {', '.join(args.complaints)}")
     
-    all_generated_cases = generate_cases_from_differentials(
-        max_cases_per_complaint=args.max_cases,
-        specific_complaints=args.complaints
-    )
+    try:
+        generated_case_count = generate_cases_from_differentials(
+            max_cases_per_complaint=args.max_cases,
+            specific_complaints=args.complaints,
+            concurrency=args.concurrency,
+            parse_workers=args.parse_workers,
+            stream=args.stream,
+            hedge_budget=args.hedge_budget,
+            hedge_percentile=args.hedge_percentile,
+            candidates=args.candidates,
+            store_alternates=args.store_alternates,
+            catalogue_cache=not args.no_catalogue_cache,
+            requests_per_minute=args.rpm,
+            tokens_per_minute=args.tpm,
+            resume=not args.no_resume,
+            model=model,
+            prompt_cache=args.prompt_cache,
+            compact_prompt=args.compact_prompt,
+            batch_submitter=batch_submitter,
+            json_mode=args.json_mode,
+            response_schema=args.response_schema,
+            metrics_path=args.metrics_file,
+            prometheus_path=args.prometheus_file
+        )
+    finally:
+        # Flush queued log records before the interpreter exits.
+        shutdown_run_logging()
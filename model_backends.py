@@ -0,0 +1,822 @@
+"""
+Model backends for case generation.
+
+Every backend exposes generate_content(prompt, generation_config=None) and
+returns a response with a `.text` attribute (and `.usage_metadata` where
+available), matching the Vertex AI GenerativeModel interface the scripts
+were written against.
+
+- "vertex": Vertex AI GenerativeModel (the production backend).
+- "stub": a local, deterministic stand-in that either replays recorded raw
+  responses (an artefact store or a directory of *.txt files) or synthesises cases, with configurable
+  latency and failure rates. Use it to benchmark and profile the pipeline's
+  parsing, validation and I/O without network access or spend.
+
+With stream_with_prefix() a backend yields the response in chunks;
+generate_streamed() reads them through an IncrementalJsonScanner and stops as
+soon as the top-level JSON value closes, reporting the finish reason so a
+response cut off at max_output_tokens can be told apart from one that is
+merely malformed. Backends without streaming deliver one chunk.
+
+Static prompt prefixes can be registered with cache_prefix(); callers then
+send only the per-job suffix through generate_with_prefix(). Vertex stores the
+prefix as a context cache where the model and prefix size allow it; the
+stub simulates a cache hit; otherwise the prefix is re-sent on every call.
+
+Clients are built lazily through a factory so importing the generation
+scripts (or running them with --help) does not initialise Vertex AI or make
+any network calls. The billable health check that used to run at import is
+available as preflight_check() behind the scripts' --preflight flag.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from artefact_store import ArtefactStore, KIND_RAW_RESPONSE
+from hedging import DEFAULT_HEDGE_PERCENTILE
+from rate_limiter import estimate_tokens, is_rate_limit_error
+from response_parser import IncrementalJsonScanner
+
+MODEL_ID = "gemini-2.5-pro-preview-03-25"
+VERTEX_LOCATION = "us-central1"
+DEFAULT_BACKEND = "vertex"
+
+# Finish reasons of streamed responses (Vertex AI FinishReason names).
+FINISH_STOP = "STOP"
+FINISH_MAX_TOKENS = "MAX_TOKENS"
+
+
+class CachedPrefix:
+    """
+    Handle for a static prompt prefix registered with a backend.
+
+    `cached_model` is the backend-specific object that already holds the
+    prefix (None if the prefix has to be re-sent with every call). The handle
+    also counts calls and prefix tokens served from the cache for reporting.
+    """
+
+    def __init__(self, text, cached_model=None, resource=None):
+        self.text = text
+        # Empty for the default prompt layout, where the whole prompt is the per-call suffix.
+        self.token_count = estimate_tokens(text) if text else 0
+        self.cached_model = cached_model
+        self.resource = resource
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.cached_tokens = 0
+
+    @property
+    def is_cached(self):
+        return self.cached_model is not None
+
+    def record_call(self, cached_tokens=0):
+        with self._lock:
+            self.calls += 1
+            self.cached_tokens += cached_tokens
+
+
+class StreamChunk:
+    """One piece of a streamed response; the last one carries the finish reason and usage where known."""
+
+    def __init__(self, text, finish_reason=None, usage_metadata=None):
+        self.text = text
+        self.finish_reason = finish_reason
+        self.usage_metadata = usage_metadata
+
+
+class StreamedResponse:
+    """
+    A response read by generate_streamed().
+
+    `complete` is True if the top-level JSON value closed, `stopped_early` if
+    the stream was abandoned at that point, before the backend finished it.
+    `hit_token_limit` means the backend stopped at max_output_tokens before
+    the value closed, i.e. the text is truncated.
+    """
+
+    def __init__(self, text, complete, stopped_early, finish_reason, usage_metadata):
+        self.text = text
+        self.complete = complete
+        self.stopped_early = stopped_early
+        self.finish_reason = finish_reason
+        self.usage_metadata = usage_metadata
+
+    @property
+    def hit_token_limit(self):
+        return self.finish_reason == FINISH_MAX_TOKENS and not self.complete
+
+
+class CandidatesResponse:
+    """
+    The candidates returned by one generate_candidates() call.
+
+    `texts` holds each candidate's text ("" for an empty candidate or a
+    sub-request that failed) and `finish_reasons` their finish reasons;
+    `usage_metadata` covers the whole call. `text` is the first non-empty
+    candidate, so code written for single responses still works.
+    """
+
+    def __init__(self, texts, finish_reasons, usage_metadata):
+        self.texts = texts
+        self.finish_reasons = finish_reasons
+        self.usage_metadata = usage_metadata
+
+    @property
+    def text(self):
+        return next((text for text in self.texts if text), "")
+
+
+def sum_usage_metadata(responses):
+    """Add up the usage_metadata token counts of several responses."""
+    usages = [getattr(response, "usage_metadata", None) for response in responses]
+    usages = [usage for usage in usages if usage is not None]
+    return StubUsageMetadata(sum(getattr(usage, "prompt_token_count", 0) or 0 for usage in usages),
+                             sum(getattr(usage, "candidates_token_count", 0) or 0 for usage in usages),
+                             sum(getattr(usage, "cached_content_token_count", 0) or 0 for usage in usages))
+
+
+def candidate_text(candidate):
+    """Text of one Vertex AI response candidate ("" if it has no text parts)."""
+    content = getattr(candidate, "content", None)
+    return "".join(getattr(part, "text", "") or "" for part in getattr(content, "parts", None) or [])
+
+
+class ModelBackend:
+    """Interface implemented by all model backends."""
+
+    name = "base"
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        raise NotImplementedError
+
+    def cache_prefix(self, prefix, ttl_seconds=3600):
+        """Register a static prompt prefix. By default nothing is cached and the prefix is re-sent."""
+        return CachedPrefix(prefix)
+
+    def release_prefix(self, cached_prefix):
+        """Free any server-side resources held for a cached prefix."""
+
+    def generate_with_prefix(self, cached_prefix, suffix, generation_config=None, **kwargs):
+        """Generate from `cached_prefix` + `suffix`, sending only the suffix when the prefix is cached."""
+        response = self.generate_content(cached_prefix.text + suffix, generation_config=generation_config, **kwargs)
+        cached_prefix.record_call(0)
+        return response
+
+    def candidate_requests(self, count):
+        """Requests one generate_candidates(count) call costs against the rate limiter."""
+        return count
+
+    def generate_candidates(self, cached_prefix, suffix, count, generation_config=None, **kwargs):
+        """
+        Generate `count` candidate responses to one prompt; returns a CandidatesResponse.
+
+        By default this makes `count` parallel sub-requests (one round trip each),
+        so callers charge the rate limiter candidate_requests(count) requests;
+        backends with a candidate_count option answer in a single call. If any
+        sub-request is rate limited that error is raised, so the limiter backs
+        off and the attempt is retried; any other failed sub-request counts as
+        an empty candidate, and if all of them fail the first error is raised.
+        """
+        with ThreadPoolExecutor(max_workers=count, thread_name_prefix="candidate") as executor:
+            futures = [executor.submit(self.generate_with_prefix, cached_prefix, suffix, generation_config, **kwargs)
+                       for _ in range(count)]
+        errors = [future.exception() for future in futures]
+        rate_limit_error = next((e for e in errors if e is not None and is_rate_limit_error(e)), None)
+        if rate_limit_error is not None:
+            raise rate_limit_error
+        responses = [future.result() if error is None else None for future, error in zip(futures, errors)]
+        if all(response is None for response in responses):
+            raise errors[0]
+        texts = [getattr(response, "text", "") or "" for response in responses]
+        finish_reasons = [getattr(response, "finish_reason", None) for response in responses]
+        return CandidatesResponse(texts, finish_reasons, sum_usage_metadata([r for r in responses if r is not None]))
+
+    def stream_with_prefix(self, cached_prefix, suffix, generation_config=None, **kwargs):
+        """Yield the response as StreamChunks. By default the whole response arrives as one chunk."""
+        response = self.generate_with_prefix(cached_prefix, suffix, generation_config, **kwargs)
+        yield StreamChunk(getattr(response, "text", "") or "", getattr(response, "finish_reason", None),
+                          getattr(response, "usage_metadata", None))
+
+    def generate_streamed(self, cached_prefix, suffix, generation_config=None, **kwargs):
+        """
+        Stream a response and stop reading once its top-level JSON value closes.
+
+        Returns a StreamedResponse. Errors raised by the stream propagate as
+        they would from generate_content, so rate limiting and back-off work unchanged.
+        """
+        scanner = IncrementalJsonScanner()
+        parts = []
+        finish_reason = None
+        usage_metadata = None
+        stream = self.stream_with_prefix(cached_prefix, suffix, generation_config, **kwargs)
+        try:
+            for chunk in stream:
+                finish_reason = chunk.finish_reason or finish_reason
+                usage_metadata = chunk.usage_metadata or usage_metadata
+                if chunk.text:
+                    parts.append(chunk.text)
+                    if scanner.feed(chunk.text):
+                        break
+        finally:
+            stream.close()
+        text = "".join(parts)
+        if usage_metadata is None:
+            # Usage arrives with the last chunk, so an abandoned stream has none; estimate it.
+            usage_metadata = StubUsageMetadata(estimate_tokens(cached_prefix.text + suffix), estimate_tokens(text))
+        return StreamedResponse(text, scanner.complete, scanner.complete and finish_reason is None, finish_reason,
+                                usage_metadata)
+
+
+def create_vertex_model(model_id=MODEL_ID, location=VERTEX_LOCATION):
+    """Initialise Vertex AI and return a GenerativeModel for `model_id`."""
+    # Imported here so the SDK is only loaded when a Vertex client is actually needed.
+    import vertexai
+    from vertexai.preview.generative_models import GenerativeModel
+
+    # Use the service account from the working directory unless credentials are already configured.
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", "service-account.json")
+    vertexai.init(
+        location=location,
+        credentials=None  # Will use service account from environment
+    )
+    return GenerativeModel(model_id)
+
+
+def vertex_generation_config(generation_config):
+    """Wrap dict configs with a response schema in GenerationConfig, which converts the schema dict."""
+    if isinstance(generation_config, dict) and "response_schema" in generation_config:
+        from vertexai.generative_models import GenerationConfig
+        return GenerationConfig(**generation_config)
+    return generation_config
+
+
+def vertex_stream_chunk(response):
+    """Convert one response of a Vertex AI generate_content(stream=True) iterator to a StreamChunk."""
+    candidate = response.candidates[0] if response.candidates else None
+    text = ""
+    finish_reason = None
+    if candidate is not None:
+        text = "".join(getattr(part, "text", "") or "" for part in candidate.content.parts)
+        finish_reason = getattr(getattr(candidate, "finish_reason", None), "name", None)
+        if finish_reason == "FINISH_REASON_UNSPECIFIED":
+            finish_reason = None
+    return StreamChunk(text, finish_reason, getattr(response, "usage_metadata", None))
+
+
+class VertexBackend(ModelBackend):
+    """Vertex AI GenerativeModel backend."""
+
+    name = "vertex"
+
+    def __init__(self, model_id=MODEL_ID, location=VERTEX_LOCATION):
+        self.model_id = model_id
+        self.location = location
+        self.model = create_vertex_model(model_id, location)
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        return self.model.generate_content(prompt, generation_config=vertex_generation_config(generation_config), **kwargs)
+
+    def cache_prefix(self, prefix, ttl_seconds=3600):
+        # Context caches have a minimum size, so this can fail for small (e.g. compact) prefixes.
+        try:
+            import datetime
+            from vertexai.preview import caching
+            from vertexai.preview.generative_models import GenerativeModel
+
+            cached_content = caching.CachedContent.create(
+                model_name=self.model_id,
+                contents=[prefix],
+                ttl=datetime.timedelta(seconds=ttl_seconds),
+            )
+            cached_model = GenerativeModel.from_cached_content(cached_content=cached_content)
+            print(f"✅ Cached prompt prefix as Vertex AI context cache {cached_content.name}")
+            return CachedPrefix(prefix, cached_model=cached_model, resource=cached_content)
+        except Exception as e:
+            print(f"⚠️ Could not create a context cache for the prompt prefix, sending it with every call: {str(e)}")
+            return CachedPrefix(prefix)
+
+    def release_prefix(self, cached_prefix):
+        if cached_prefix.resource is not None:
+            try:
+                cached_prefix.resource.delete()
+            except Exception as e:
+                print(f"⚠️ Could not delete context cache: {str(e)}")
+
+    def generate_with_prefix(self, cached_prefix, suffix, generation_config=None, **kwargs):
+        if not cached_prefix.is_cached:
+            return super().generate_with_prefix(cached_prefix, suffix, generation_config, **kwargs)
+        response = cached_prefix.cached_model.generate_content(suffix, generation_config=vertex_generation_config(generation_config),
+                                                               **kwargs)
+        usage = getattr(response, "usage_metadata", None)
+        cached_prefix.record_call(getattr(usage, "cached_content_token_count", None) or cached_prefix.token_count)
+        return response
+
+    def candidate_requests(self, count):
+        return 1
+
+    def generate_candidates(self, cached_prefix, suffix, count, generation_config=None, **kwargs):
+        # One call with candidate_count: the prompt is sent and billed once for all candidates.
+        response = self.generate_with_prefix(cached_prefix, suffix, {**(generation_config or {}), "candidate_count": count},
+                                             **kwargs)
+        candidates = list(getattr(response, "candidates", None) or [])
+        texts = [candidate_text(candidate) for candidate in candidates]
+        finish_reasons = [getattr(getattr(candidate, "finish_reason", None), "name", None) for candidate in candidates]
+        return CandidatesResponse(texts, finish_reasons, getattr(response, "usage_metadata", None))
+
+    def stream_with_prefix(self, cached_prefix, suffix, generation_config=None, **kwargs):
+        if cached_prefix.is_cached:
+            target, prompt = cached_prefix.cached_model, suffix
+        else:
+            target, prompt = self.model, cached_prefix.text + suffix
+        cached_tokens = cached_prefix.token_count if cached_prefix.is_cached else 0
+        answered = False
+        try:
+            for response in target.generate_content(prompt, generation_config=vertex_generation_config(generation_config),
+                                                    stream=True, **kwargs):
+                chunk = vertex_stream_chunk(response)
+                if cached_prefix.is_cached and chunk.usage_metadata is not None:
+                    cached_tokens = getattr(chunk.usage_metadata, "cached_content_token_count", None) or cached_tokens
+                answered = True
+                yield chunk
+        finally:
+            # Counted once the model has answered, also when the caller stops reading early.
+            if answered:
+                cached_prefix.record_call(cached_tokens)
+
+
+# --- Local stub backend ---
+
+class StubRateLimitError(Exception):
+    """Simulated 429 raised by the stub backend."""
+
+    code = 429
+
+
+class StubUsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count, cached_content_token_count=0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class StubResponse:
+    def __init__(self, text, prompt_token_count=0, finish_reason=FINISH_STOP):
+        self.text = text
+        self.finish_reason = finish_reason
+        self.usage_metadata = StubUsageMetadata(prompt_token_count, len(text) // 4)
+
+
+# Stub latency distributions: "normal" is N(latency, jitter) clipped at 0; "lognormal" has the
+# same mean and standard deviation but the long right tail of real model latencies.
+STUB_LATENCY_DISTRIBUTIONS = ("normal", "lognormal")
+
+# Streaming stub: characters per chunk, and the share of the latency spent before the first chunk.
+STUB_CHUNK_CHARS = 256
+STUB_FIRST_CHUNK_SHARE = 0.2
+
+
+# Failure kinds the stub can inject, and their default relative weights.
+STUB_FAILURE_KINDS = {
+    "rate_limit": 1.0,        # raises StubRateLimitError (429)
+    "empty": 1.0,             # returns an empty response
+    "truncated": 1.0,         # cuts the JSON off part-way through (finish reason MAX_TOKENS)
+    "invalid_structure": 1.0, # valid JSON without OSCE_Examination.Test_Results
+}
+
+# Matches the task line of the generation prompt to recover the job it belongs to.
+PROMPT_TASK_PATTERN = re.compile(r"(?:TARGET|TASK): Create a detailed medical case about (?P<differential>.+?) for a (?P<complaint>.+?) complaint\.")
+RAW_RESPONSE_NAME_PATTERN = re.compile(r"^(?P<complaint>.+?)__(?P<differential>.+)_attempt\d+$")
+INVALID_FILENAME_CHARS = re.compile(r'[\\/:*?"<>|]')
+
+
+def synthesise_case(complaint, differential, rng):
+    """Build a structurally valid OSCE case for `differential` with a little random variation."""
+    age = rng.randint(18, 85)
+    sex = rng.choice(["male", "female"])
+    return {
+        "Presenting complaint": complaint,
+        "case": {
+            "OSCE_Examination": {
+                "Patient_Actor": {
+                    "Demographics": f"{age}-year-old {sex}",
+                    "History": f"The patient presents with {complaint.lower()} of {rng.randint(1, 14)} days' duration. " * 4,
+                    "Symptoms": {
+                        "Primary_Symptom": complaint,
+                        "Secondary_Symptoms": [f"Secondary symptom {i + 1}" for i in range(rng.randint(1, 4))]
+                    },
+                    "Past_Medical_History": "No significant past medical history.",
+                    "Social_History": "Non-smoker, drinks alcohol occasionally.",
+                    "Review_of_Systems": "Denies fever, weight loss or night sweats. " * 3
+                },
+                "Physical_Examination_Findings": {
+                    "Vital_Signs": {
+                        "Temperature": f"{rng.uniform(36.2, 38.5):.1f}°C",
+                        "Blood_Pressure": f"{rng.randint(100, 150)}/{rng.randint(60, 95)} mmHg",
+                        "Heart_Rate": f"{rng.randint(55, 110)} bpm",
+                        "Respiratory_Rate": f"{rng.randint(12, 24)} breaths/min"
+                    },
+                    "General_Appearance": "Alert and oriented, mildly uncomfortable."
+                },
+                "Test_Results": {
+                    "Blood_Tests": {
+                        "Complete_Blood_Count": {"WBC": f"{rng.uniform(4, 15):.1f} x 10^9/L", "Hemoglobin": "13.8 g/dL"},
+                        "C_Reactive_Protein": f"{rng.randint(1, 80)} mg/L"
+                    }
+                },
+                "Correct_Diagnosis": differential
+            }
+        }
+    }
+
+
+class StubBackend(ModelBackend):
+    """
+    Deterministic local backend for offline benchmarking.
+
+    If `replay_dir` is an artefact store (e.g. artefacts/store) or holds recorded raw
+    responses (<complaint>__<differential>_attemptN.txt), the response recorded for the
+    prompt's (complaint, differential) is replayed, falling back to one picked by
+    prompt hash. Otherwise a case is synthesised.
+
+    Each call sleeps for a latency drawn from N(latency, latency_jitter) seconds
+    (or a log-normal distribution with that mean and standard deviation, see
+    STUB_LATENCY_DISTRIBUTIONS) and fails with probability `failure_rate`, the failure kind being drawn from
+    `failure_mix` (see STUB_FAILURE_KINDS). Randomness is seeded per (prompt, call number),
+    so a run is reproducible regardless of thread scheduling.
+
+    In JSON mode (response_mime_type application/json) the response has no text
+    around the object, and with a response_schema "invalid_structure" failures
+    do not occur, as with schema-constrained decoding.
+    """
+
+    name = "stub"
+
+    def __init__(self, replay_dir=None, latency=0.0, latency_jitter=0.0, failure_rate=0.0,
+                 failure_mix=None, seed=0, latency_distribution="normal"):
+        if latency_distribution not in STUB_LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown stub latency distribution '{latency_distribution}'. "
+                             f"Available: {', '.join(STUB_LATENCY_DISTRIBUTIONS)}")
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.latency_distribution = latency_distribution
+        self.failure_rate = failure_rate
+        self.failure_mix = dict(failure_mix or STUB_FAILURE_KINDS)
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._call_counts = {}
+        self.replay_files = {}
+        self.replay_all = []
+        self.replay_store = None
+        if replay_dir:
+            self._index_replay_dir(replay_dir)
+
+    def _index_replay_dir(self, replay_dir):
+        # Replay sources are file paths, or index entries when replaying from an artefact store.
+        if ArtefactStore.is_store(replay_dir):
+            self.replay_store = ArtefactStore(replay_dir)
+            for entry in self.replay_store.entries(KIND_RAW_RESPONSE):
+                self.replay_all.append(entry)
+                key = (INVALID_FILENAME_CHARS.sub('_', entry["complaint"]), INVALID_FILENAME_CHARS.sub('_', entry["differential"]))
+                self.replay_files.setdefault(key, []).append(entry)
+        else:
+            self.replay_all = sorted(glob.glob(os.path.join(replay_dir, "*.txt")))
+            for path in self.replay_all:
+                name_match = RAW_RESPONSE_NAME_PATTERN.match(os.path.splitext(os.path.basename(path))[0])
+                if name_match:
+                    key = (name_match.group("complaint"), name_match.group("differential"))
+                    self.replay_files.setdefault(key, []).append(path)
+        print(f"✅ Stub backend indexed {len(self.replay_all)} recorded responses from {replay_dir}")
+
+    def _read_replay(self, source):
+        if self.replay_store is not None:
+            return self.replay_store.read_entry(source)
+        with open(source, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def _rng_for(self, prompt):
+        prompt_hash = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        with self._lock:
+            call_number = self._call_counts.get(prompt_hash, 0)
+            self._call_counts[prompt_hash] = call_number + 1
+        return random.Random(f"{self.seed}:{prompt_hash}:{call_number}"), prompt_hash
+
+    def _response_text(self, prompt, prompt_hash, rng):
+        task_match = PROMPT_TASK_PATTERN.search(prompt)
+        complaint = task_match.group("complaint") if task_match else "Unknown complaint"
+        differential = task_match.group("differential") if task_match else "Unknown diagnosis"
+        if self.replay_all:
+            key = (INVALID_FILENAME_CHARS.sub('_', complaint), INVALID_FILENAME_CHARS.sub('_', differential))
+            recorded = self.replay_files.get(key)
+            if recorded:
+                source = rng.choice(recorded)
+            else:
+                source = self.replay_all[int(prompt_hash, 16) % len(self.replay_all)]
+            return self._read_replay(source)
+        return json.dumps(synthesise_case(complaint, differential, rng), indent=2, ensure_ascii=False)
+
+    def _draw_latency(self, rng):
+        if not (self.latency or self.latency_jitter):
+            return 0.0
+        if self.latency_distribution == "lognormal" and self.latency > 0:
+            sigma_squared = math.log(1 + (self.latency_jitter / self.latency) ** 2)
+            return rng.lognormvariate(math.log(self.latency) - sigma_squared / 2, math.sqrt(sigma_squared))
+        return max(0.0, rng.gauss(self.latency, self.latency_jitter))
+
+    def _simulate(self, prompt, generation_config):
+        """Draw one call's latency, failure kind, response text and finish reason."""
+        rng, prompt_hash = self._rng_for(prompt)
+        latency = self._draw_latency(rng)
+
+        failure_kind = None
+        if self.failure_rate and rng.random() < self.failure_rate:
+            kinds = list(self.failure_mix)
+            failure_kind = rng.choices(kinds, weights=[self.failure_mix[k] for k in kinds])[0]
+        if failure_kind in ("rate_limit", "empty"):
+            return latency, failure_kind, "", FINISH_STOP
+
+        text = self._response_text(prompt, prompt_hash, rng)
+        generation_config = generation_config or {}
+        finish_reason = FINISH_STOP
+        if generation_config.get("response_mime_type") == "application/json":
+            # JSON mode: no fences or prose around the object.
+            text = text[text.find('{'):text.rfind('}') + 1] if '{' in text else text
+        if failure_kind == "invalid_structure" and "response_schema" in generation_config:
+            # Schema-constrained decoding cannot drop required keys.
+            failure_kind = None
+        if failure_kind == "truncated":
+            text = text[:rng.randint(len(text) // 3, max(len(text) // 3, len(text) - 10))]
+            finish_reason = FINISH_MAX_TOKENS
+        elif failure_kind == "invalid_structure":
+            text = text.replace('"Test_Results"', '"Test_Result"')
+        max_output_tokens = generation_config.get("max_output_tokens")
+        if max_output_tokens and len(text) // 4 > max_output_tokens:
+            text = text[:max_output_tokens * 4]
+            finish_reason = FINISH_MAX_TOKENS
+        return latency, failure_kind, text, finish_reason
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        latency, failure_kind, text, finish_reason = self._simulate(prompt, generation_config)
+        if latency:
+            time.sleep(latency)
+        if failure_kind == "rate_limit":
+            raise StubRateLimitError("429 Resource exhausted (stub backend)")
+        return StubResponse(text, len(prompt) // 4, finish_reason)
+
+    def candidate_requests(self, count):
+        return 1
+
+    def generate_candidates(self, cached_prefix, suffix, count, generation_config=None, **kwargs):
+        # Simulates candidate_count: one round trip as slow as the slowest candidate, each candidate
+        # drawn (and failing) independently; a rate limit fails the whole call.
+        prompt = cached_prefix.text + suffix
+        draws = [self._simulate(prompt, generation_config) for _ in range(count)]
+        latency = max(draw[0] for draw in draws)
+        if latency:
+            time.sleep(latency)
+        if draws[0][1] == "rate_limit":
+            raise StubRateLimitError("429 Resource exhausted (stub backend)")
+        texts = [text for _, _, text, _ in draws]
+        cached_tokens = cached_prefix.token_count if cached_prefix.is_cached else 0
+        cached_prefix.record_call(cached_tokens)
+        return CandidatesResponse(texts, [finish_reason for _, _, _, finish_reason in draws],
+                                  StubUsageMetadata(len(prompt) // 4, sum(len(text) for text in texts) // 4, cached_tokens))
+
+    def stream_content(self, prompt, generation_config=None):
+        """Yield the response in STUB_CHUNK_CHARS chunks, spreading the latency over them."""
+        latency, failure_kind, text, finish_reason = self._simulate(prompt, generation_config)
+        if latency:
+            time.sleep(latency * STUB_FIRST_CHUNK_SHARE)
+        if failure_kind == "rate_limit":
+            raise StubRateLimitError("429 Resource exhausted (stub backend)")
+        pieces = [text[i:i + STUB_CHUNK_CHARS] for i in range(0, len(text), STUB_CHUNK_CHARS)] or [""]
+        for number, piece in enumerate(pieces, 1):
+            if number > 1 and latency:
+                time.sleep(latency * (1 - STUB_FIRST_CHUNK_SHARE) / (len(pieces) - 1))
+            if number < len(pieces):
+                yield StreamChunk(piece)
+            else:
+                yield StreamChunk(piece, finish_reason, StubUsageMetadata(len(prompt) // 4, len(text) // 4))
+
+    def cache_prefix(self, prefix, ttl_seconds=3600):
+        # Simulate a server-side cache: the stub itself holds the prefix.
+        return CachedPrefix(prefix, cached_model=self)
+
+    def generate_with_prefix(self, cached_prefix, suffix, generation_config=None, **kwargs):
+        if not cached_prefix.is_cached:
+            return super().generate_with_prefix(cached_prefix, suffix, generation_config, **kwargs)
+        response = self.generate_content(cached_prefix.text + suffix, generation_config=generation_config, **kwargs)
+        response.usage_metadata.cached_content_token_count = cached_prefix.token_count
+        cached_prefix.record_call(cached_prefix.token_count)
+        return response
+
+    def stream_with_prefix(self, cached_prefix, suffix, generation_config=None, **kwargs):
+        cached_tokens = cached_prefix.token_count if cached_prefix.is_cached else 0
+        answered = False
+        try:
+            for chunk in self.stream_content(cached_prefix.text + suffix, generation_config):
+                if chunk.usage_metadata is not None:
+                    chunk.usage_metadata.cached_content_token_count = cached_tokens
+                answered = True
+                yield chunk
+        finally:
+            if answered:
+                cached_prefix.record_call(cached_tokens)
+
+
+MODEL_FACTORIES = {
+    "vertex": VertexBackend,
+    "stub": StubBackend,
+}
+
+
+class LazyModel:
+    """
+    Proxy that constructs the underlying model backend on first use.
+
+    Construction is guarded by a lock so concurrent workers share one client.
+    """
+
+    def __init__(self, factory, **factory_kwargs):
+        self._factory = factory
+        self._factory_kwargs = factory_kwargs
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_initialised(self):
+        return self._client is not None
+
+    def get(self):
+        """Return the underlying backend, constructing it if needed."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory(**self._factory_kwargs)
+        return self._client
+
+    def generate_content(self, *args, **kwargs):
+        return self.get().generate_content(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # Forward the rest of the backend interface (cache_prefix, generate_with_prefix, ...).
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(backend=DEFAULT_BACKEND, **factory_kwargs):
+    """
+    Return the shared lazily-initialised model for `backend`.
+
+    Nothing is constructed until the first generate_content() or get() call.
+    """
+    if backend not in MODEL_FACTORIES:
+        raise ValueError(f"Unknown model backend '{backend}'. Available: {', '.join(sorted(MODEL_FACTORIES))}")
+    key = (backend, repr(sorted(factory_kwargs.items())))
+    with _models_lock:
+        if key not in _models:
+            _models[key] = LazyModel(MODEL_FACTORIES[backend], **factory_kwargs)
+        return _models[key]
+
+
+def add_backend_arguments(parser):
+    """Add the --backend and --stub-* options shared by both generation scripts."""
+    parser.add_argument("--backend", choices=sorted(MODEL_FACTORIES), default=DEFAULT_BACKEND,
+                        help=f"Model backend to generate with (default: {DEFAULT_BACKEND}). 'stub' runs fully offline.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream responses, stop reading once the JSON object closes, and fail responses cut off at the token limit instead of repairing them.")
+    parser.add_argument("--stub-replay-dir", type=str, default=None,
+                        help="Stub backend: replay recorded responses from an artefact store (e.g. artefacts/store) or a directory of *.txt responses instead of synthesising cases.")
+    parser.add_argument("--stub-latency", type=float, default=0.0,
+                        help="Stub backend: mean simulated latency per call in seconds (default: 0).")
+    parser.add_argument("--stub-latency-jitter", type=float, default=0.0,
+                        help="Stub backend: standard deviation of the simulated latency in seconds (default: 0).")
+    parser.add_argument("--stub-latency-distribution", choices=STUB_LATENCY_DISTRIBUTIONS, default="normal",
+                        help="Stub backend: shape of the simulated latency distribution (default: normal).")
+    parser.add_argument("--stub-failure-rate", type=float, default=0.0,
+                        help="Stub backend: probability that a call fails (rate limit, empty, truncated or invalid structure) (default: 0).")
+    parser.add_argument("--stub-failure-mix", type=parse_failure_mix, default=None,
+                        help="Stub backend: relative weights of the failure kinds, e.g. rate_limit=2,truncated=1 "
+                             f"(kinds: {', '.join(STUB_FAILURE_KINDS)}; default: equal weights).")
+    parser.add_argument("--stub-seed", type=int, default=0,
+                        help="Stub backend: random seed (default: 0).")
+
+
+def parse_failure_mix(text):
+    """Parse "kind=weight,..." into a stub failure_mix dict (an argparse type)."""
+    mix = {}
+    for item in text.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in STUB_FAILURE_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown failure kind '{kind}' (kinds: {', '.join(STUB_FAILURE_KINDS)})")
+        try:
+            mix[kind] = float(weight) if weight else 1.0
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid weight '{weight}' for {kind}")
+    return mix
+
+
+def model_from_args(args):
+    """Return the lazily-initialised model selected by the add_backend_arguments() options."""
+    if args.backend == "stub":
+        return get_model(
+            "stub",
+            replay_dir=args.stub_replay_dir,
+            latency=args.stub_latency,
+            latency_jitter=args.stub_latency_jitter,
+            failure_rate=args.stub_failure_rate,
+            failure_mix=args.stub_failure_mix,
+            seed=args.stub_seed,
+            latency_distribution=args.stub_latency_distribution,
+        )
+    return get_model(args.backend)
+
+
+def add_prompt_arguments(parser):
+    """Add the prompt size/caching options shared by both generation scripts."""
+    parser.add_argument("--prompt-cache", action="store_true",
+                        help="Split the prompt into a static prefix, registered with the backend's context cache, and a "
+                             "per-differential suffix, which is all that is sent per call. The split prompt is worded and "
+                             "ordered differently from the default one (see prompts.py).")
+    parser.add_argument("--compact-prompt", action="store_true",
+                        help="Use a single example case in the prompt instead of three.")
+
+
+def add_catalogue_arguments(parser):
+    """Add the diagnoses catalogue options shared by both generation scripts (see catalogue.py)."""
+    parser.add_argument("--no-catalogue-cache", action="store_true",
+                        help="Parse tables_list/diagnoses.jsonl without reading or writing the cached index "
+                             "(also set by the CASEGEN_NO_CATALOGUE_CACHE environment variable).")
+
+
+def add_structured_output_arguments(parser):
+    """Add the JSON-mode options shared by both generation scripts."""
+    parser.add_argument("--json-mode", action="store_true",
+                        help="Ask the model for JSON-only output (response_mime_type application/json).")
+    parser.add_argument("--response-schema", action="store_true",
+                        help="Also constrain output to a response schema derived from the OSCE case schema (implies --json-mode).")
+
+
+def add_telemetry_arguments(parser, default_metrics_filename="run_metrics.json"):
+    """Add the run metrics output options shared by both generation scripts (see telemetry.py)."""
+    parser.add_argument("--metrics-file", type=str, default=None,
+                        help=f"Where to write the run metrics summary JSON; a CSV is written next to it (default: artefacts/{default_metrics_filename}).")
+    parser.add_argument("--prometheus-file", type=str, default=None,
+                        help="Also write the run metrics in Prometheus text format to this file.")
+
+
+def add_hedging_arguments(parser):
+    """Add the hedged request options shared by both generation scripts (see hedging.py)."""
+    parser.add_argument("--hedge-budget", type=int, default=0,
+                        help="Send a duplicate request for a call that runs past the run's latency percentile, "
+                             "at most this many times per run (default: 0, no hedging).")
+    parser.add_argument("--hedge-percentile", type=float, default=DEFAULT_HEDGE_PERCENTILE,
+                        help=f"Latency percentile of the calls so far after which a call is hedged (default: {DEFAULT_HEDGE_PERCENTILE}).")
+
+
+def add_logging_arguments(parser):
+    """Add the console verbosity and run log options shared by both generation scripts (see run_logging.py)."""
+    parser.add_argument("--verbose", action="store_true",
+                        help="Print every attempt and response to the console instead of a progress line, "
+                             "and include DEBUG records in the run log.")
+    parser.add_argument("--log-file", type=str, default=None,
+                        help="Where to write the structured JSON-lines run log (default: artefacts/run_log.jsonl).")
+
+
+def report_prompt_token_savings(cached_prefix, compact_saving_per_call=0):
+    """
+    Print how many prompt tokens the prefix cache and compact mode saved over a run.
+
+    `compact_saving_per_call` is prompts.exemplar_tokens_saved() for the run's prompt.
+    """
+    compact_saving = compact_saving_per_call * cached_prefix.calls
+    print(f"🧮 Prompt prefix: {cached_prefix.token_count} tokens x {cached_prefix.calls} calls; "
+          f"{cached_prefix.cached_tokens} tokens served from the backend cache, "
+          f"{max(compact_saving, 0)} tokens saved by the compact prompt "
+          f"(~{cached_prefix.cached_tokens + max(compact_saving, 0)} input tokens saved in total)")
+
+
+def preflight_check(model, prompt="Hello, can you respond?"):
+    """Send a short test prompt and report whether the model answered. Makes one billable call."""
+    try:
+        test_response = model.generate_content(prompt)
+        print(f"✅ Test response: {test_response.text[:100]}...")
+        return True
+    except Exception as e:
+        print(f"❌ Preflight check failed: {str(e)}")
+        return False
@@ -0,0 +1,312 @@
+"""
+Per-stage benchmark of the response-processing hot path over a corpus of raw responses.
+
+The corpus is every raw response in an artefact store or a directory of
+*.txt files (the old artefacts/raw_responses/ layout). Each response is also
+run as synthetic variants built from its JSON value: wrapped in a markdown
+fence, surrounded by prose, after prose that contains brackets ("Note [1]"),
+wrapped in a one-element array, and truncated at 25%, 50% and 90% of its length. Without recorded responses, cases are
+synthesised as the stub backend does (--synthesise N).
+
+Each response goes through the stages of parse_model_json() and
+extract_case(), timed separately:
+
+    locate       find the first '{' or '['
+    decode       raw_decode fast path for a well-formed value
+    complete     complete_json_text(): fence/prose skipping and truncation repair (when decode fails)
+    loads        json.loads of the completed text
+    json_repair  fallback when loads fails
+    validate     validate_specific_key_nesting() on the "case" object
+    stream       IncrementalJsonScanner over STREAM_CHUNK_CHARS chunks, then
+                 extract_case() of the text read up to where the scan stopped
+                 (as model_backends.generate_streamed() with --stream)
+    total        extract_case() end to end
+
+For each stage it reports calls, success rate, p50/p99 latency and throughput
+(MB/s of text handed to the stage), and for each variant the end-to-end
+success rate. Results can be saved as JSON and compared with a stored
+baseline: a stage whose p50 or p99 is more than --tolerance slower, or whose
+success rate drops, counts as a regression and the exit status is 1.
+
+    python parse_benchmark.py artefacts/store --save-baseline parse_baseline.json
+    python parse_benchmark.py artefacts/store --baseline parse_baseline.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from json_repair import repair_json as json_repair
+
+from case_schema import validate_specific_key_nesting
+from response_parser import (IncrementalJsonScanner, extract_case, complete_json_text, load_raw_responses,
+                             _first_container, _DECODER, _percentile)
+
+STAGES = ("locate", "decode", "complete", "loads", "json_repair", "validate", "stream", "total")
+TRUNCATION_POINTS = (0.25, 0.5, 0.9)
+VARIANTS = ("recorded", "fenced", "prose", "cited", "array") + tuple(f"truncated_{int(p * 100)}" for p in TRUNCATION_POINTS)
+DEFAULT_TOLERANCE = 0.25
+# Latency differences below this many milliseconds are treated as timer noise when comparing runs.
+NOISE_FLOOR_MS = 0.005
+# Chunk size for the stream stage, as the stub backend streams.
+STREAM_CHUNK_CHARS = 256
+
+
+def json_value_text(text):
+    """The JSON value of a response (without fences or prose) if it decodes cleanly, else the text itself."""
+    start = _first_container(text)
+    if start == -1:
+        return text
+    try:
+        _, end = _DECODER.raw_decode(text, start)
+    except json.JSONDecodeError:
+        return text
+    return text[start:end]
+
+
+def make_variants(text, variants=VARIANTS):
+    """Yield (variant, text) for one recorded response."""
+    body = json_value_text(text)
+    builders = {
+        "recorded": lambda: text,
+        "fenced": lambda: f"```json\n{body}\n```",
+        "prose": lambda: f"Here is the requested case:\n\n{body}\n\nLet me know if you need any changes.",
+        # Brackets in leading prose must not be taken for the case (extract_case and the stream scanner).
+        "cited": lambda: f"Note [1]: fields marked [optional] are filled in; see {{case}} below.\n\n{body}",
+        "array": lambda: f"[{body}]",
+    }
+    for point in TRUNCATION_POINTS:
+        builders[f"truncated_{int(point * 100)}"] = lambda point=point: body[:int(len(body) * point)]
+    for variant in variants:
+        yield variant, builders[variant]()
+
+
+def synthesise_responses(count, seed=0):
+    """Raw responses as the stub backend synthesises them, for running without recorded output."""
+    # Imported here so benchmarking a recorded corpus does not load the model backends.
+    from model_backends import synthesise_case
+
+    rng = random.Random(seed)
+    return [json.dumps(synthesise_case("Headache", f"Differential {number}", rng), indent=2, ensure_ascii=False)
+            for number in range(count)]
+
+
+def _decode(text, start):
+    try:
+        return True, _DECODER.raw_decode(text, start)[0]
+    except json.JSONDecodeError:
+        return False, None
+
+
+def _loads(text):
+    try:
+        return True, json.loads(text)
+    except json.JSONDecodeError:
+        return False, None
+
+
+def _repair(text):
+    try:
+        repaired = json_repair(text, return_objects=True)
+    except Exception:
+        return False, None
+    return repaired not in ("", None), repaired
+
+
+def _extract(text):
+    accepted = extract_case(text, validate_specific_key_nesting)["error"] is None
+    return accepted, accepted
+
+
+def _stream(text):
+    scanner = IncrementalJsonScanner()
+    for offset in range(0, len(text), STREAM_CHUNK_CHARS):
+        if scanner.feed(text[offset:offset + STREAM_CHUNK_CHARS]):
+            return _extract(text[:scanner.end])
+    return _extract(text)
+
+
+def _case_object(data):
+    if isinstance(data, list) and len(data) == 1:
+        data = data[0]
+    return data.get("case") if isinstance(data, dict) else None
+
+
+class StageTimer:
+    """Best-of-`repeat` timings, input bytes and successes for every stage."""
+
+    def __init__(self, repeat):
+        self.repeat = max(1, repeat)
+        self.timings = {stage: [] for stage in STAGES}
+        self.bytes = dict.fromkeys(STAGES, 0)
+        self.successes = dict.fromkeys(STAGES, 0)
+
+    def run(self, stage, size, func, *args):
+        """Time func(*args), which returns (ok, value), and return the value."""
+        best = None
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            ok, value = func(*args)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        self.timings[stage].append(best)
+        self.bytes[stage] += size
+        self.successes[stage] += bool(ok)
+        return value
+
+    def summary(self):
+        stages = {}
+        for stage in STAGES:
+            timings = sorted(self.timings[stage])
+            calls = len(timings)
+            total_seconds = sum(timings)
+            stages[stage] = {
+                "calls": calls,
+                "success_rate": round(self.successes[stage] / calls, 4) if calls else None,
+                "p50_ms": round(_percentile(timings, 0.50) * 1000, 4),
+                "p99_ms": round(_percentile(timings, 0.99) * 1000, 4),
+                "mean_ms": round(total_seconds / calls * 1000, 4) if calls else 0.0,
+                "throughput_mb_s": round(self.bytes[stage] / 1e6 / total_seconds, 2) if total_seconds else None,
+            }
+        return stages
+
+
+def process(text, timer):
+    """Run one response through the stages; returns True if extract_case() accepted it."""
+    size = len(text.encode('utf-8'))
+    start = timer.run("locate", size, lambda: (True, _first_container(text)))
+    data = None
+    if start != -1:
+        data = timer.run("decode", size, _decode, text, start)
+        if data is None:
+            json_text = timer.run("complete", size, lambda: (True, complete_json_text(text)[0]))
+            json_size = len(json_text.encode('utf-8'))
+            data = timer.run("loads", json_size, _loads, json_text)
+            if data is None:
+                data = timer.run("json_repair", json_size, _repair, json_text)
+    case_content = _case_object(data)
+    if isinstance(case_content, dict):
+        timer.run("validate", size, lambda: (validate_specific_key_nesting(case_content)[0], None))
+    timer.run("stream", size, _stream, text)
+    return timer.run("total", size, _extract, text)
+
+
+def run_benchmark(texts, repeat=3, variants=VARIANTS):
+    timer = StageTimer(repeat)
+    by_variant = {variant: {"responses": 0, "accepted": 0} for variant in variants}
+    total_bytes = 0
+    for text in texts:
+        for variant, variant_text in make_variants(text, variants):
+            total_bytes += len(variant_text.encode('utf-8'))
+            by_variant[variant]["responses"] += 1
+            by_variant[variant]["accepted"] += process(variant_text, timer)
+    for counts in by_variant.values():
+        counts["success_rate"] = round(counts["accepted"] / counts["responses"], 4) if counts["responses"] else None
+    return {
+        "corpus": {"responses": len(texts), "variants": list(variants), "bytes": total_bytes},
+        "repeat": repeat,
+        "stages": timer.summary(),
+        "variants": by_variant,
+    }
+
+
+def _format_ms(value):
+    return "n/a" if value is None else f"{value:.3f} ms"
+
+
+def print_results(results):
+    corpus = results["corpus"]
+    print(f"📊 {corpus['responses']} responses x {len(corpus['variants'])} variants "
+          f"({corpus['bytes'] / 1e6:.2f} MB), best of {results['repeat']} runs per call")
+    for stage, stats in results["stages"].items():
+        if not stats["calls"]:
+            print(f"  {stage:12} not reached")
+            continue
+        throughput = "n/a" if stats["throughput_mb_s"] is None else f"{stats['throughput_mb_s']:.1f} MB/s"
+        print(f"  {stage:12} {stats['calls']:6} calls, {stats['success_rate'] * 100:6.2f}% ok, "
+              f"p50 {_format_ms(stats['p50_ms'])}, p99 {_format_ms(stats['p99_ms'])}, {throughput}")
+    print("🧾 Accepted by extract_case: " + ", ".join(
+        f"{variant} {counts['accepted']}/{counts['responses']}" for variant, counts in results["variants"].items()))
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Print per-stage changes against `baseline`; returns a list of regression descriptions."""
+    regressions = []
+    if baseline.get("corpus", {}).get("responses") != results["corpus"]["responses"]:
+        print(f"⚠️ Baseline was measured on {baseline.get('corpus', {}).get('responses')} responses, "
+              f"this run on {results['corpus']['responses']}; comparisons are approximate")
+    print(f"🔁 Compared with the baseline (tolerance {tolerance * 100:.0f}%):")
+    for stage, stats in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before or not before.get("calls") or not stats["calls"]:
+            continue
+        changes = []
+        for metric in ("p50_ms", "p99_ms"):
+            ratio = stats[metric] / before[metric] if before[metric] else 1.0
+            changes.append(f"{metric[:3]} {ratio:.2f}x")
+            if ratio > 1 + tolerance and stats[metric] - before[metric] > NOISE_FLOOR_MS:
+                regressions.append(f"{stage} {metric[:3]} {before[metric]:.3f} -> {stats[metric]:.3f} ms")
+        if stats["success_rate"] < before["success_rate"]:
+            regressions.append(f"{stage} success rate {before['success_rate']:.2%} -> {stats['success_rate']:.2%}")
+        changes.append(f"ok {before['success_rate']:.2%} -> {stats['success_rate']:.2%}")
+        print(f"  {stage:12} " + ", ".join(changes))
+    for variant, counts in results["variants"].items():
+        before = baseline.get("variants", {}).get(variant)
+        if before and before.get("success_rate") is not None and counts["success_rate"] < before["success_rate"]:
+            regressions.append(f"{variant} accepted {before['success_rate']:.2%} -> {counts['success_rate']:.2%}")
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s): " + "; ".join(regressions))
+    else:
+        print("✅ No regressions against the baseline")
+    return regressions
+
+
+def _write_json(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of response parsing and validation over a corpus of raw responses")
+    parser.add_argument("raw_dir", nargs="?", default=os.path.join("artefacts", "store"),
+                        help="Artefact store or directory of raw model responses (*.txt) (default: artefacts/store).")
+    parser.add_argument("--synthesise", type=int, default=0,
+                        help="Add N synthesised responses (used with 50 when no recorded responses are found).")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS),
+                        help="Variants of each response to run (default: all).")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timing repeats per call; the fastest is kept (default: 3).")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Compare with results saved by --save-baseline; exits with status 1 on a regression.")
+    parser.add_argument("--save-baseline", type=str, default=None,
+                        help="Save these results as the baseline for later runs.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Allowed slow-down of a stage's p50/p99 before it counts as a regression (default: {DEFAULT_TOLERANCE}).")
+    args = parser.parse_args()
+
+    texts = load_raw_responses(args.raw_dir) if os.path.isdir(args.raw_dir) else []
+    synthesise = args.synthesise or (0 if texts else 50)
+    if not texts:
+        print(f"ℹ️ No raw responses found in {args.raw_dir}; synthesising {synthesise}")
+    texts += synthesise_responses(synthesise)
+    results = run_benchmark(texts, args.repeat, args.variants)
+    print_results(results)
+    if args.output:
+        _write_json(args.output, results)
+        print(f"📝 Results written to {args.output}")
+    if args.save_baseline:
+        _write_json(args.save_baseline, results)
+        print(f"📝 Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,180 @@
+"""
+Pipelined generation: model calls, parsing/validation and writes run as
+separate stages, so the model is not left idle while a long response is
+repaired or saved.
+
+    jobs -> model threads -> parse pool (processes) -> writer thread -> results in job order
+            generate(job)    parse(text)               write(job, outcome, parsed)
+
+- Model stage: `concurrency` threads take jobs from an AttemptQueue and call
+  generate(job), which returns an outcome dict: {"text": response text} or,
+  for a failed call, {"text": None, "failure": {...}, "retry_delay": seconds}.
+- Parse stage: response texts are handed to `parse` (a module-level function,
+  so it can be pickled, e.g. extract_case) in a process pool, because
+  json_repair is CPU-bound on long responses and would hold the GIL.
+  A multi-candidate outcome ({"candidates": [texts]}) is parsed in one
+  call on the list of texts (e.g. by extract_candidates).
+  With parse_workers=0 the writer thread parses inline.
+- Writer stage: one thread calls write(job, outcome, parsed) for every
+  attempt, which saves what it needs and returns the attempt's result
+  ({"case", "output_path", "failure"}). Rejected attempts go back on the
+  queue until the job has used max_attempts; then on_finished(job, result)
+  is called from the writer thread.
+
+Backpressure keeps memory flat: a model thread takes one of `buffer_size`
+slots before handing a response on and the writer frees it once the
+attempt is written, so a slow parse or write stage stops new model calls
+instead of piling up responses; and jobs are admitted at most `window` ahead
+of the oldest result not yet yielded, so results waiting to be returned in
+order stay bounded as well.
+
+Jobs are plain dicts; the pipeline sets job["index"] and job["attempts"].
+"""
+
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from failure_ledger import REASON_MODEL_ERROR
+from run_logging import get_logger
+from work_queue import AttemptQueue
+
+logger = get_logger("pipeline")
+
+DEFAULT_PARSE_WORKERS = min(4, os.cpu_count() or 1)
+
+_STOP = object()
+
+
+def _parse_input(outcome):
+    return outcome["candidates"] if outcome.get("candidates") is not None else outcome["text"]
+
+
+class GenerationPipeline:
+    """Run jobs through the model -> parse -> write stages; run() yields (job, result) in job order."""
+
+    def __init__(self, generate, parse, write, on_finished=None, concurrency=1, parse_workers=DEFAULT_PARSE_WORKERS,
+                 max_attempts=3, buffer_size=None):
+        self.generate = generate
+        self.parse = parse
+        self.write = write
+        self.on_finished = on_finished
+        self.concurrency = max(1, concurrency)
+        self.parse_workers = max(0, parse_workers)
+        self.max_attempts = max_attempts
+        self.buffer_size = buffer_size or 2 * max(self.concurrency, self.parse_workers)
+        self.window = self.buffer_size + self.concurrency
+        self._queue = AttemptQueue(more_jobs=True)
+        self._slots = threading.Semaphore(self.buffer_size)
+        self._handoff = queue.SimpleQueue()
+        self._results = {}
+        self._cond = threading.Condition()
+        self._error = None
+        self._closed = False
+        self._pool = None
+
+    def run(self, jobs):
+        jobs = list(jobs)
+        if not jobs:
+            return
+        if self.parse_workers:
+            # spawn rather than fork: the run already has logging and ledger threads.
+            self._pool = ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn"))
+        model_executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="case-gen")
+        writer = threading.Thread(target=self._write_stage, name="case-writer", daemon=True)
+        writer.start()
+        for _ in range(self.concurrency):
+            model_executor.submit(self._model_stage)
+        admitted = 0
+        try:
+            for index, job in enumerate(jobs):
+                while admitted < len(jobs) and admitted <= index + self.window:
+                    jobs[admitted]["index"] = admitted
+                    jobs[admitted]["attempts"] = 0
+                    self._queue.add(jobs[admitted])
+                    admitted += 1
+                    if admitted == len(jobs):
+                        self._queue.end_input()
+                yield job, self._result(index)
+        finally:
+            # On Ctrl-C or an error, stop handing out attempts; calls already made are still written.
+            self._closed = True
+            self._queue.close()
+            for _ in range(self.concurrency):
+                self._slots.release()
+            model_executor.shutdown(wait=True)
+            self._handoff.put(_STOP)
+            writer.join()
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def _result(self, index):
+        with self._cond:
+            while index not in self._results and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            return self._results.pop(index)
+
+    def _fail(self, error):
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+        self._queue.close()
+
+    def _model_stage(self):
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                job["attempts"] += 1
+                try:
+                    outcome = self.generate(job)
+                except Exception as e:
+                    logger.error(f"❌ Error: {str(e)}", exc_info=True, extra={"attempt": job["attempts"]})
+                    outcome = {"text": None, "failure": {"reason": REASON_MODEL_ERROR, "detail": f"{type(e).__name__}: {str(e)}"}}
+                # Blocks while buffer_size attempts are waiting to be parsed or written.
+                self._slots.acquire()
+                future = None
+                if outcome.get("text") is not None and self._pool is not None and not self._closed:
+                    future = self._pool.submit(self.parse, _parse_input(outcome))
+                self._handoff.put((job, outcome, future))
+        except BaseException as e:
+            self._fail(e)
+
+    def _write_stage(self):
+        while True:
+            item = self._handoff.get()
+            if item is _STOP:
+                return
+            job, outcome, future = item
+            if self._error is not None:
+                self._slots.release()
+                continue
+            try:
+                parsed = None
+                if future is not None:
+                    parsed = future.result()
+                elif outcome.get("text") is not None:
+                    parsed = self.parse(_parse_input(outcome))
+                result = self.write(job, outcome, parsed)
+                if result["case"] is None and job["attempts"] < self.max_attempts:
+                    # Re-queued at the back (after its back-off delay, if any); dropped unfinished on shutdown.
+                    self._queue.task_done(job, None if self._closed else outcome.get("retry_delay") or 0)
+                    continue
+                result["attempts"] = job["attempts"]
+                if self.on_finished is not None:
+                    self.on_finished(job, result)
+                with self._cond:
+                    self._results[job["index"]] = result
+                    self._cond.notify_all()
+                self._queue.task_done(job)
+            except BaseException as e:
+                # A write failure (e.g. a full disk) stops the run rather than being retried.
+                self._fail(e)
+            finally:
+                self._slots.release()
@@ -0,0 +1,393 @@
+"""
+Prompt construction for case generation, shared by both generation scripts.
+
+By default each call sends PROMPT_TEMPLATE, the prompt the benchmark cases
+were generated with, naming the target differential and complaint in the task
+line. With --prompt-cache the prompt is instead split into a static prefix
+(the same instructions, reworded to refer to a target given at the end, plus
+the example_json_format exemplars) that is identical for all ~3000 calls, and
+a short per-job suffix naming the differential and complaint. The prefix is
+built once per run and cached by the model backend (see
+ModelBackend.cache_prefix), so only the suffix is re-sent per call. The split
+prompt is worded and ordered differently, so cases generated with it can
+differ from the default ones.
+
+Both layouts go through the same (prefix, suffix) interface: the default
+layout has an empty prefix and the whole prompt as its suffix.
+Compact mode replaces the three exemplars with a single one.
+"""
+
+from functools import lru_cache
+
+from rate_limiter import estimate_tokens
+
+# Example OSCE cases shown to the model (three exemplars)
+example_json_format = """
+{
+      "OSCE_Examination": {
+        "Patient_Actor": {
+          "Demographics": "32-year-old male",
+          "History": "The patient reports a progressive worsening of headaches over the past several weeks. He also notices blurred vision occasionally, especially later in the day. He initially attributed these to work-related stress but has decided to seek medical attention as the symptoms persisted and have not responded to over-the-counter medications.",
+          "Symptoms": {
+            "Primary_Symptom": "Headaches",
+            "Secondary_Symptoms": [
+              "Blurred vision",
+              "Pain intensifying over the day",
+              "Occasional nausea"
+            ]
+          },
+          "Past_Medical_History": "Previous concussion during a motor vehicle accident 5 years ago. No other significant past medical or surgical history.",
+          "Social_History": "Non-smoker, occasional drinker. Works as a software engineer.",
+          "Review_of_Systems": "Pain is located in the frontal region and worse in the morning. Denies fever, focal neurology, seizures, balance problems, weakness or loss of consciousness. No preceding aura."
+        },
+        "Physical_Examination_Findings": {
+          "Vital_Signs": {
+            "Temperature": "36.7°C (98°F)",
+            "Blood_Pressure": "128/75 mmHg",
+            "Heart_Rate": "60 bpm",
+            "Respiratory_Rate": "18 breaths/min"
+          },
+          "Neurological_Examination": {
+            "Pupils": "Bilateral papilledema",
+            "Gait": "Normal gait",
+            "Motor_System": "Normal power and tone in all four limbs. Deep tendon reflexes within normal limits.",
+            "Sensory_System": "Normal sensation to touch, pain, temperature, and vibration."
+          }
+        },
+        "Test_Results": {
+          "Imaging": {
+            "MRI_Brain": {
+              "Findings": "Normal, no space-occupying lesions."
+            },
+            "CT_Brain": {
+              "Findings": "Normal, no space-occupying lesions."
+            },
+            "CT_Angiogram_Brain": {
+              "Findings": "Normal, no acute intracranial hemorrhage."
+            }
+          },
+          "CSF_Opening_Pressure": "Increased CSF opening pressure",
+          "CSF_analysis": {
+            "Protein_Level": "Normal",
+            "WBC_Count": "Normal"
+          }
+        },
+        "Correct_Diagnosis": "Idiopathic intracranial hypertension"
+      }
+    },
+{
+    "Presenting complaint": "Weight loss",
+    "case": {
+      "OSCE_Examination": {
+        "Patient_Actor": {
+          "Demographics": "60-year-old female",
+          "History": "The patient reports a 6-month history of diarrhea, as well as considerable weight loss during this period. She also mentions being easily fatigued and having been diagnosed with iron deficiency anemia.",
+          "Symptoms": {
+            "Primary_Symptom": "Weight loss and chronic diarrhea",
+            "Secondary_Symptoms": [
+              "Fatigue",
+              "Iron deficiency anemia",
+		"Constipation"
+            ]
+          },
+          "Past_Medical_History": "No significant past medical history.",
+          "Social_History": "Non-smoker, moderate alcohol consumption, works as a restaurant manager. No allergies, eats an unrestricted diet.",
+          "Review_of_Systems": "Patient denies experiencing any vomiting, blood in stool, or gastric pain. Reports 5 kg weight loss over 3 months, denies any rashes."
+        },
+        "Physical_Examination_Findings": {
+          "Vital_Signs": {
+            "Temperature": "36.7°C (98.1°F)",
+            "Blood_Pressure": "115/70 mmHg",
+            "Heart_Rate": "82 bpm",
+            "Respiratory_Rate": "17 breaths/min"
+          },
+          "Abdominal_Examination": {
+            "Inspection": "Flat abdomen",
+            "Auscultation": "Increased bowel sounds",
+            "Percussion": "Tympanic sound throughout",
+            "Palpation": "Mild, diffuse abdominal tenderness"
+          }
+        },
+        "Test_Results": {
+          "Blood_Tests": {
+            "Hemoglobin": "Low",
+            "Iron_Studies": {
+              "Serum_Iron": "Low",
+              "Transferrin_Saturation": "Low",
+              "Ferritin": "Low",
+		"Anti TTG-IgA": "Positive",
+		"Anti-EMA": "Positive",
+		"IgA-Titre": "Normal"
+            }
+          },
+          "Stool_Analysis": {
+            "Macroscopic_Appearance": "Normal",
+            "Fecal_Fat_Stain": "Positive"
+          },
+          "Upper_Endoscopy": {
+            "Findings": "Villous atrophy in the duodenum"
+          },
+          "Small_Bowel_Biopsy": {
+            "Histopathology": "Villous atrophy with crypt hyperplasia and intraepithelial lymphocytosis"
+          },
+"Colonoscopy": {
+            "Findings": "Normal"
+          }
+        },
+        "Correct_Diagnosis": "Celiac disease"
+      }
+    }
+  },
+{
+  "Presenting complaint": "Abdominal pain, migrating from epigastrium to right lower quadrant",
+  "case": {
+    "OSCE_Examination": {
+      "Patient_Actor": {
+        "Demographics": "28-year-old male",
+        "History": "The patient presents with a 36-hour history of abdominal pain. He states the pain initially began around his epigastrium, described as a persistent dull ache. Over the last 12 hours, the pain has become more constant and has shifted, now predominantly felt in the right lower quadrant, with some associated discomfort radiating to his right flank. He rates the pain as 5/10, exacerbated by movement and coughing. He experienced one episode of nausea this morning but has not vomited. His appetite is noticeably reduced, though he is not completely anorexic. His last bowel movement was yesterday and was normal; he now feels slightly constipated. He also reports a mild burning sensation at the end of urination for the past day, but denies increased urinary frequency, urgency, or visible blood in his urine. He mentions consuming some 'questionable leftovers' two days prior, but no one else who ate them has reported illness.",
+        "Symptoms": {
+          "Primary_Symptom": "Abdominal pain, migrating from epigastrium to right lower quadrant",
+          "Secondary_Symptoms": [
+            "Nausea (one episode)",
+            "Reduced appetite",
+            "Slight constipation",
+            "Mild dysuria"
+          ]
+        },
+        "Past_Medical_History": "Generally healthy. No chronic illnesses. No previous abdominal surgeries. No history of inflammatory bowel disease. No known drug allergies.",
+        "Social_History": "Non-smoker. Drinks socially, approximately 2-3 beers on weekends. Works as a graphic designer. Denies illicit drug use.",
+        "Medications": "No regular medications. Takes ibuprofen occasionally for headaches.",
+        "Review_of_Systems": "Patient reports the abdominal pain as his main concern. Denies fever at home (though measured 37.6°C in clinic), denies chills or night sweats. Denies significant recent weight loss. Denies chest pain, palpitations, or shortness of breath. Denies melena or hematochezia. Denies rash or joint pains. Confirms mild dysuria but denies frank hematuria, true urinary urgency, or flank pain distinct from his described abdominal discomfort."
+      },
+      "Physical_Examination_Findings": {
+        "Vital_Signs": {
+          "Temperature": "37.6°C (99.7°F)",
+          "Blood_Pressure": "125/80 mmHg",
+          "Heart_Rate": "92 bpm",
+          "Respiratory_Rate": "18 breaths/min",
+          "Oxygen_Saturation": "99% on room air"
+        },
+        "General_Appearance": "Alert and oriented. Appears uncomfortable and is observed to shift position frequently on the examination table. Not in acute distress.",
+        "Abdominal_Examination": {
+          "Inspection": "Abdomen is flat. No visible scars, distension, or discoloration. Umbilicus is central and inverted.",
+          "Auscultation": "Bowel sounds are present but slightly hypoactive in all four quadrants. No abdominal bruits.",
+          "Percussion": "Mild tympany throughout. Tender to light percussion over the right lower quadrant and extending slightly to the right flank. No shifting dullness.",
+          "Palpation": "Maximal tenderness on palpation in the right lower quadrant, slightly medial to McBurney's point. Some voluntary guarding noted in this area. No definite rebound tenderness elicited, though the patient winces and pulls away upon rapid withdrawal of pressure. Rovsing's sign is equivocal. Psoas and Obturator signs are negative. No palpable masses. Liver edge not palpable; spleen not palpable. No hepatosplenomegaly."
+        },
+        "Cardiovascular_Examination": "Regular rate and rhythm. S1 and S2 heart sounds normal. No murmurs, rubs, or gallops.",
+        "Respiratory_Examination": "Chest clear to auscultation bilaterally. No wheezes, rales, or rhonchi. Symmetric chest expansion.",
+        "Back_Examination": "No costovertebral angle tenderness elicited bilaterally."
+      },
+      "Test_Results": {
+        "Blood_Tests": {
+          "Complete_Blood_Count": {
+            "WBC": "11.5 x 10^9/L",
+            "Hemoglobin": "14.5 g/dL",
+            "Hematocrit": "43%",
+            "Platelets": "250 x 10^9/L",
+            "Neutrophils": "75%",
+            "Lymphocytes": "18%",
+            "Monocytes": "5%",
+            "Eosinophils": "2%"
+          },
+          "C_Reactive_Protein": "35 mg/L",
+          "Electrolytes_and_Renal_Function": {
+            "Sodium": "138 mmol/L",
+            "Potassium": "4.0 mmol/L",
+            "Chloride": "102 mmol/L",
+            "Bicarbonate": "24 mmol/L",
+            "Urea": "5.0 mmol/L",
+            "Creatinine": "80 µmol/L"
+          },
+          "Liver_Function_Tests": {
+            "ALT": "25 U/L",
+            "AST": "22 U/L",
+            "ALP": "70 U/L",
+            "Total_Bilirubin": "0.8 mg/dL"
+          },
+          "Amylase": "60 U/L"
+        },
+        "Urine_Analysis": {
+          "Dipstick": {
+            "Color": "Yellow",
+            "Clarity": "Clear",
+            "Specific_Gravity": "1.015",
+            "pH": "6.0",
+            "Leukocytes": "Trace",
+            "Nitrite": "Negative",
+            "Protein": "Negative",
+            "Glucose": "Negative",
+            "Ketones": "Negative",
+            "Urobilinogen": "Normal",
+            "Bilirubin": "Negative",
+            "Blood": "Trace"
+          },
+          "Microscopy": {
+            "WBC_per_HPF": "2-5",
+            "RBC_per_HPF": "1-3",
+            "Bacteria": "None seen",
+            "Casts": "None seen",
+            "Epithelial_cells": "Few"
+          }
+        },
+        "Imaging": {
+          "Abdominal_Ultrasound_RLQ_Pelvis": {
+            "Findings": "Focused examination of the right lower quadrant demonstrates limited views due to overlying bowel gas. The appendix was not definitively visualized. No free fluid or obvious abscess collection identified in the RLQ. Kidneys appear sonographically normal bilaterally. Bladder unremarkable. No other acute sonographic abnormality identified to explain the patient's symptoms."
+          },
+          "CT_Abdomen_Pelvis_with_IV_contrast": {
+            "Findings": "The appendix is identified, measuring 7mm in maximal transverse diameter with associated mild circumferential wall thickening and periappendiceal fat stranding. A small amount of simple free fluid is noted adjacent to the appendiceal tip. No definite appendicolith visualized. No evidence of abscess formation or frank perforation. Several mildly prominent mesenteric lymph nodes, up to 8mm in short axis, are seen in the right lower quadrant, likely reactive. The visualized small and large bowel are otherwise unremarkable. Liver, spleen, pancreas, kidneys, and adrenal glands are normal. No acute pelvic pathology identified."
+          }
+        }
+      },
+      "Correct_Diagnosis": "Acute appendicitis (non-perforated)"
+    }
+  }
+}
+
+"""
+
+# A single complete exemplar (the shortest one, the coeliac disease case) used by compact prompts.
+COMPACT_EXAMPLE_JSON_FORMAT = "\n" + example_json_format[
+    example_json_format.index('{\n    "Presenting complaint": "Weight loss"'):
+    example_json_format.index('{\n  "Presenting complaint": "Abdominal pain, migrating')
+].rstrip().rstrip(',') + "\n"
+
+# The generation prompt, verbatim (text and order) from the original generation scripts.
+PROMPT_TEMPLATE = """
+
+                
+You are a clinical assistant generating synthetic training data of medical cases. Your output will be parsed as JSON, so **valid JSON formatting is critical**.
+
+📌 TASK: Create a detailed medical case about {differential} for a {complaint} complaint.
+
+Include:
+1. **Pertinent positive AND negative findings** in:
+   - History (e.g. denies urinary symptoms, no past abdominal surgery)
+   - Examination (e.g. no focal neurology, no hepatosplenomegaly)
+   - Investigations (e.g. normal ECG, negative troponin, normal lipase)
+
+   EXTREMELY IMPORTANT INSTRUCTIONS:
+1. Return ONLY a valid JSON object, nothing else.
+2. Do NOT include ```json or ``` tags around your output.
+3. Make sure all strings are enclosed in double quotes, not single quotes.
+4. Do NOT add any comments or extra text before or after the JSON.
+5. Ensure EVERY string is properly closed with a matching quote.
+6. Make sure your JSON is valid and can be parsed by standard JSON parsers.
+7. Use the EXACT field names shown in the example below.
+
+2. These findings should help **narrow the differential diagnosis** — by ruling out common or dangerous alternatives.
+
+3. All investigations ordered should be **relevant to the presenting complaint** and help confirm the diagnosis of {differential}, or rule out other differentials.
+
+For this case, create a realistic presentation with an adequate amount of medical uncertainty that would lead to a diagnosis of {differential}.
+
+**Refrain from including pathognomonic signs of diseases in the case**
+
+**Refrain from creating history and exam findings that are too obvious**
+
+ESPECIALLY in the history, make it less obvious. Make the symptoms of the correct diagnosis less classical. 
+
+**Reduce the number of typical symptoms and signs**.
+
+Make the diagnostic process difficult.
+
+Difficulty can be increased in cases in the form of **more diagnostically complicated (e.g. red herrings, findings or investigations that don't fit typically into the case)**, **less typical symptoms/signs**, **subtle or absent signs**.
+
+Please generate a detailed and realistic OSCE-style medical case that focuses on {differential} as the correct diagnosis.
+
+Return only valid JSON. No explanation text before or after the JSON object. 
+
+Use the EXACT field names and EXACT ORDER AND EXACT STRUCTURE as shown below. 
+
+Provide the diagnosis only at the end of the case.
+Example format:
+{example_json_format}
+
+"""
+
+# --prompt-cache layout: the static part first so it can be cached, the target last.
+PROMPT_PREFIX_TEMPLATE = """
+
+You are a clinical assistant generating synthetic training data of medical cases. Your output will be parsed as JSON, so **valid JSON formatting is critical**.
+
+📌 TASK: Create a detailed medical case about the TARGET DIAGNOSIS for the PRESENTING COMPLAINT given at the end of this prompt.
+
+Include:
+1. **Pertinent positive AND negative findings** in:
+   - History (e.g. denies urinary symptoms, no past abdominal surgery)
+   - Examination (e.g. no focal neurology, no hepatosplenomegaly)
+   - Investigations (e.g. normal ECG, negative troponin, normal lipase)
+
+   EXTREMELY IMPORTANT INSTRUCTIONS:
+1. Return ONLY a valid JSON object, nothing else.
+2. Do NOT include ```json or ``` tags around your output.
+3. Make sure all strings are enclosed in double quotes, not single quotes.
+4. Do NOT add any comments or extra text before or after the JSON.
+5. Ensure EVERY string is properly closed with a matching quote.
+6. Make sure your JSON is valid and can be parsed by standard JSON parsers.
+7. Use the EXACT field names shown in the example below.
+
+2. These findings should help **narrow the differential diagnosis** — by ruling out common or dangerous alternatives.
+
+3. All investigations ordered should be **relevant to the presenting complaint** and help confirm the target diagnosis, or rule out other differentials.
+
+For this case, create a realistic presentation with an adequate amount of medical uncertainty that would lead to the target diagnosis.
+
+**Refrain from including pathognomonic signs of diseases in the case**
+
+**Refrain from creating history and exam findings that are too obvious**
+
+ESPECIALLY in the history, make it less obvious. Make the symptoms of the correct diagnosis less classical. 
+
+**Reduce the number of typical symptoms and signs**.
+
+Make the diagnostic process difficult.
+
+Difficulty can be increased in cases in the form of **more diagnostically complicated (e.g. red herrings, findings or investigations that don't fit typically into the case)**, **less typical symptoms/signs**, **subtle or absent signs**.
+
+Return only valid JSON. No explanation text before or after the JSON object. 
+
+Use the EXACT field names and EXACT ORDER AND EXACT STRUCTURE as shown below. 
+
+Provide the diagnosis only at the end of the case.
+Example format:
+{example_json_format}
+
+"""
+
+PROMPT_SUFFIX_TEMPLATE = """
+📌 TARGET: Create a detailed medical case about {differential} for a {complaint} complaint.
+
+Please generate a detailed and realistic OSCE-style medical case that focuses on {differential} as the correct diagnosis.
+"""
+
+
+def _exemplars(compact):
+    return COMPACT_EXAMPLE_JSON_FORMAT if compact else example_json_format
+
+
+@lru_cache(maxsize=None)
+def build_prompt_prefix(compact=False, split=False):
+    """Return the static prompt prefix (built once per process); empty unless `split` (--prompt-cache)."""
+    if not split:
+        return ""
+    return PROMPT_PREFIX_TEMPLATE.format(example_json_format=_exemplars(compact))
+
+
+def build_prompt_suffix(differential, complaint, compact=False, split=False):
+    """Return the per-job part of the prompt: the whole PROMPT_TEMPLATE prompt unless `split`."""
+    if not split:
+        return build_prompt(differential, complaint, compact)
+    return PROMPT_SUFFIX_TEMPLATE.format(differential=differential, complaint=complaint)
+
+
+def build_prompt(differential, complaint, compact=False):
+    """Return the full default (PROMPT_TEMPLATE) prompt for one (complaint, differential) job."""
+    return PROMPT_TEMPLATE.format(differential=differential, complaint=complaint, example_json_format=_exemplars(compact))
+
+
+def exemplar_tokens_saved(compact):
+    """Prompt tokens the compact exemplar saves per call compared with the three full exemplars."""
+    if not compact:
+        return 0
+    return estimate_tokens(example_json_format) - estimate_tokens(COMPACT_EXAMPLE_JSON_FORMAT)
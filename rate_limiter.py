@@ -0,0 +1,208 @@
+"""
+Shared rate limiting and retry back-off for model calls.
+
+Both generation scripts send every model.generate_content call through a
+RateLimiter, which enforces a requests-per-minute and (optionally) a
+tokens-per-minute budget with token buckets. The request rate is adapted with
+AIMD: each successful call raises it additively up to the configured budget,
+and each 429/503-style error cuts it multiplicatively. The request bucket only
+holds REQUEST_BURST_SECONDS worth of requests, so neither the start of a run
+nor the calls after a rate cut go out as one large burst. Per-job retries use
+exponential back-off with full jitter via backoff_delay().
+"""
+
+import random
+import threading
+import time
+
+from run_logging import get_logger
+
+logger = get_logger("rate_limiter")
+
+# Exception class names (google.api_core / grpc) that mean "slow down".
+RATE_LIMIT_EXCEPTION_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable"}
+RATE_LIMIT_STATUS_CODES = (429, 503)
+# gRPC status code names for the same errors.
+RATE_LIMIT_GRPC_STATUSES = {"RESOURCE_EXHAUSTED", "UNAVAILABLE"}
+# Seconds of the request budget that may be sent back to back.
+REQUEST_BURST_SECONDS = 2.0
+
+
+def is_rate_limit_error(exc):
+    """
+    Return True for a 429/503 quota or overload error.
+
+    Classified by exception type and status code only; the message is not
+    inspected, so unrelated errors that happen to mention e.g. "quota" or a
+    number like 503 are not mistaken for rate limiting.
+    """
+    if type(exc).__name__ in RATE_LIMIT_EXCEPTION_NAMES:
+        return True
+    for attribute in ("code", "status_code", "grpc_status_code"):
+        code = getattr(exc, attribute, None)
+        if callable(code):
+            # grpc.RpcError.code() returns a StatusCode.
+            try:
+                code = code()
+            except Exception:
+                continue
+        if isinstance(code, int) and code in RATE_LIMIT_STATUS_CODES:
+            return True
+        if getattr(code, "name", None) in RATE_LIMIT_GRPC_STATUSES:
+            return True
+    return False
+
+
+def backoff_delay(attempt, base=2.0, cap=60.0):
+    """Exponential back-off with full jitter for a 1-based attempt number."""
+    return random.uniform(0, min(cap, base * (2 ** (max(attempt, 1) - 1))))
+
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token) used for budgeting before a call."""
+    return max(1, len(text) // 4)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `rate_per_minute`.
+
+    The bucket holds `burst_seconds` worth of tokens (at least one) and starts
+    full; its capacity follows the rate, so lowering the rate also shrinks the
+    burst. acquire() reserves tokens immediately (the balance may go negative)
+    and sleeps for the time needed to pay off the debt, so concurrent callers
+    are served in arrival order without busy-waiting.
+    """
+
+    def __init__(self, rate_per_minute, burst_seconds=60.0):
+        self._lock = threading.Lock()
+        self.burst_seconds = burst_seconds
+        self.rate_per_minute = float(rate_per_minute)
+        self.capacity = self._capacity_for(self.rate_per_minute)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _capacity_for(self, rate_per_minute):
+        return max(1.0, rate_per_minute * self.burst_seconds / 60.0)
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate_per_minute / 60.0)
+        self.updated_at = now
+
+    def set_rate(self, rate_per_minute):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate_per_minute = float(rate_per_minute)
+            self.capacity = self._capacity_for(self.rate_per_minute)
+            # After a cut, tokens saved up at the old rate must not go out as one burst.
+            self.tokens = min(self.tokens, self.capacity)
+
+    def acquire(self, amount=1.0):
+        # A single request larger than a minute's budget is charged as one minute's worth.
+        amount = min(float(amount), max(self.capacity, self.rate_per_minute))
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            wait = 0.0 if self.tokens >= 0 else -self.tokens * 60.0 / self.rate_per_minute
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def refund(self, amount):
+        """Return (or, with a negative amount, charge) tokens after the real cost is known."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute / tokens-per-minute scheduler shared by all workers.
+
+    The request rate starts at `requests_per_minute` and is adapted with AIMD:
+    +`additive_increase` RPM per successful call (capped at the budget) and
+    x`decrease_factor` on a rate-limit error, at most once per
+    `cooldown_seconds` so a burst of concurrent 429s only counts once.
+    `tokens_per_minute` of None or 0 disables the token budget.
+    """
+
+    def __init__(self, requests_per_minute=60, tokens_per_minute=None, min_requests_per_minute=1,
+                 additive_increase=1.0, decrease_factor=0.5, cooldown_seconds=5.0):
+        self._lock = threading.Lock()
+        self.max_requests_per_minute = float(requests_per_minute)
+        self.min_requests_per_minute = float(min(min_requests_per_minute, requests_per_minute))
+        self.current_requests_per_minute = float(requests_per_minute)
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.request_bucket = TokenBucket(requests_per_minute, REQUEST_BURST_SECONDS)
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._last_decrease = 0.0
+        self.calls = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self, estimated_tokens=0, requests=1):
+        """Block until both budgets allow `requests` more requests of roughly `estimated_tokens` tokens in total."""
+        waited = self.request_bucket.acquire(requests)
+        if self.token_bucket is not None and estimated_tokens:
+            waited += self.token_bucket.acquire(estimated_tokens)
+        with self._lock:
+            self.wait_seconds += waited
+
+    def record_success(self, estimated_tokens=0, actual_tokens=None, requests=1):
+        with self._lock:
+            self.calls += requests
+            new_rate = min(self.max_requests_per_minute, self.current_requests_per_minute + self.additive_increase)
+            if new_rate != self.current_requests_per_minute:
+                self.current_requests_per_minute = new_rate
+                # Under the lock, so a concurrent decrease cannot leave the bucket on an older rate.
+                self.request_bucket.set_rate(new_rate)
+        if self.token_bucket is not None and actual_tokens is not None and estimated_tokens:
+            self.token_bucket.refund(estimated_tokens - actual_tokens)
+
+    def record_throttle(self, requests=1):
+        now = time.monotonic()
+        with self._lock:
+            self.calls += requests
+            self.throttled += 1
+            if now - self._last_decrease < self.cooldown_seconds:
+                return
+            self._last_decrease = now
+            new_rate = max(self.min_requests_per_minute, self.current_requests_per_minute * self.decrease_factor)
+            self.current_requests_per_minute = new_rate
+            self.request_bucket.set_rate(new_rate)
+        logger.warning(f"🐢 Rate limited by the model endpoint, reducing request rate to {new_rate:.1f} RPM",
+                       extra={"requests_per_minute": round(new_rate, 1)})
+
+    def call(self, func, *args, estimated_tokens=0, requests=1, **kwargs):
+        """
+        Call func(*args, **kwargs) within the budgets and feed the outcome back into AIMD.
+
+        `requests` is how many model requests func makes (e.g. one per
+        candidate when a backend fans out); each is charged to the request budget.
+        Exceptions are re-raised unchanged; callers decide whether to retry
+        (normally after sleeping for backoff_delay(attempt)).
+        """
+        self.acquire(estimated_tokens, requests)
+        try:
+            response = func(*args, **kwargs)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.record_throttle(requests)
+            raise
+        usage = getattr(response, "usage_metadata", None)
+        actual_tokens = getattr(usage, "total_token_count", None) if usage is not None else None
+        self.record_success(estimated_tokens, actual_tokens, requests)
+        return response
+
+    def summary(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "current_requests_per_minute": round(self.current_requests_per_minute, 2),
+                "wait_seconds": round(self.wait_seconds, 2),
+            }
@@ -0,0 +1,504 @@
+"""
+Single-pass parser for model responses.
+
+parse_model_json() replaces the old multi-stage cleaning chain (markdown regex,
+prefix/suffix trimming, whole-string brace counting, trailing-string regex,
+json.loads, then json_repair over the whole text again). A well-formed
+response is decoded directly from its first '{' or '['; otherwise one linear
+scan over the structural tokens of the response completes it:
+
+- Leading text (a ```json fence or prose) before the first '{' or '[' is skipped.
+- Brackets are tracked with a stack and string literals are matched as whole
+  tokens, so braces inside strings do not count and the scan stops as soon as
+  the top-level value closes; trailing text such as a closing fence is ignored.
+- If the response is truncated, the open string is closed, a dangling comma,
+  colon or key is completed, and the open brackets are closed in order.
+
+The completed text is parsed with json.loads, and json_repair is used only if that
+fails. extract_case() adds the checks both generation scripts share
+(single-element arrays, "Presenting complaint", "case" and a structure
+validator); extract_candidates() applies it to every candidate of a
+multi-candidate call.
+
+Run as a script to benchmark the parser against the saved raw responses
+(an artefact store or a directory of *.txt files):
+
+    python response_parser.py artefacts/store --repeat 5
+
+parse_benchmark.py times each stage separately, over synthetic variants too.
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import time
+
+from json_repair import repair_json as json_repair
+
+from artefact_store import ArtefactStore, KIND_RAW_RESPONSE
+
+# A complete or truncated string literal (the "closed" group is missing when the
+# text ends inside the string), or a single structural character.
+TOKEN_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*(?:(?P<closed>")|\\?\Z)|[{}\[\]:,]', re.DOTALL)
+CLOSERS = {'{': '}', '[': ']'}
+_DECODER = json.JSONDecoder()
+# How many '{' extract_case() tries in total when the first container in a response is not a case.
+MAX_CONTAINER_ATTEMPTS = 8
+
+
+def _first_container(text):
+    """Index of the first '{' or '[' in text, or -1."""
+    brace = text.find('{')
+    bracket = text.find('[')
+    if brace == -1 or bracket == -1:
+        return max(brace, bracket)
+    return min(brace, bracket)
+
+
+def _describe_skipped(skipped_text, where):
+    skipped_text = skipped_text.strip()
+    if skipped_text.strip('`').strip().lower() in ("", "json"):
+        return f"removed {where} markdown code fence"
+    return f"skipped {len(skipped_text)} characters of {where} text"
+
+
+def complete_json_text(response_text, start=None):
+    """
+    Return (json_text, repairs): the JSON value found in response_text, with
+    truncation repaired, and a list of human-readable repairs applied.
+
+    The value starts at the first '{' or '[' (or at `start`); json_text is
+    None if the response contains neither.
+    """
+    repairs = []
+    if start is None:
+        start = _first_container(response_text)
+    if start == -1:
+        return None, repairs
+    if response_text[:start].strip():
+        repairs.append(_describe_skipped(response_text[:start], "leading"))
+
+    # One entry per open container: [opening char, object is expecting a key].
+    stack = []
+    end = None
+    truncated_string = False
+    last_was_string = False
+    for match in TOKEN_PATTERN.finditer(response_text, start):
+        token = match.group()
+        char = token[0]
+        if char == '"':
+            if match.group("closed") is None:
+                truncated_string = True
+                break
+            last_was_string = True
+            continue
+        last_was_string = False
+        if char in CLOSERS:
+            stack.append([char, char == '{'])
+        elif char in '}]':
+            if not stack or CLOSERS[stack[-1][0]] != char:
+                # Mismatched bracket: leave it to json.loads/json_repair.
+                end = len(response_text)
+                break
+            stack.pop()
+            if not stack:
+                end = match.end()
+                break
+        elif char == ':':
+            stack[-1][1] = False
+        elif char == ',' and stack[-1][0] == '{':
+            stack[-1][1] = True
+
+    if end is not None:
+        if response_text[end:].strip():
+            repairs.append(_describe_skipped(response_text[end:], "trailing"))
+        return response_text[start:end], repairs
+
+    # Truncated: complete the value at the point where the text stops.
+    json_text = response_text[start:].rstrip()
+    expecting_key = bool(stack) and stack[-1][0] == '{' and stack[-1][1]
+    if truncated_string:
+        # A lone trailing backslash would escape the closing quote.
+        trailing_backslashes = len(json_text) - len(json_text.rstrip('\\'))
+        if trailing_backslashes % 2:
+            json_text = json_text[:-1]
+        json_text += '"'
+        repairs.append("closed truncated string")
+        if expecting_key:
+            json_text += ': null'
+    elif json_text.endswith(','):
+        json_text = json_text[:-1]
+        repairs.append("removed dangling comma")
+    elif json_text.endswith(':'):
+        json_text += ' null'
+        repairs.append("completed dangling key with null")
+    elif last_was_string and expecting_key:
+        json_text += ': null'
+        repairs.append("completed dangling key with null")
+    if stack:
+        json_text += "".join(CLOSERS[char] for char, _ in reversed(stack))
+        repairs.append(f"closed {len(stack)} unclosed brackets")
+    return json_text, repairs
+
+
+# Characters that matter to IncrementalJsonScanner before the value, inside it, and inside a string.
+_OPENERS = re.compile(r'[{\[]')
+_STRUCTURAL = re.compile(r'[{}\[\]"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class IncrementalJsonScanner:
+    """
+    Follow a streamed response chunk by chunk and report when its JSON object
+    closes, so the caller can stop reading the stream.
+
+    Only brackets and string delimiters are looked at, with the state
+    (open brackets, inside a string, a pending escape) carried across chunk
+    boundaries; as in complete_json_text(), text before the first '{' or '['
+    is skipped and braces inside strings do not count. A top-level value only
+    completes the scan if it is an object raw_decode accepts; anything else
+    (leading prose such as "Note [1]" or "use {braces}") is skipped and the
+    scan continues after it, as extract_case() does.
+
+        scanner = IncrementalJsonScanner()
+        for chunk in stream:
+            if scanner.feed(chunk):
+                break  # the object is complete; anything after it is a fence or prose
+    """
+
+    def __init__(self):
+        self.length = 0    # characters fed so far
+        self.start = None  # offset of the current top-level '{' or '['
+        self.end = None    # offset just past the bracket closing the object, once complete
+        self.depth = 0
+        self._in_string = False
+        self._escaped = False  # the last chunk ended on a backslash inside a string
+        # Chunks since the one holding `start`, and the offset of the first, for decoding the closed value.
+        self._chunks = []
+        self._chunks_offset = 0
+
+    @property
+    def complete(self):
+        return self.end is not None
+
+    def _is_object(self, end):
+        text = "".join(self._chunks)
+        start = self.start - self._chunks_offset
+        if text[start] != '{':
+            return False
+        try:
+            _, value_end = _DECODER.raw_decode(text, start)
+        except json.JSONDecodeError:
+            return False
+        return value_end == end - self._chunks_offset
+
+    def feed(self, chunk):
+        """Scan the next chunk; returns True once the top-level object has closed."""
+        if self.end is not None:
+            return True
+        if self.start is not None:
+            self._chunks.append(chunk)
+        pos = 0
+        if self._escaped and chunk:
+            pos = 1
+            self._escaped = False
+        size = len(chunk)
+        while pos < size:
+            if self.start is None:
+                match = _OPENERS.search(chunk, pos)
+                if match is None:
+                    break
+                self.start = self.length + match.start()
+                self.depth = 1
+                self._chunks = [chunk]
+                self._chunks_offset = self.length
+                pos = match.end()
+            elif self._in_string:
+                match = _STRING_SPECIAL.search(chunk, pos)
+                if match is None:
+                    break
+                if match.group() == '\\':
+                    if match.end() == size:
+                        self._escaped = True
+                    pos = match.end() + 1
+                else:
+                    self._in_string = False
+                    pos = match.end()
+            else:
+                match = _STRUCTURAL.search(chunk, pos)
+                if match is None:
+                    break
+                char = match.group()
+                pos = match.end()
+                if char == '"':
+                    self._in_string = True
+                elif char in CLOSERS:
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        if self._is_object(self.length + pos):
+                            self.end = self.length + pos
+                            self.length += size
+                            return True
+                        # Not the object (e.g. "[1]" in leading prose): keep scanning after it.
+                        self.start = None
+                        self._chunks = []
+        self.length += size
+        return False
+
+
+def parse_model_json(response_text):
+    """
+    Parse the JSON value in a model response.
+
+    Returns a dict with:
+        "data": the parsed value, or None
+        "repairs": list of repairs applied before parsing
+        "parse_error": the json.loads error (with context) if json_repair was needed, else None
+        "used_json_repair": True if json_repair produced "data"
+        "error": why parsing failed, or None
+    """
+    return _parse_from(response_text, _first_container(response_text))[0]
+
+
+def _parse_from(response_text, start, decode_only=False):
+    """
+    parse_model_json() of the value starting at `start`; returns (result, end of the value if it decoded cleanly).
+
+    With `decode_only` only the raw_decode fast path is tried: no completion, json.loads or json_repair.
+    """
+    result = {"data": None, "repairs": [], "parse_error": None, "used_json_repair": False, "error": None}
+    if start == -1:
+        result["error"] = "No JSON object or array found in the response"
+        return result, None
+
+    # Fast path for the common well-formed response: the C decoder parses from the
+    # first bracket and reports where the value ends, without a Python-level scan.
+    try:
+        result["data"], end = _DECODER.raw_decode(response_text, start)
+    except json.JSONDecodeError as e:
+        if decode_only:
+            result["error"] = f"No JSON value decodes at offset {start}: {str(e)}"
+            return result, None
+    else:
+        if response_text[:start].strip():
+            result["repairs"].append(_describe_skipped(response_text[:start], "leading"))
+        if response_text[end:].strip():
+            result["repairs"].append(_describe_skipped(response_text[end:], "trailing"))
+        return result, end
+
+    json_text, result["repairs"] = complete_json_text(response_text, start)
+    try:
+        result["data"] = json.loads(json_text)
+        return result, None
+    except json.JSONDecodeError as e:
+        context = json_text[max(0, e.pos - 30):e.pos + 30]
+        result["parse_error"] = f"{str(e)} (near '...{context}...')"
+
+    # Last resort: the more tolerant (and much slower) json_repair.
+    try:
+        repaired = json_repair(json_text, return_objects=True)
+    except Exception as e:
+        result["error"] = f"json-repair failed: {str(e)}"
+        return result, None
+    if repaired in ("", None):
+        result["error"] = "json-repair could not recover a JSON value"
+        return result, None
+    result["data"] = repaired
+    result["used_json_repair"] = True
+    return result, None
+
+
+def extract_case(response_text, validator):
+    """
+    Parse a model response and check it holds one case.
+
+    `validator(case_content)` must return (passed, message), e.g.
+    validate_specific_key_nesting.
+
+    Returns the parse_model_json() dict plus:
+        "presenting_complaint": the model's "Presenting complaint" string, or None
+        "case": the "case" object, or None
+        "validation_failed": True if the response parsed but failed the validator
+        "validation_message": the validator's message, or None
+    On failure "error" says why the response was rejected.
+
+    Parsing starts at the first '{' or '['. If that container is not a case
+    (leading prose such as "Note [1]" or "use {braces}"), the next '{' after
+    it is tried, up to MAX_CONTAINER_ATTEMPTS containers; if none is a case,
+    the result for the first container is returned. Only the first container
+    goes through completion and json_repair; later ones must raw_decode
+    cleanly, so json_repair runs at most once per response.
+    """
+    start = _first_container(response_text)
+    first, end = _extract_case_at(response_text, start, validator)
+    result = first
+    attempts = 1
+    while (start != -1 and result["error"] is not None and not result["validation_failed"]
+           and attempts < MAX_CONTAINER_ATTEMPTS):
+        # Skip past a value that decoded cleanly; otherwise try the next '{' after its opening bracket.
+        start = response_text.find('{', end if end is not None else start + 1)
+        if start == -1:
+            break
+        result, end = _extract_case_at(response_text, start, validator, decode_only=True)
+        attempts += 1
+        if result["error"] is None or result["validation_failed"]:
+            return result
+    return first
+
+
+def _extract_case_at(response_text, start, validator, decode_only=False):
+    """extract_case() for the value starting at `start`; returns (result, end of the value if it decoded cleanly)."""
+    result, end = _parse_from(response_text, start, decode_only)
+    result.update({"presenting_complaint": None, "case": None, "validation_failed": False, "validation_message": None})
+    parsed = result["data"]
+    if result["error"] is not None:
+        return result, end
+
+    # The model sometimes wraps the object in an array.
+    if isinstance(parsed, list) and len(parsed) == 1:
+        result["repairs"].append("extracted the only object from a JSON array")
+        parsed = result["data"] = parsed[0]
+    elif isinstance(parsed, list):
+        result["error"] = f"Expected a JSON object, but got an array with {len(parsed)} elements"
+        return result, end
+    if not isinstance(parsed, dict):
+        result["error"] = f"Expected a JSON object, but got type {type(parsed).__name__}"
+        return result, end
+
+    presenting_complaint = parsed.get("Presenting complaint")
+    if not presenting_complaint or not isinstance(presenting_complaint, str):
+        result["error"] = "Missing, empty, or invalid type for 'Presenting complaint'"
+        return result, end
+    case_content = parsed.get("case")
+    if not isinstance(case_content, dict):
+        result["error"] = "Missing, empty, or incorrect type for field: 'case' (must be an object)"
+        return result, end
+
+    passed, message = validator(case_content)
+    result["validation_message"] = message
+    if not passed:
+        result["validation_failed"] = True
+        result["error"] = message
+        return result, end
+    result["presenting_complaint"] = presenting_complaint
+    result["case"] = case_content
+    return result, end
+
+
+def extract_candidates(response_texts, validator):
+    """
+    extract_case() for each candidate text of one call, in order (None for an empty candidate).
+
+    Every candidate is checked, not just up to the first valid one, so the
+    other valid candidates can be kept as alternates.
+    """
+    return [extract_case(text, validator) if text else None for text in response_texts]
+
+
+def _legacy_parse_model_json(response_text):
+    """The cleaning chain parse_model_json() replaced, kept only for benchmark comparison."""
+    cleaned_text = response_text
+    # Patterns copied verbatim, including their double-escaped backslashes.
+    markdown_match = re.search(r"^\\s*```(?:json)?\\s*\\n?(.*?)\\n?\\s*```\\s*$", response_text, re.DOTALL)
+    if markdown_match:
+        cleaned_text = markdown_match.group(1)
+    else:
+        if response_text.startswith("```json"):
+            cleaned_text = response_text[len("```json"):]
+        elif response_text.startswith("```"):
+            cleaned_text = response_text[len("```"):]
+        if cleaned_text.endswith("```"):
+            cleaned_text = cleaned_text[:-len("```")]
+    cleaned_text = cleaned_text.strip()
+    open_braces = cleaned_text.count('{')
+    close_braces = cleaned_text.count('}')
+    if open_braces > close_braces:
+        cleaned_text += "}" * (open_braces - close_braces)
+    if re.search(r'"([^"]+)"\\s*:\\s*"([^"]+)$', cleaned_text):
+        cleaned_text += '"'
+    try:
+        return json.loads(cleaned_text), False
+    except json.JSONDecodeError:
+        try:
+            return json_repair(cleaned_text, return_objects=True), True
+        except Exception:
+            return None, True
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def load_raw_responses(raw_dir):
+    """Raw response texts from an artefact store or a directory of *.txt files."""
+    if ArtefactStore.is_store(raw_dir):
+        store = ArtefactStore(raw_dir)
+        return [store.read_entry(entry) for entry in store.entries(KIND_RAW_RESPONSE)]
+    texts = []
+    for path in sorted(glob.glob(os.path.join(raw_dir, "*.txt"))):
+        with open(path, 'r', encoding='utf-8') as f:
+            texts.append(f.read())
+    return texts
+
+
+def benchmark(raw_dir, repeat=3):
+    """Time parse_model_json() against the legacy chain over every raw response in raw_dir."""
+    texts = load_raw_responses(raw_dir)
+    if not texts:
+        print(f"⚠️ No raw responses found in {raw_dir}")
+        return
+    total_bytes = sum(len(text.encode('utf-8')) for text in texts)
+    print(f"📊 Benchmarking {len(texts)} raw responses ({total_bytes / 1e6:.2f} MB) from {raw_dir}, {repeat} repeats")
+
+    def run(parse):
+        timings = []
+        parsed = fallbacks = 0
+        for text in texts:
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                outcome = parse(text)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+            data, used_fallback = outcome
+            parsed += isinstance(data, (dict, list)) and bool(data)
+            fallbacks += used_fallback
+        timings.sort()
+        return {
+            "parsed": parsed,
+            "json_repair_fallbacks": fallbacks,
+            "total_seconds": sum(timings),
+            "p50_ms": _percentile(timings, 0.50) * 1000,
+            "p99_ms": _percentile(timings, 0.99) * 1000,
+        }
+
+    def single_pass(text):
+        result = parse_model_json(text)
+        return result["data"], result["used_json_repair"]
+
+    results = {"single-pass": run(single_pass), "legacy": run(_legacy_parse_model_json)}
+    for name, stats in results.items():
+        throughput = total_bytes / 1e6 / stats["total_seconds"] if stats["total_seconds"] else 0.0
+        print(f"  {name:12} parsed {stats['parsed']}/{len(texts)}, json-repair fallbacks {stats['json_repair_fallbacks']}, "
+              f"p50 {stats['p50_ms']:.3f} ms, p99 {stats['p99_ms']:.3f} ms, {throughput:.1f} MB/s")
+    legacy_seconds = results["legacy"]["total_seconds"]
+    if results["single-pass"]["total_seconds"]:
+        print(f"⚡ Speed-up over the legacy chain: {legacy_seconds / results['single-pass']['total_seconds']:.2f}x")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the single-pass response parser against saved raw responses")
+    parser.add_argument("raw_dir", nargs="?", default=os.path.join("artefacts", "store"),
+                        help="Artefact store or directory of raw model responses (*.txt) (default: artefacts/store).")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timing repeats per response; the fastest is kept (default: 3).")
+    args = parser.parse_args()
+    benchmark(args.raw_dir, args.repeat)
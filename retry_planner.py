@@ -0,0 +1,209 @@
+"""
+Work planner for retry_failed_differentials.py.
+
+Which (complaint, differential) pairs already have a case is answered from a
+persistent completed index instead of listing every complaint folder and
+reading every *_all_cases.jsonl:
+
+- the run manifest (artefacts/run_manifest.jsonl), which main_generation.py
+  and retry_failed_differentials.py append to as each case is written, and
+- a one-off snapshot (artefacts/completed_index.jsonl) of the case files that
+  existed before the manifest did, built from file names only.
+
+Entries from either source count only while their case file still exists, so
+deleting a case file makes its differential outstanding again. Both are small
+JSONL files of names, so a plan over the full corpus takes
+milliseconds and never opens a case body. python retry_planner.py prints the
+plan without calling the model (the same as retry_failed_differentials.py --dry-run).
+"""
+
+import argparse
+import json
+import os
+import time
+
+from artefact_store import ArtefactStore
+from catalogue import Catalogue, get_catalogue, sanitize_filename, strip_suffix, all_normalized_forms
+from failure_ledger import FAILED_DIFFERENTIALS_FILENAME, read_failures
+from run_manifest import RunManifest, DEFAULT_MANIFEST_FILENAME, STATUS_SUCCEEDED
+
+DEFAULT_SNAPSHOT_FILENAME = "completed_index.jsonl"
+
+SOURCE_FAILED_LOG = FAILED_DIFFERENTIALS_FILENAME
+SOURCE_CATALOGUE = "catalogue"
+
+
+def completion_forms(differential):
+    """
+    Normalised forms a differential can be recorded under: its own, and those of its
+    sanitized file name (main_generation.py names case files sanitize_filename(differential)).
+    """
+    return all_normalized_forms(differential) | all_normalized_forms(sanitize_filename(differential))
+
+
+class CompletedIndex:
+    """Set of completed (complaint folder, normalised differential) pairs."""
+
+    def __init__(self, output_dir="artefacts", manifest=None, rebuild=False):
+        self.output_dir = output_dir
+        self.snapshot_path = os.path.join(output_dir, DEFAULT_SNAPSHOT_FILENAME)
+        self.manifest = manifest if manifest is not None else RunManifest(os.path.join(output_dir, DEFAULT_MANIFEST_FILENAME))
+        self._completed = set()
+        if rebuild or not os.path.exists(self.snapshot_path) or not self._load_snapshot():
+            self._write_snapshot()
+            self._load_snapshot()
+        for record in self.manifest.records():
+            self._add_record(record)
+
+    def _write_snapshot(self):
+        """Record the case files already on disk, by name only (run once, or with --rebuild-index)."""
+        entries = []
+        for complaint_folder in complaint_folders(self.output_dir):
+            with os.scandir(os.path.join(self.output_dir, complaint_folder)) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.lower().endswith('.json'):
+                        entries.append({"complaint_folder": complaint_folder, "differential": strip_suffix(entry.name[:-5]),
+                                        "path": entry.name})
+        os.makedirs(self.output_dir, exist_ok=True)
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.snapshot_path)
+        print(f"🗂️ Indexed {len(entries)} existing case files into {self.snapshot_path}")
+
+    def _load_snapshot(self):
+        """Add the snapshot entries whose case file still exists; False if the snapshot predates stored paths."""
+        with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        if any("path" not in entry for entry in entries):
+            return False
+        for entry in entries:
+            # Same rule as _add_record: a deleted case file means the job is outstanding again.
+            if os.path.exists(os.path.join(self.output_dir, entry["complaint_folder"], entry["path"])):
+                self.add(entry["complaint_folder"], entry["differential"])
+        return True
+
+    def _add_record(self, record):
+        if record.get("status") != STATUS_SUCCEEDED or not record.get("complaint") or not record.get("differential"):
+            return
+        # Same rule as RunManifest.completed_record: a deleted case file means the job is outstanding again.
+        output_path = record.get("output_path")
+        if not output_path or not os.path.exists(output_path):
+            return
+        self.add(sanitize_filename(record["complaint"]), record["differential"])
+
+    def add(self, complaint_folder, differential):
+        for form in completion_forms(differential):
+            self._completed.add((complaint_folder, form))
+
+    def is_completed(self, complaint_folder, differential):
+        return any((complaint_folder, form) in self._completed for form in completion_forms(differential))
+
+    def __len__(self):
+        return len(self._completed)
+
+
+def complaint_folders(output_dir="artefacts"):
+    """Complaint folders directly under output_dir, skipping hidden/system folders and the artefact store."""
+    if not os.path.isdir(output_dir):
+        return []
+    folders = []
+    with os.scandir(output_dir) as it:
+        for entry in it:
+            if not entry.is_dir() or entry.name.startswith('.') or entry.name == '__pycache__':
+                continue
+            if ArtefactStore.is_store(entry.path):
+                continue
+            folders.append(entry.name)
+    return sorted(folders)
+
+
+def plan_retries(output_dir="artefacts", catalogue=None, completed=None):
+    """
+    Build the retry work list.
+
+    Returns one dict per complaint folder with outstanding work:
+        "complaint_folder": folder name under output_dir
+        "complaint": the catalogue complaint name, or the folder name if it is not in the catalogue
+        "in_catalogue": whether the folder matched a catalogue complaint
+        "source": where the candidates came from (failed_differentials.jsonl or the catalogue)
+        "outstanding": differentials to generate, deduplicated by normalised name
+        "failures": failure ledger entry per outstanding differential (reason, attempts), if logged
+        "completed": candidates skipped because they already have a case
+    """
+    if catalogue is None:
+        catalogue = get_catalogue()
+    if completed is None:
+        completed = CompletedIndex(output_dir)
+    plan = []
+    for complaint_folder in complaint_folders(output_dir):
+        failed_path = os.path.join(output_dir, complaint_folder, FAILED_DIFFERENTIALS_FILENAME)
+        catalogue_complaint = catalogue.find_complaint(complaint_folder)
+        failures = {}
+        if os.path.exists(failed_path):
+            failures = read_failures(failed_path)
+            candidates = list(failures)
+            source = SOURCE_FAILED_LOG
+        elif catalogue_complaint is not None:
+            candidates = catalogue.differentials(catalogue_complaint)
+            source = SOURCE_CATALOGUE
+        else:
+            continue
+
+        seen = set()
+        outstanding = []
+        already_completed = []
+        for differential in candidates:
+            forms = all_normalized_forms(differential)
+            if forms & seen:
+                continue
+            seen |= forms
+            if completed.is_completed(complaint_folder, differential):
+                already_completed.append(differential)
+            else:
+                outstanding.append(differential)
+        if outstanding or already_completed:
+            plan.append({
+                "complaint_folder": complaint_folder,
+                "complaint": catalogue_complaint or complaint_folder,
+                "in_catalogue": catalogue_complaint is not None,
+                "source": source,
+                "outstanding": outstanding,
+                "failures": {differential: failures[differential] for differential in outstanding if differential in failures},
+                "completed": already_completed,
+            })
+    return plan
+
+
+def print_plan(plan, verbose=True):
+    """Print the retry plan; returns the number of outstanding differentials."""
+    total = sum(len(entry["outstanding"]) for entry in plan)
+    print(f"🗺️ Retry plan: {total} differentials outstanding across "
+          f"{sum(1 for entry in plan if entry['outstanding'])} complaints")
+    for entry in plan:
+        skipped = f", {len(entry['completed'])} already generated" if entry["completed"] else ""
+        print(f"  {entry['complaint_folder']}: {len(entry['outstanding'])} outstanding (from {entry['source']}{skipped})")
+        if verbose:
+            for differential in entry["outstanding"]:
+                failure = entry["failures"].get(differential) or {}
+                reason = f" ({failure['reason']} after {failure.get('attempts')} attempts)" if failure.get("reason") else ""
+                print(f"    - {differential}{reason}")
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the retry work list without calling the model")
+    parser.add_argument("--output-dir", default="artefacts", help="Artefacts directory (default: artefacts).")
+    parser.add_argument("--rebuild-index", action="store_true",
+                        help=f"Rescan case files into {DEFAULT_SNAPSHOT_FILENAME} before planning.")
+    parser.add_argument("--summary", action="store_true", help="Only print per-complaint counts.")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    try:
+        catalogue = get_catalogue()
+    except FileNotFoundError:
+        catalogue = Catalogue(None)
+    plan = plan_retries(args.output_dir, catalogue, CompletedIndex(args.output_dir, rebuild=args.rebuild_index))
+    print_plan(plan, verbose=not args.summary)
+    print(f"⏱️ Planned in {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,283 @@
+"""
+Structured, levelled logging for the generation scripts.
+
+Hot-path messages (per attempt, per response, per differential) go through
+loggers under "casegen" instead of print(). setup_run_logging() routes them
+through a QueueHandler, so worker threads only enqueue records, to a
+QueueListener thread that writes:
+
+- every record at INFO and above (DEBUG with --verbose) as one JSON object
+  per line to the run log (artefacts/run_log.jsonl by default), with the job
+  context fields (complaint, differential, attempt) set by job_context() in
+  the worker,
+- the console: with --verbose every record, otherwise only warnings and a
+  compact progress line (done / failed / in flight, rate and ETA).
+
+    with job_context(complaint=complaint, differential=differential):
+        logger.info("✅ Generated and saved case", extra={"output_path": path})
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOGGER_NAME = "casegen"
+DEFAULT_LOG_FILENAME = "run_log.jsonl"
+
+# Attributes every LogRecord has; anything else on a record came from extra= or the job context.
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_job_context = contextvars.ContextVar("casegen_job_context", default={})
+
+
+def get_logger(name):
+    """Logger for a module, e.g. get_logger("main_generation") -> casegen.main_generation."""
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+@contextlib.contextmanager
+def job_context(**fields):
+    """Attach fields (complaint, differential, attempt, ...) to every record logged in this block."""
+    token = _job_context.set({**_job_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _job_context.reset(token)
+
+
+class JobContextFilter(logging.Filter):
+    """
+    Copy the current job context onto the record.
+
+    Attached to the QueueHandler, so it runs in the thread that logged the
+    record, before queueing; that is where the job context is set.
+    """
+
+    def filter(self, record):
+        for key, value in _job_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+def record_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _STANDARD_ATTRIBUTES}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update(record_fields(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """The emoji message, prefixed with the job it belongs to when one is set."""
+
+    def format(self, record):
+        message = record.getMessage()
+        complaint = getattr(record, "complaint", None)
+        differential = getattr(record, "differential", None)
+        if differential:
+            attempt = getattr(record, "attempt", None)
+            label = f"{complaint} / {differential}" if complaint else differential
+            message = f"[{label}{f' #{attempt}' if attempt else ''}] {message}"
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        return message
+
+
+class ProgressView:
+    """
+    One-line progress summary for the console.
+
+    On a terminal the line is redrawn in place (at most every `interval`
+    seconds); otherwise a plain line is printed every `plain_interval` seconds.
+    """
+
+    def __init__(self, stream=None, interval=0.5, plain_interval=15.0):
+        self.stream = stream or sys.stdout
+        self.is_tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self.interval = interval if self.is_tty else plain_interval
+        self.lock = threading.RLock()
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.label = ""
+        # Off for --verbose runs, which print every attempt anyway.
+        self.visible = True
+        self.enabled = False
+        self._started = None
+        self._last_render = 0.0
+        self._line_visible = False
+        self._rendered_counts = None
+
+    def start(self, total, label=""):
+        with self.lock:
+            self.total = total
+            self.done = self.failed = self.in_flight = 0
+            self.label = label
+            self._started = time.monotonic()
+            self.enabled = self.visible and total > 0
+            self._render(force=True)
+
+    def add_total(self, count):
+        with self.lock:
+            self.total += count
+
+    def job_started(self):
+        with self.lock:
+            self.in_flight += 1
+            self._render()
+
+    def job_finished(self, succeeded, started=True):
+        with self.lock:
+            if started:
+                self.in_flight = max(0, self.in_flight - 1)
+            if succeeded:
+                self.done += 1
+            else:
+                self.failed += 1
+            self._render(force=self.done + self.failed >= self.total)
+
+    def finish(self):
+        with self.lock:
+            # A plain (non-terminal) stream already has the final counts if they were just printed.
+            if self.enabled and (self.is_tty or self._rendered_counts != (self.done, self.failed)):
+                self._render(force=True)
+                if self._line_visible:
+                    self.stream.write("\n")
+                    self.stream.flush()
+                    self._line_visible = False
+            self.enabled = False
+
+    def text(self):
+        finished = self.done + self.failed
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - finished
+        eta = f"{_format_duration(remaining / rate)}" if rate > 0 and remaining > 0 else ("0s" if remaining <= 0 else "?")
+        return (f"⏳ {self.label}{finished}/{self.total} ({self.done} ✅, {self.failed} ❌, {self.in_flight} in flight) "
+                f"{rate * 60:.1f}/min, elapsed {_format_duration(elapsed)}, ETA {eta}")
+
+    def clear(self):
+        """Erase the in-place line so a log message can be written (terminal only)."""
+        with self.lock:
+            if self._line_visible and self.is_tty:
+                self.stream.write("\r\033[K")
+                self._line_visible = False
+
+    def redraw(self):
+        with self.lock:
+            if self.enabled and self.is_tty:
+                self._render(force=True)
+
+    def _render(self, force=False):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_render < self.interval:
+            return
+        self._last_render = now
+        self._rendered_counts = (self.done, self.failed)
+        if self.is_tty:
+            self.stream.write("\r\033[K" + self.text())
+            self._line_visible = True
+        else:
+            self.stream.write(self.text() + "\n")
+        self.stream.flush()
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class ConsoleHandler(logging.StreamHandler):
+    """Console output that keeps the progress line below the log messages."""
+
+    def __init__(self, progress):
+        super().__init__(progress.stream)
+        self.progress = progress
+
+    def emit(self, record):
+        with self.progress.lock:
+            self.progress.clear()
+            super().emit(record)
+            self.progress.redraw()
+
+
+progress = ProgressView()
+_listener = None
+
+
+def setup_run_logging(log_path=None, verbose=False):
+    """
+    Route casegen loggers through a queue to the JSON-lines run log and the console.
+
+    DEBUG records are only emitted (to both the run log and the console)
+    with verbose, so hot-path debug messages cost nothing by default.
+    Safe to call more than once; the previous listener is stopped first.
+    Returns the log file path (None if file logging is disabled).
+    """
+    global _listener
+    shutdown_run_logging()
+    level = logging.DEBUG if verbose else logging.INFO
+    root = logging.getLogger(LOGGER_NAME)
+    root.setLevel(level)
+    root.propagate = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    handlers = []
+    if log_path:
+        directory = os.path.dirname(log_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = logging.FileHandler(log_path, mode='a', encoding='utf-8')
+        file_handler.setLevel(level)
+        file_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(file_handler)
+    console_handler = ConsoleHandler(progress)
+    console_handler.setLevel(logging.DEBUG if verbose else logging.WARNING)
+    console_handler.setFormatter(ConsoleFormatter())
+    handlers.append(console_handler)
+    progress.visible = not verbose
+
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(JobContextFilter())
+    root.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return log_path
+
+
+def shutdown_run_logging():
+    """Flush queued records and close the log handlers."""
+    global _listener
+    progress.finish()
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,98 @@
+"""
+Durable run manifest for resumable generation runs.
+
+The manifest is an append-only JSONL journal (artefacts/run_manifest.jsonl by
+default). Every finished (complaint, differential) job appends one record:
+
+    {"complaint": ..., "differential": ..., "attempt": 2, "status": "succeeded",
+     "output_path": "artefacts/Headache/Migraine.json", "presenting_complaint": ..., "timestamp": ...}
+
+On start-up the journal is replayed into a dict keyed by (complaint, differential),
+keeping the latest record per job, so checking whether a job is already done
+is a single dict lookup. Records are flushed and fsynced as they are written,
+so a crash or Ctrl-C loses at most the jobs that were still in flight.
+"""
+
+import json
+import os
+import threading
+import time
+
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+
+DEFAULT_MANIFEST_FILENAME = "run_manifest.jsonl"
+
+
+class RunManifest:
+    """Append-only journal of finished generation jobs, safe to share between worker threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from an interrupted write; the job simply reruns.
+                    print(f"⚠️ Ignoring unreadable manifest line {line_number} in {self.path}")
+                    continue
+                self._records[(record.get("complaint"), record.get("differential"))] = record
+
+    def __len__(self):
+        return len(self._records)
+
+    def records(self):
+        """The latest record of every recorded job (a snapshot, safe to iterate while workers record)."""
+        with self._lock:
+            return list(self._records.values())
+
+    def get(self, complaint, differential):
+        """Return the latest record for a job, or None if it has never finished."""
+        return self._records.get((complaint, differential))
+
+    def completed_record(self, complaint, differential):
+        """
+        Return the record of a successfully finished job whose output file still
+        exists, or None if the job needs to run.
+        """
+        record = self._records.get((complaint, differential))
+        if record is None or record.get("status") != STATUS_SUCCEEDED:
+            return None
+        output_path = record.get("output_path")
+        if not output_path or not os.path.exists(output_path):
+            return None
+        return record
+
+    def record(self, complaint, differential, attempt, status, output_path=None, **extra):
+        """Append a job record and make it durable before returning."""
+        record = {
+            "complaint": complaint,
+            "differential": differential,
+            "attempt": attempt,
+            "status": status,
+            "output_path": output_path,
+            "timestamp": time.time(),
+        }
+        record.update(extra)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._records[(complaint, differential)] = record
+        return record
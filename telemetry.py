@@ -0,0 +1,391 @@
+"""
+Run telemetry: model call latency, token usage and outcome counters.
+
+Both generation scripts feed the process-wide Telemetry from get_telemetry():
+
+- observe_call(): latency and outcome (ok / error / rate_limited) of each model call,
+- record_usage(): prompt/output/cached tokens per (complaint, category),
+- record_extraction(): how each response parsed (clean, repaired, json_repair,
+  rejected) and whether it passed validation,
+- record_stream(): for --stream runs, whether each response closed early,
+  ran to the end, or was cut off at the token limit,
+- record_hedge(): hedged requests issued and won (see hedging.py),
+- record_candidate(): with several candidates per call, whether each was
+  kept, stored as an alternate, rejected or empty,
+- record_job(): attempts per differential and whether it produced a case
+  (and when the first case of the run was accepted).
+
+At the end of a run write_reports() saves a JSON summary and a flat CSV of
+every metric, and optionally the same metrics in Prometheus text format (for
+node_exporter's textfile collector or a quick diff between runs):
+
+    python telemetry.py artefacts/run_metrics.json   # print a saved summary
+"""
+
+import argparse
+import bisect
+import csv
+import json
+import math
+import os
+import threading
+import time
+
+from rate_limiter import is_rate_limit_error
+
+# Upper bounds (seconds) of the model call latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, math.inf)
+# Upper bounds of the attempts-per-differential histogram buckets.
+ATTEMPT_BUCKETS = (1, 2, 3, 5, 10, 15, math.inf)
+
+CALL_OK = "ok"
+CALL_ERROR = "error"
+CALL_RATE_LIMITED = "rate_limited"
+
+PARSE_CLEAN = "clean"
+PARSE_REPAIRED = "repaired"
+PARSE_JSON_REPAIR = "json_repair"
+PARSE_REJECTED = "rejected"
+
+DEFAULT_METRICS_FILENAME = "run_metrics.json"
+PROMETHEUS_PREFIX = "casegen_"
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile (q in 0..100) of an already sorted list, or None if it is empty."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Histogram:
+    """Cumulative-bucket histogram that also keeps its samples for exact percentiles."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.samples = []
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.samples.append(value)
+        self.sum += value
+
+    @property
+    def count(self):
+        return len(self.samples)
+
+    def summary(self):
+        values = sorted(self.samples)
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets["+Inf" if bound == math.inf else str(bound)] = cumulative
+        return {
+            "count": len(values),
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / len(values), 6) if values else None,
+            "min": values[0] if values else None,
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else None,
+            "buckets": buckets,
+        }
+
+
+class Telemetry:
+    """Thread-safe metrics for one run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.call_latency = Histogram(LATENCY_BUCKETS)
+        self.attempts = Histogram(ATTEMPT_BUCKETS)
+        # (metric, ((label, value), ...)) -> count
+        self.counters = {}
+        # (complaint, category) -> token totals
+        self.tokens = {}
+        # Seconds from the start of generation to the first accepted case.
+        self.first_case_seconds = None
+
+    def start(self):
+        """Mark the start of generation (after planning and model setup); durations are measured from here."""
+        with self._lock:
+            self.started = time.time()
+            self.first_case_seconds = None
+
+    def _increment(self, metric, amount=1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def timed(self, func):
+        """Wrap a model call so its latency and outcome are recorded (rate limiter waits are excluded)."""
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                self.observe_call(time.perf_counter() - start, CALL_RATE_LIMITED if is_rate_limit_error(e) else CALL_ERROR)
+                raise
+            self.observe_call(time.perf_counter() - start, CALL_OK)
+            return response
+        return call
+
+    def observe_call(self, seconds, outcome=CALL_OK):
+        with self._lock:
+            self.call_latency.observe(seconds)
+            self._increment("model_calls", outcome=outcome)
+
+    def record_usage(self, complaint, category, response):
+        """Add a response's usage_metadata token counts to its (complaint, category) totals."""
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+        output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+        cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+        total_tokens = getattr(usage, "total_token_count", 0) or (prompt_tokens + output_tokens)
+        with self._lock:
+            totals = self.tokens.setdefault((complaint, category or "Unknown"),
+                                            {"calls": 0, "prompt": 0, "output": 0, "cached": 0, "total": 0})
+            totals["calls"] += 1
+            totals["prompt"] += prompt_tokens
+            totals["output"] += output_tokens
+            totals["cached"] += cached_tokens
+            totals["total"] += total_tokens
+
+    def record_extraction(self, extracted):
+        """Count how an extract_case() result parsed and whether it validated."""
+        if extracted["data"] is None:
+            parse_outcome = PARSE_REJECTED
+        elif extracted["used_json_repair"]:
+            parse_outcome = PARSE_JSON_REPAIR
+        elif extracted["repairs"]:
+            parse_outcome = PARSE_REPAIRED
+        else:
+            parse_outcome = PARSE_CLEAN
+        with self._lock:
+            self._increment("responses", parse=parse_outcome)
+            if extracted["validation_failed"]:
+                self._increment("validation", outcome="failed")
+            elif extracted["error"] is not None and extracted["data"] is not None:
+                self._increment("validation", outcome="wrong_shape")
+            elif extracted["error"] is None:
+                self._increment("validation", outcome="passed")
+
+    def record_stream(self, response):
+        """Count how a StreamedResponse ended (see model_backends.generate_streamed)."""
+        if not response.text:
+            outcome = "empty"
+        elif response.hit_token_limit:
+            outcome = "max_tokens"
+        elif response.stopped_early:
+            outcome = "stopped_early"
+        elif response.complete:
+            outcome = "complete"
+        else:
+            outcome = "unterminated"
+        with self._lock:
+            self._increment("streams", outcome=outcome)
+
+    def record_hedge(self, event):
+        """Count a hedged request being "issued" or having "won" (see hedging.py)."""
+        with self._lock:
+            self._increment("hedges", event=event)
+
+    def record_candidate(self, outcome):
+        """Count one candidate of a multi-candidate call: "kept", "alternate", "rejected" or "empty"."""
+        with self._lock:
+            self._increment("candidates", outcome=outcome)
+
+    def record_failure(self, reason):
+        """Count a failed attempt by failure_ledger reason code."""
+        with self._lock:
+            self._increment("failed_attempts", reason=reason or "unknown")
+
+    def record_job(self, category, attempts, succeeded):
+        with self._lock:
+            self.attempts.observe(attempts)
+            if succeeded and self.first_case_seconds is None:
+                self.first_case_seconds = round(time.time() - self.started, 3)
+            self._increment("differentials", outcome="succeeded" if succeeded else "failed")
+            self._increment("differentials_by_category", category=category or "Unknown",
+                            outcome="succeeded" if succeeded else "failed")
+
+    def counter(self, metric, **labels):
+        with self._lock:
+            return self.counters.get((metric, tuple(sorted(labels.items()))), 0)
+
+    def summary(self):
+        with self._lock:
+            counters = {}
+            for (metric, labels), value in sorted(self.counters.items()):
+                label_text = ",".join(f"{k}={v}" for k, v in labels)
+                counters.setdefault(metric, {})[label_text] = value
+            by_complaint = {}
+            by_category = {}
+            for (complaint, category), totals in sorted(self.tokens.items()):
+                for key, target in ((complaint, by_complaint), (category, by_category)):
+                    aggregate = target.setdefault(key, dict.fromkeys(totals, 0))
+                    for name, value in totals.items():
+                        aggregate[name] += value
+            return {
+                "started": self.started,
+                "duration_seconds": round(time.time() - self.started, 3),
+                "first_case_seconds": self.first_case_seconds,
+                "model_call_latency_seconds": self.call_latency.summary(),
+                "attempts_per_differential": self.attempts.summary(),
+                "counters": counters,
+                "tokens_by_complaint": by_complaint,
+                "tokens_by_category": by_category,
+                "tokens_total": {name: sum(t[name] for t in by_complaint.values())
+                                 for name in ("calls", "prompt", "output", "cached", "total")},
+            }
+
+    def write_json(self, path, summary=None):
+        _ensure_parent(path)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(summary or self.summary(), f, indent=2, ensure_ascii=False)
+
+    def write_csv(self, path, summary=None):
+        """One row per value: metric, labels (k=v;...), value."""
+        summary = summary or self.summary()
+        _ensure_parent(path)
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["metric", "labels", "value"])
+            writer.writerow(["duration_seconds", "", summary["duration_seconds"]])
+            writer.writerow(["first_case_seconds", "", summary.get("first_case_seconds")])
+            for name in ("model_call_latency_seconds", "attempts_per_differential"):
+                for stat in ("count", "sum", "mean", "min", "p50", "p90", "p99", "max"):
+                    writer.writerow([f"{name}_{stat}", "", summary[name][stat]])
+            for metric, values in summary["counters"].items():
+                for labels, value in values.items():
+                    writer.writerow([metric, labels.replace(",", ";"), value])
+            for group, label in (("tokens_by_complaint", "complaint"), ("tokens_by_category", "category")):
+                for key, totals in summary[group].items():
+                    for name, value in totals.items():
+                        writer.writerow([f"tokens_{name}", f"{label}={key}", value])
+
+    def write_prometheus(self, path):
+        """Write the metrics in Prometheus text exposition format (atomically, for textfile collectors)."""
+        lines = []
+        with self._lock:
+            for name, histogram, help_text in (
+                    ("model_call_latency_seconds", self.call_latency, "Latency of model generate calls."),
+                    ("attempts_per_differential", self.attempts, "Attempts made per differential.")):
+                metric = PROMETHEUS_PREFIX + name
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+                lines += [f"{metric}_sum {histogram.sum}", f"{metric}_count {histogram.count}"]
+            for counter_name in sorted({metric for metric, _ in self.counters}):
+                metric = f"{PROMETHEUS_PREFIX}{counter_name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (name, labels), value in sorted(self.counters.items()):
+                    if name == counter_name:
+                        lines.append(f"{metric}{_prometheus_labels(labels)} {value}")
+            metric = f"{PROMETHEUS_PREFIX}tokens_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (complaint, category), totals in sorted(self.tokens.items()):
+                for kind in ("prompt", "output", "cached"):
+                    labels = (("category", category), ("complaint", complaint), ("kind", kind))
+                    lines.append(f"{metric}{_prometheus_labels(labels)} {totals[kind]}")
+            if self.first_case_seconds is not None:
+                metric = f"{PROMETHEUS_PREFIX}first_case_seconds"
+                lines += [f"# HELP {metric} Seconds from the start of the run to the first accepted case.",
+                          f"# TYPE {metric} gauge", f"{metric} {self.first_case_seconds}"]
+        _ensure_parent(path)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+    def write_reports(self, json_path, prometheus_path=None):
+        """Write the JSON summary, a CSV next to it and optionally Prometheus text; prints a one-line digest."""
+        summary = self.summary()
+        self.write_json(json_path, summary)
+        csv_path = os.path.splitext(json_path)[0] + ".csv"
+        self.write_csv(csv_path, summary)
+        written = [json_path, csv_path]
+        if prometheus_path:
+            self.write_prometheus(prometheus_path)
+            written.append(prometheus_path)
+        print_digest(summary)
+        print(f"📊 Run metrics written to {', '.join(written)}")
+        return summary
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _ensure_parent(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def _format_seconds(value):
+    return "n/a" if value is None else f"{value:.2f}s"
+
+
+def print_digest(summary):
+    latency = summary["model_call_latency_seconds"]
+    tokens = summary["tokens_total"]
+    print(f"⏱️ Model call latency over {latency['count']} calls: p50 {_format_seconds(latency['p50'])}, "
+          f"p90 {_format_seconds(latency['p90'])}, p99 {_format_seconds(latency['p99'])}, max {_format_seconds(latency['max'])}")
+    print(f"🔢 Tokens: {tokens['prompt']} prompt, {tokens['output']} output, {tokens['cached']} cached "
+          f"over {tokens['calls']} responses")
+    responses = summary["counters"].get("responses", {})
+    if responses:
+        print("🧾 Responses: " + ", ".join(f"{labels.split('=', 1)[1]} {count}" for labels, count in responses.items()))
+    streams = summary["counters"].get("streams", {})
+    if streams:
+        print("📡 Streams: " + ", ".join(f"{labels.split('=', 1)[1]} {count}" for labels, count in streams.items()))
+    candidates = summary["counters"].get("candidates", {})
+    if candidates:
+        print("🎯 Candidates: " + ", ".join(f"{labels.split('=', 1)[1]} {count}" for labels, count in candidates.items()))
+    hedges = summary["counters"].get("hedges", {})
+    if hedges:
+        print(f"🪁 Hedged requests: {hedges.get('event=issued', 0)} issued, {hedges.get('event=won', 0)} won")
+    if summary.get("first_case_seconds") is not None:
+        print(f"🥇 First case accepted after {_format_seconds(summary['first_case_seconds'])}")
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry():
+    """Return the process-wide Telemetry shared by the generation code."""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry()
+        return _telemetry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the digest of a saved run metrics summary")
+    parser.add_argument("path", nargs="?", default=os.path.join("artefacts", DEFAULT_METRICS_FILENAME),
+                        help=f"Summary JSON written by a run (default: artefacts/{DEFAULT_METRICS_FILENAME}).")
+    args = parser.parse_args()
+    with open(args.path, 'r', encoding='utf-8') as f:
+        saved = json.load(f)
+    print_digest(saved)
+    for complaint, totals in saved["tokens_by_complaint"].items():
+        print(f"  {complaint}: {totals['total']} tokens over {totals['calls']} responses")
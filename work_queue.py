@@ -0,0 +1,137 @@
+"""
+Attempt-level work queue for retrying many differentials concurrently.
+
+Each queued job is one differential; a worker takes a job, makes a single
+attempt and, if that attempt failed and the job still has budget, puts it at
+the back of the queue (optionally not before a back-off delay). So one
+stubborn differential never holds a worker for all of its attempts, and
+retries for every complaint interleave:
+
+    def attempt(job):
+        ...
+        return {"ok": False, "retry_delay": backoff_delay(job["attempts"])}
+
+    run_attempt_queue(jobs, attempt, on_finished, concurrency=4, max_attempts=15)
+
+Jobs are plain dicts; the queue maintains job["attempts"].
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from run_logging import get_logger
+
+logger = get_logger("work_queue")
+
+
+def interleave(groups):
+    """Round-robin over lists of jobs: the first job of every group, then the second, and so on."""
+    return [job for round_ in itertools.zip_longest(*groups) for job in round_ if job is not None]
+
+
+class AttemptQueue:
+    """
+    Thread-safe queue of jobs with delayed re-queueing; get() returns None once all work is finished.
+
+    With more_jobs=True the queue is fed with add() and get() keeps waiting
+    for work until end_input() is called.
+    """
+
+    def __init__(self, jobs=(), more_jobs=False):
+        self._ready = deque(jobs)
+        self._delayed = []  # heap of (ready_at, seq, job)
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._more_jobs = more_jobs
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def add(self, job):
+        with self._cond:
+            self._ready.append(job)
+            self._cond.notify()
+
+    def end_input(self):
+        """No more add() calls will follow; get() returns None once the queued work is finished."""
+        with self._cond:
+            self._more_jobs = False
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._delayed)[2])
+                if self._ready:
+                    self._in_flight += 1
+                    return self._ready.popleft()
+                if not self._delayed and not self._in_flight and not self._more_jobs:
+                    # Nothing queued and nothing that could be re-queued: wake the other workers and stop.
+                    self._cond.notify_all()
+                    return None
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+    def task_done(self, job, retry_delay=None):
+        """Finish the attempt taken by get(); with retry_delay set (seconds, may be 0) the job is re-queued."""
+        with self._cond:
+            self._in_flight -= 1
+            if retry_delay is not None:
+                if retry_delay > 0:
+                    heapq.heappush(self._delayed, (time.monotonic() + retry_delay, next(self._seq), job))
+                else:
+                    self._ready.append(job)
+            self._cond.notify_all()
+
+    def close(self):
+        """Stop handing out jobs (e.g. on Ctrl-C); workers finish their current attempt and exit."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+def run_attempt_queue(jobs, attempt, on_finished, concurrency=1, max_attempts=15):
+    """
+    Run attempt(job) until each job succeeds or has used max_attempts attempts.
+
+    attempt(job) returns a dict with "ok" and optionally "retry_delay" (seconds
+    before the job may be tried again). on_finished(job, ok) is called once per
+    job from the worker thread that made its last attempt. An exception from
+    attempt() counts as a failed attempt with no delay.
+    """
+    queue = AttemptQueue(jobs)
+
+    def worker():
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            job["attempts"] = job.get("attempts", 0) + 1
+            try:
+                outcome = attempt(job)
+            except Exception as e:
+                logger.error(f"❌ Error: {str(e)}", exc_info=True, extra={"attempt": job["attempts"]})
+                outcome = {"ok": False}
+            if outcome["ok"] or job["attempts"] >= max_attempts:
+                try:
+                    on_finished(job, outcome["ok"])
+                finally:
+                    queue.task_done(job)
+            else:
+                queue.task_done(job, outcome.get("retry_delay") or 0)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="retry")
+    futures = [executor.submit(worker) for _ in range(max(1, concurrency))]
+    try:
+        for future in futures:
+            future.result()
+    finally:
+        queue.close()
+        executor.shutdown(wait=True)